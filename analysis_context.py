@@ -0,0 +1,45 @@
+from indicators import add_indicators
+
+class AnalysisContext:
+    """
+    單次分析（例如一個頁面請求）共用的資料與計算結果
+
+    保存 K 線的 OHLCV 陣列，技術指標與各分析函數的結果在第一次使用時計算並快取，
+    同一個 context 傳給所有分析函數時每項結果只計算一次。hits / misses 記錄快取命中情形。
+    """
+
+    def __init__(self, kline_df):
+        self.kline_df = kline_df
+        self.open = kline_df['Open'].to_numpy(dtype=float)
+        self.high = kline_df['High'].to_numpy(dtype=float)
+        self.low = kline_df['Low'].to_numpy(dtype=float)
+        self.close = kline_df['Close'].to_numpy(dtype=float)
+        self.volume = kline_df['Volume'].to_numpy(dtype=float)
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.kline_df)
+
+    def memoize(self, key, compute):
+        """返回 key 的快取結果，尚未計算時呼叫 compute() 並保存"""
+        if key in self._cache:
+            self.hits += 1
+            return self._cache[key]
+        self.misses += 1
+        value = self._cache[key] = compute()
+        return value
+
+    @property
+    def frame(self):
+        """帶有技術指標欄位的 K 線（已預先計算的指標直接使用，否則計算一次）"""
+        return self.memoize('indicators', lambda: add_indicators(self.kline_df))
+
+    def cache_stats(self):
+        """返回快取命中次數、未命中次數與已快取的項目"""
+        return {'hits': self.hits, 'misses': self.misses, 'keys': list(self._cache)}
+
+def get_context(data):
+    """分析函數的輸入可以是 K 線 DataFrame 或 AnalysisContext，統一轉為 AnalysisContext"""
+    return data if isinstance(data, AnalysisContext) else AnalysisContext(data)
@@ -1,6 +1,8 @@
 import pandas as pd
-import pandas_ta as ta
-from trend_pattern_analysis import analyze_trend_patterns
+from indicators import INDICATOR_WARMUP_BARS
+from analysis_context import get_context
+from candlestick_patterns import scan_candlestick_patterns, REPORT_OFFSET
+from trend_pattern_analysis import analyze_trend_patterns, TREND_LOOKBACK_DAYS, LOOKBACK_BARS as TREND_LOOKBACK_BARS
 from valuation_analysis import perform_fundamental_valuation
 
 def analyze_kline(df, lookback_bars=15):
@@ -8,25 +10,23 @@ def analyze_kline(df, lookback_bars=15):
     Analyze K-line patterns and return recent signals with scores
     
     參數:
-    - df: 完整的K線數據
+    - df: 完整的K線數據，或 AnalysisContext（同一 context 內只計算一次）
     - lookback_bars: 只分析最近幾根K線（預設15根）
     """
+    ctx = get_context(df)
+    return ctx.memoize(('analyze_kline', lookback_bars), lambda: _analyze_kline(ctx, lookback_bars))
+
+def _analyze_kline(ctx, lookback_bars):
     signals = {}
-    if len(df) < 60:  # Ensure enough data for analysis
+    if len(ctx) < 60:  # Ensure enough data for analysis
         signals['Error'] = '資料不足，無法進行 K 線型態分析'
         return signals
-    if len(df) < 2:
-        return signals
 
-    # Calculate technical indicators
-    df = df.copy()
-    df.ta.sma(length=20, append=True)
-    df.ta.sma(length=60, append=True)
-    df.ta.macd(append=True)
-    df.ta.stoch(append=True)
-
-    # 只分析最近的 K 線
-    start_index = max(3, len(df) - lookback_bars)
+    # 整段K線的型態掃描結果（同一 context 內共用），這裡只取最近的 K 線
+    table = scan_candlestick_patterns(ctx)
+    start_index = max(3, len(ctx) - lookback_bars)
+    offsets = table['Pattern'].map(REPORT_OFFSET).fillna(0)
+    recent = table[table['Bar'] >= start_index + offsets]
     
     # 輔助函數：格式化日期
     def format_date(date_index):
@@ -35,249 +35,15 @@ def analyze_kline(df, lookback_bars=15):
         else:
             return str(date_index)
     
-    # Analyze candlestick patterns
-    for i in range(start_index, len(df)):  # 只分析最近的K線
-        last = df.iloc[i]
-        prev = df.iloc[i-1]
-        prev2 = df.iloc[i-2]
-        prev3 = df.iloc[i-3]
-
-        # Bullish Patterns (+1 score)
-        # 1. Bullish Engulfing
-        if (prev['Close'] < prev['Open'] and 
-            last['Close'] > last['Open'] and 
-            last['Close'] > prev['Open'] and 
-            last['Open'] < prev['Close']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '看漲吞噬',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 2. Piercing Line
-        if (prev['Close'] < prev['Open'] and 
-            last['Close'] > last['Open'] and 
-            last['Open'] < prev['Close'] and 
-            last['Close'] > (prev['Open'] + prev['Close']) / 2 and 
-            last['Close'] < prev['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '刺透線',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 3. Morning Star (3-candle pattern)
-        if (prev2['Close'] < prev2['Open'] and 
-            abs(prev['Close'] - prev['Open']) < abs(prev2['Close'] - prev2['Open']) * 0.5 and 
-            last['Close'] > last['Open'] and 
-            last['Close'] > prev2['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '早晨之星',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 4. Three White Soldiers (3-candle pattern)
-        if (prev2['Close'] > prev2['Open'] and 
-            prev['Close'] > prev['Open'] and 
-            last['Close'] > last['Open'] and 
-            prev2['Close'] > prev2['Open'] * 1.01 and 
-            prev['Close'] > prev['Open'] * 1.01 and 
-            last['Close'] > last['Open'] * 1.01):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '紅三兵',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 5. Rising Three Methods (simplified, 5-candle pattern)
-        if i >= 5 and i >= start_index + 2 and \
-           df.iloc[i-4]['Close'] > df.iloc[i-4]['Open'] and \
-           df.iloc[i-3]['Close'] < df.iloc[i-3]['Open'] and \
-           df.iloc[i-2]['Close'] < df.iloc[i-2]['Open'] and \
-           df.iloc[i-1]['Close'] < df.iloc[i-1]['Open'] and \
-           last['Close'] > last['Open'] and last['Close'] > df.iloc[i-4]['Close']:
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '上升三法',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 6. Three Inside Up
-        if (prev2['Close'] < prev2['Open'] and 
-            prev['Close'] > prev['Open'] and 
-            prev['Open'] > prev2['Close'] and 
-            prev['Close'] < prev2['Open'] and 
-            last['Close'] > last['Open'] and 
-            last['Close'] > prev2['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '三內升勢',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 7. Bullish Harami
-        if (prev['Close'] < prev['Open'] and 
-            last['Close'] > last['Open'] and 
-            last['Open'] > prev['Close'] and 
-            last['Close'] < prev['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '夾陽線',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # 8. Three White Gaps
-        if i >= 3 and prev2['Close'] > prev2['Open'] and \
-           prev['Close'] > prev['Open'] and prev['Open'] > prev2['Close'] and \
-           last['Close'] > last['Open'] and last['Open'] > prev['Close']:
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '三空白',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-        # Bearish Patterns (-1 score)
-        # 1. Bearish Engulfing
-        if (prev['Close'] > prev['Open'] and 
-            last['Close'] < last['Open'] and 
-            last['Close'] < prev['Open'] and 
-            last['Open'] > prev['Close']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '看跌吞噬',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 2. Dark Cloud Cover
-        if (prev['Close'] > prev['Open'] and 
-            last['Close'] < last['Open'] and 
-            last['Open'] > prev['Close'] and 
-            last['Close'] < (prev['Open'] + prev['Close']) / 2 and 
-            last['Close'] > prev['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '烏雲蓋頂',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 3. Evening Star (3-candle pattern)
-        if (prev2['Close'] > prev2['Open'] and 
-            abs(prev['Close'] - prev['Open']) < abs(prev2['Close'] - prev2['Open']) * 0.5 and 
-            last['Close'] < last['Open'] and 
-            last['Close'] < prev2['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '黃昏之星',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 4. Three Black Crows (3-candle pattern)
-        if (prev2['Close'] < prev2['Open'] and 
-            prev['Close'] < prev['Open'] and 
-            last['Close'] < last['Open'] and 
-            prev2['Close'] < prev2['Open'] * 0.99 and 
-            prev['Close'] < prev['Open'] * 0.99 and 
-            last['Close'] < last['Open'] * 0.99):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '黑三鴉',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 5. Falling Three Methods (simplified, 5-candle pattern)
-        if i >= 5 and i >= start_index + 2 and \
-           df.iloc[i-4]['Close'] < df.iloc[i-4]['Open'] and \
-           df.iloc[i-3]['Close'] > df.iloc[i-3]['Open'] and \
-           df.iloc[i-2]['Close'] > df.iloc[i-2]['Open'] and \
-           df.iloc[i-1]['Close'] > df.iloc[i-1]['Open'] and \
-           last['Close'] < last['Open'] and last['Close'] < df.iloc[i-4]['Close']:
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '下降三法',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 6. Three Inside Down
-        if (prev2['Close'] > prev2['Open'] and 
-            prev['Close'] < prev['Open'] and 
-            prev['Open'] < prev2['Close'] and 
-            prev['Close'] > prev2['Open'] and 
-            last['Close'] < last['Open'] and 
-            last['Close'] < prev2['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '三內下降勢',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 7. Bearish Harami
-        if (prev['Close'] > prev['Open'] and 
-            last['Close'] < last['Open'] and 
-            last['Open'] < prev['Close'] and 
-            last['Close'] > prev['Open']):
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '夾陰線',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # 8. Three Black Gaps
-        if i >= 3 and prev2['Close'] < prev2['Open'] and \
-           prev['Close'] < prev['Open'] and prev['Open'] < prev2['Close'] and \
-           last['Close'] < last['Open'] and last['Open'] < prev['Close']:
-            signals[df.index[i]] = {
-                'type': 'K-Line',
-                'signal': '三空黑',
-                'recommendation': '賣出訊號',
-                'score': -1,
-                'date': format_date(df.index[i])
-            }
-
-        # Price Breakout
-        if i > 1 and last['Close'] > df['High'].iloc[i-2:i].max() and last['Volume'] > df['Volume'].iloc[i-1]:
-            signals[df.index[i]] = {
-                'type': 'Breakout',
-                'signal': '價格突破前高',
-                'recommendation': '買進訊號',
-                'score': 1,
-                'date': format_date(df.index[i])
-            }
-
-    # Keep only the most recent 5 signals
-    if signals:
-        sorted_signals = dict(sorted(signals.items(), key=lambda x: x[0], reverse=True))
-        signals = dict(list(sorted_signals.items())[:5])
+    # Keep only the most recent 5 signals (同一根K線符合多個型態時全部保留，依宣告順序排列)
+    for row in recent.sort_values('Date', ascending=False, kind='stable').head(5).itertuples(index=False):
+        signals[(row.Date, row.Pattern)] = {
+            'type': row.Type,
+            'signal': row.Pattern,
+            'recommendation': row.Recommendation,
+            'score': int(row.Score),
+            'date': format_date(row.Date)
+        }
 
     print(f"Generated kline signals (recent 5 from last {lookback_bars} bars): {signals}")
     return signals
@@ -378,17 +144,15 @@ def generate_comprehensive_conclusion_with_patterns(kline_df, fundamental_analys
     """
     生成包含趨勢型態分析的綜合結論
     這個函數會取代原本的 generate_comprehensive_conclusion
+    kline_df 可以是 K 線 DataFrame 或 AnalysisContext
     """
     buy_score = 0
     sell_score = 0
     reasons = []
 
-    # 計算技術指標
-    kline_df = kline_df.copy()
-    kline_df.ta.sma(length=20, append=True)
-    kline_df.ta.sma(length=60, append=True)
-    kline_df.ta.macd(append=True)
-    kline_df.ta.stoch(append=True)
+    # 計算技術指標（與其他分析共用 context 中的結果）
+    ctx = get_context(kline_df)
+    kline_df = ctx.frame
     
     last = kline_df.iloc[-1]
 
@@ -427,7 +191,7 @@ def generate_comprehensive_conclusion_with_patterns(kline_df, fundamental_analys
             reasons.append("KD 指標進入超買區 (>80)")
 
     # K-line Pattern Scoring (原本的)
-    kline_signals = analyze_kline(kline_df)
+    kline_signals = analyze_kline(ctx)
     for signal in kline_signals.values():
         if 'score' in signal:
             if signal['score'] > 0:
@@ -438,7 +202,7 @@ def generate_comprehensive_conclusion_with_patterns(kline_df, fundamental_analys
                 reasons.append(f"K 線訊號: {signal['signal']}")
 
     # 新增：趨勢型態分析評分
-    trend_patterns = analyze_trend_patterns(kline_df, lookback_days=200)
+    trend_patterns = analyze_trend_patterns(ctx, lookback_days=TREND_LOOKBACK_DAYS)
     for pattern_name, (score, description) in trend_patterns.items():
         if score > 0:
             buy_score += abs(score)
@@ -508,17 +272,14 @@ def generate_comprehensive_conclusion_with_patterns(kline_df, fundamental_analys
     }
 
 def generate_comprehensive_conclusion(kline_df, fundamental_analysis):
-    """Generate comprehensive conclusion with K-line pattern scores"""
+    """Generate comprehensive conclusion with K-line pattern scores (kline_df may be an AnalysisContext)"""
     buy_score = 0
     sell_score = 0
     reasons = []
 
-    # Calculate technical indicators
-    kline_df = kline_df.copy()
-    kline_df.ta.sma(length=20, append=True)
-    kline_df.ta.sma(length=60, append=True)
-    kline_df.ta.macd(append=True)
-    kline_df.ta.stoch(append=True)
+    # Calculate technical indicators (shared through the analysis context)
+    ctx = get_context(kline_df)
+    kline_df = ctx.frame
     
     last = kline_df.iloc[-1]
 
@@ -557,7 +318,7 @@ def generate_comprehensive_conclusion(kline_df, fundamental_analysis):
             reasons.append("KD 指標進入超買區 (>80)")
 
     # K-line Pattern Scoring
-    kline_signals = analyze_kline(kline_df)
+    kline_signals = analyze_kline(ctx)
     for signal in kline_signals.values():
         if 'score' in signal:
             if signal['score'] > 0:
@@ -606,4 +367,28 @@ def generate_comprehensive_conclusion(kline_df, fundamental_analysis):
         "sell_score": round(sell_score, 1),
         "reasons": reasons,
         "class": conclusion_class
-    }
\ No newline at end of file
+    }
+
+# 分析最近15根K線時最多往前看4根，另外至少需要60根才會進行分析
+_kline_bars = max(60, 15 + 4)
+
+# 各分析函數（依預設參數）需要的最少K線數，超過的歷史不影響結果
+LOOKBACK_BARS = {
+    analyze_kline: _kline_bars,
+    generate_comprehensive_conclusion: max(INDICATOR_WARMUP_BARS, _kline_bars),
+    generate_comprehensive_conclusion_with_patterns: max(INDICATOR_WARMUP_BARS, _kline_bars, TREND_LOOKBACK_DAYS),
+    # 趨勢型態函數讀取的指標欄位也需要暖身
+    **{func: max(bars, INDICATOR_WARMUP_BARS) for func, bars in TREND_LOOKBACK_BARS.items()},
+}
+
+def plan_kline_window(analyzers, display_bars=0):
+    """
+    計算一組分析函數合計需要讀取的K線數
+    
+    參數:
+    - analyzers: 要執行的分析函數（需在 LOOKBACK_BARS 中宣告）
+    - display_bars: 另外需要顯示的最近K線數
+    
+    返回可傳給 get_kline / get_klines 的 last_n；只讀取這個範圍與讀取完整歷史的分析結果相同。
+    """
+    return max([display_bars] + [LOOKBACK_BARS[func] for func in analyzers])
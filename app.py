@@ -3,12 +3,12 @@ import pandas as pd
 import plotly.graph_objects as go
 import plotly.io as pio
 from analysis_engine import analyze_kline, analyze_fundamentals, generate_comprehensive_conclusion
-from database import get_kline, get_info, get_financials
-import pandas_ta as ta
+from database import get_kline, get_klines, get_info, get_financials, get_pattern_timeline
+from analysis_context import AnalysisContext
 import os
 import sys
-from analysis_engine import analyze_fundamentals_with_valuation, generate_comprehensive_conclusion_with_patterns
-from trend_pattern_analysis import analyze_trend_patterns
+from analysis_engine import analyze_fundamentals_with_valuation, generate_comprehensive_conclusion_with_patterns, plan_kline_window
+from trend_pattern_analysis import analyze_trend_patterns, scan_multiscale_patterns, MULTISCALE_ORDERS
 from valuation_analysis import perform_fundamental_valuation
 
 # 取得執行檔案的目錄
@@ -50,6 +50,9 @@ if template_path is None:
 
 app = Flask(__name__, template_folder=template_path if template_path else None)
 
+# 個股頁面顯示的歷史型態筆數
+PATTERN_HISTORY_ROWS = 20
+
 # 加入錯誤處理
 @app.errorhandler(500)
 def internal_error(error):
@@ -69,10 +72,16 @@ def index():
     from config import TICKERS
     
     summary_data = []
+    # 以單一查詢讀取所有股票分析所需的最近K線，再依股票分組
+    last_n = plan_kline_window([generate_comprehensive_conclusion])
+    kline_groups = {
+        ticker: group.set_index('Date')
+        for ticker, group in get_klines(list(TICKERS.values()), last_n=last_n, with_indicators=True).groupby('Ticker')
+    }
     for name, ticker in TICKERS.items():
         try:
             info = get_info(ticker)
-            kline_df = get_kline(ticker)
+            kline_df = kline_groups.get(ticker, pd.DataFrame())
             last_price = kline_df.iloc[-1]['Close'] if not kline_df.empty else 0
             
             # 先取得PE
@@ -118,7 +127,10 @@ def index():
 def stock_detail(ticker):
     try:
         info = get_info(ticker)
-        kline_df = get_kline(ticker)
+        # 只讀取分析與圖表（最多120根）需要的最近K線，連同抓取時預先計算的技術指標
+        kline_df = get_kline(ticker, last_n=plan_kline_window(
+            [generate_comprehensive_conclusion_with_patterns, analyze_kline], display_bars=120),
+            with_indicators=True)
         financials_df = get_financials(ticker)
         
         if info is not None and isinstance(info, pd.DataFrame) and not info.empty:
@@ -131,13 +143,10 @@ def stock_detail(ticker):
 
         company_name = info['Name'] if info is not None and 'Name' in info else ticker
 
-        # 計算技術指標
+        # 技術指標與各項分析結果在同一個 context 中只計算一次（指標表尚未涵蓋時才即時計算指標）
+        ctx = AnalysisContext(kline_df)
         try:
-            kline_df = kline_df.copy()
-            kline_df.ta.sma(length=20, append=True)
-            kline_df.ta.sma(length=60, append=True)
-            kline_df.ta.macd(append=True)
-            kline_df.ta.stoch(append=True)
+            kline_df = ctx.frame
         except Exception as e:
             print(f"Indicator error: {e}")
             return f"<h1>技術指標計算失敗: {e}</h1>"
@@ -146,11 +155,17 @@ def stock_detail(ticker):
         
         # 使用新的分析函數
         fundamental_analysis = analyze_fundamentals_with_valuation(info, financials_df, last_price)
-        conclusion = generate_comprehensive_conclusion_with_patterns(kline_df, fundamental_analysis)
-        kline_signals = analyze_kline(kline_df)
+        conclusion = generate_comprehensive_conclusion_with_patterns(ctx, fundamental_analysis)
+        kline_signals = analyze_kline(ctx)
         
         # 新增：趨勢型態分析
         trend_patterns = conclusion.get('trend_patterns', {})
+        # 歷史型態：直接讀取抓取時保存的型態時間軸，最近的在前
+        pattern_history = [
+            {'start': row.Start.strftime('%Y-%m-%d'), 'end': row.End.strftime('%Y-%m-%d'),
+             'pattern': row.Pattern, 'score': int(row.Score)}
+            for row in get_pattern_timeline(ticker).tail(PATTERN_HISTORY_ROWS).iloc[::-1].itertuples()
+        ]
         
         # 新增：估值分析詳情
         valuation_details = fundamental_analysis.pop('_valuation_details', None)
@@ -219,6 +234,7 @@ def stock_detail(ticker):
                 macd_kd_json=macd_kd_json,
                 kline_analysis=list(kline_signals.values()) if isinstance(kline_signals, dict) else [],
                 trend_patterns=trend_patterns,  # 新增
+                pattern_history=pattern_history,
                 fundamental_analysis=fundamental_analysis if isinstance(fundamental_analysis, dict) else {'Error': '數據無效'},
                 valuation_details=valuation_details,  # 新增
                 conclusion=conclusion,
@@ -233,6 +249,7 @@ def stock_detail(ticker):
                 macd_kd_json=macd_kd_json,
                 kline_analysis=list(kline_signals.values()) if isinstance(kline_signals, dict) else [],
                 trend_patterns=trend_patterns,  # 新增
+                pattern_history=pattern_history,
                 fundamental_analysis=fundamental_analysis if isinstance(fundamental_analysis, dict) else {'Error': '數據無效'},
                 valuation_details=valuation_details,  # 新增
                 conclusion=conclusion,
@@ -242,5 +259,69 @@ def stock_detail(ticker):
         print(f"Error in stock_detail: {e}")
         return f"<h1>處理 {ticker} 時發生錯誤: {str(e)}</h1>"
 
+def _date_bounds():
+    """
+    解析查詢參數 start / end（YYYY-MM-DD）
+    返回 ({'start': Timestamp, 'end': Timestamp}（只含有提供的參數）, 錯誤訊息或 None)
+    """
+    bounds = {}
+    for name in ('start', 'end'):
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            bounds[name] = pd.Timestamp(value)
+        except ValueError:
+            bounds[name] = pd.NaT
+        if pd.isna(bounds[name]):
+            return bounds, f"Invalid {name} date: {value!r}"
+    if 'start' in bounds and 'end' in bounds and bounds['start'] > bounds['end']:
+        return bounds, "start must not be after end"
+    return bounds, None
+
+@app.route('/api/pattern_timeline/<ticker>')
+def pattern_timeline(ticker):
+    """返回保存的型態時間軸（JSON），可用 start / end 參數（YYYY-MM-DD）限定型態的結束日期，格式錯誤時返回 400"""
+    bounds, error = _date_bounds()
+    if error:
+        return jsonify({'error': error}), 400
+    timeline = get_pattern_timeline(ticker, **bounds)
+    return jsonify([
+        {'start': row.Start.strftime('%Y-%m-%d'), 'end': row.End.strftime('%Y-%m-%d'),
+         'pattern': row.Pattern, 'score': int(row.Score)}
+        for row in timeline.itertuples()
+    ])
+
+@app.route('/api/multiscale_patterns/<ticker>')
+def multiscale_patterns(ticker):
+    """
+    以完整K線在每個極值尺度（見 MULTISCALE_ORDERS）掃描雙重頂底、三角形與楔形，返回型態列表（JSON）
+    可用 start / end 參數限定型態的結束日期、order 參數只掃描單一尺度，格式錯誤時返回 400
+    """
+    bounds, error = _date_bounds()
+    if error:
+        return jsonify({'error': error}), 400
+    orders = MULTISCALE_ORDERS
+    order = request.args.get('order')
+    if order is not None:
+        if not order.isdigit() or int(order) not in MULTISCALE_ORDERS:
+            return jsonify({'error': f"order must be between {MULTISCALE_ORDERS.start} and "
+                                     f"{MULTISCALE_ORDERS.stop - 1}"}), 400
+        orders = [int(order)]
+    
+    kline_df = get_kline(ticker)
+    if kline_df.empty:
+        return jsonify([])
+    patterns = scan_multiscale_patterns(kline_df[['Open', 'High', 'Low', 'Close', 'Volume']].astype(float), orders)
+    if 'start' in bounds:
+        patterns = patterns[patterns['End'] >= bounds['start']]
+    if 'end' in bounds:
+        patterns = patterns[patterns['End'] <= bounds['end']]
+    return jsonify([
+        {'order': int(row.Order), 'start': row.Start.strftime('%Y-%m-%d'), 'end': row.End.strftime('%Y-%m-%d'),
+         'pattern': row.Pattern, 'score': int(row.Score)}
+        for row in patterns.itertuples()
+    ])
+
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
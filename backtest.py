@@ -0,0 +1,366 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from analysis_engine import LOOKBACK_BARS, generate_comprehensive_conclusion_with_patterns
+from candlestick_patterns import PATTERNS, compile_patterns
+from indicators import add_indicators
+from trend_pattern_analysis import (TREND_LOOKBACK_DAYS, TIMELINE_CONFIRM_BARS, TIMELINE_WINDOWS,
+                                    scan_pattern_timeline)
+
+logger = logging.getLogger(__name__)
+
+# 回測只評分暖身完成後的日期，與頁面以 plan_kline_window 讀取的資料得到相同的分數
+FIRST_SCORED_BAR = LOOKBACK_BARS[generate_comprehensive_conclusion_with_patterns] - 1
+# analyze_kline 的預設設定：最近 15 根K線中最新的 5 個訊號
+KLINE_LOOKBACK_BARS = 15
+KLINE_MAX_SIGNALS = 5
+
+_evaluate_patterns = compile_patterns(PATTERNS)
+
+def _window_extrema(values, window, order):
+    """
+    每個長度 window 的滑動窗口內的局部極大值（與 argrelextrema 相同的邊界規則）
+
+    返回 (窗口矩陣, 遮罩)，shape 皆為 (n - window + 1, window)；第 r 列為結束於第 r + window - 1 根的窗口。
+    """
+    windows = sliding_window_view(values, window)
+    columns = np.arange(window)
+    mask = np.ones(windows.shape, dtype=bool)
+    for k in range(1, order + 1):
+        mask &= windows > windows[:, np.minimum(columns + k, window - 1)]
+        mask &= windows > windows[:, np.maximum(columns - k, 0)]
+    return windows, mask
+
+def _last_two(mask):
+    """每列最後兩個 True 的欄位位置（不存在時為 -1）"""
+    window = mask.shape[1]
+    columns = np.where(mask, np.arange(window), -1)
+    last = columns.max(axis=1)
+    second = np.where(columns < last[:, None], columns, -1).max(axis=1)
+    return second, last
+
+def _range_extreme(values, start, stop, func, fill):
+    """每列在欄位 [start, stop) 範圍內的 func（min / max）"""
+    columns = np.arange(values.shape[1])
+    inside = (columns >= start[:, None]) & (columns < stop[:, None])
+    return func(np.where(inside, values, fill), axis=1)
+
+def _align(values, window, n):
+    """將滑動窗口的結果（第 r 列對應第 r + window - 1 根）對齊回長度 n 的序列"""
+    aligned = np.zeros(n, dtype=values.dtype)
+    aligned[window - 1:] = values
+    return aligned
+
+def _window_run_bars(timeline, index):
+    """
+    時間軸中滑動窗口型態（見 TIMELINE_WINDOWS）每一列在 index 中的第一個與最後一個窗口的結束位置，
+    其他型態或不在 index 中的日期為 -1
+    """
+    start = index.get_indexer(timeline['Start'])
+    window = timeline['Pattern'].map(TIMELINE_WINDOWS).fillna(0).to_numpy(dtype=int)
+    first = np.where((start >= 0) & (window > 0), start + window - 1, -1)
+    last = np.where(window > 0, index.get_indexer(timeline['End']), -1)
+    return first, last
+
+def _trend_pattern_scores(frame, timeline):
+    """
+    以滑動窗口一次計算每根K線的趨勢型態分數（對應 analyze_trend_patterns 中的各偵測函數）
+
+    三角形、楔形、旗型與圓弧型態直接讀取型態時間軸（見 trend_pattern_analysis.scan_pattern_timeline）中連續符合的窗口；
+    雙重頂底只看最近 200 根內的極值，需以窗口內的極值另外計算；頭肩型態已停用，不計分（見 detect_head_and_shoulders）。
+    返回 {型態名稱: 長度 n 的分數陣列}
+    """
+    high = frame['High'].to_numpy(dtype=float)
+    low = frame['Low'].to_numpy(dtype=float)
+    n = len(high)
+    scores = {}
+
+    # 雙重頂／雙重底：最近 200 根中最後兩個高（低）點
+    window = TREND_LOOKBACK_DAYS
+    if n >= window:
+        highs, high_mask = _window_extrema(high, window, 3)
+        lows, low_mask = _window_extrema(-low, window, 3)
+        lows = -lows
+        h1, h2 = _last_two(high_mask)
+        rows = np.arange(len(highs))
+        peak1, peak2 = highs[rows, h1], highs[rows, h2]
+        valley = _range_extreme(lows, h1, h2, np.min, np.inf)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            top = ((h1 >= 0) & (h2 > window - 30) &
+                   (np.abs(peak1 - peak2) / np.maximum(peak1, peak2) < 0.02) &
+                   ((peak1 - valley) / peak1 > 0.05))
+            l1, l2 = _last_two(low_mask)
+            valley1, valley2 = lows[rows, l1], lows[rows, l2]
+            peak = _range_extreme(highs, l1, l2, np.max, -np.inf)
+            bottom = (~top & (l1 >= 0) & (l2 > window - 30) &
+                      (np.abs(valley1 - valley2) / np.minimum(valley1, valley2) < 0.02) &
+                      ((peak - valley1) / valley1 > 0.05))
+        scores['雙重頂'] = _align(np.where(top, -1, 0), window, n)
+        scores['雙重底'] = _align(np.where(bottom, 1, 0), window, n)
+
+    # 三角形、楔形、旗型與圓弧型態：時間軸中每一列的第一個到最後一個窗口的結束K線
+    first, last = _window_run_bars(timeline, frame.index)
+    score = timeline['Score'].to_numpy(dtype=int)
+    for name in TIMELINE_WINDOWS:
+        rows = (timeline['Pattern'] == name).to_numpy() & (first >= 0) & (last >= 0)
+        delta = np.zeros(n + 1, dtype=int)
+        np.add.at(delta, first[rows], score[rows])
+        np.add.at(delta, last[rows] + 1, -score[rows])
+        scores[name] = np.cumsum(delta[:-1])
+
+    return scores
+
+def _cross_scores(frame):
+    """MACD／KD 交叉與均線排列（對應 detect_macd_cross、detect_kd_cross、detect_ma_arrangement）"""
+    def previous(column):
+        return frame[column].shift(1).to_numpy(dtype=float)
+
+    macd, signal = frame['MACD_12_26_9'].to_numpy(dtype=float), frame['MACDs_12_26_9'].to_numpy(dtype=float)
+    k, d = frame['STOCHk_14_3_3'].to_numpy(dtype=float), frame['STOCHd_14_3_3'].to_numpy(dtype=float)
+    close = frame['Close'].to_numpy(dtype=float)
+    sma20, sma60 = frame['SMA_20'].to_numpy(dtype=float), frame['SMA_60'].to_numpy(dtype=float)
+
+    golden = (previous('MACD_12_26_9') <= previous('MACDs_12_26_9')) & (macd > signal)
+    death = ~golden & (previous('MACD_12_26_9') >= previous('MACDs_12_26_9')) & (macd < signal)
+    kd_golden = (previous('STOCHk_14_3_3') <= previous('STOCHd_14_3_3')) & (k > d) & (k < 50)
+    kd_death = ~kd_golden & (previous('STOCHk_14_3_3') >= previous('STOCHd_14_3_3')) & (k < d) & (k > 50)
+    bull = (close > sma20) & (sma20 > sma60)
+    bear = ~bull & (close < sma20) & (sma20 < sma60)
+    return {
+        'MACD金叉': np.where(golden, 1, 0), 'MACD死叉': np.where(death, -1, 0),
+        'KD黃金交叉': np.where(kd_golden, 1, 0), 'KD死亡交叉': np.where(kd_death, -1, 0),
+        '均線多頭排列': np.where(bull, 1, 0), '均線空頭排列': np.where(bear, -1, 0),
+    }
+
+def _kline_signal_scores(pattern_masks):
+    """
+    每根K線的 analyze_kline 買賣分數：最近 15 根中依（日期新到舊、宣告順序）取前 5 個訊號加總
+
+    返回 (buy, sell)，長度 n；序列開頭不足 15 根的位置為 0。
+    """
+    matches = np.column_stack(pattern_masks)
+    n, count = matches.shape
+    buy, sell = np.zeros(n), np.zeros(n)
+    if n < KLINE_LOOKBACK_BARS:
+        return buy, sell
+
+    # (窗口, 新到舊的K線, 型態)
+    windows = sliding_window_view(matches, KLINE_LOOKBACK_BARS, axis=0).transpose(0, 2, 1)[:, ::-1, :]
+    position = KLINE_LOOKBACK_BARS - 1 - np.arange(KLINE_LOOKBACK_BARS)
+    offsets = np.array([p['report_offset'] for p in PATTERNS])
+    valid = windows & (position[:, None] >= offsets[None, :])
+    valid = valid.reshape(len(windows), -1)
+    selected = valid & (np.cumsum(valid, axis=1) <= KLINE_MAX_SIGNALS)
+
+    scores = np.tile([p['score'] for p in PATTERNS], KLINE_LOOKBACK_BARS)
+    buy[KLINE_LOOKBACK_BARS - 1:] = (selected * np.maximum(scores, 0)).sum(axis=1)
+    sell[KLINE_LOOKBACK_BARS - 1:] = (selected * np.maximum(-scores, 0)).sum(axis=1)
+    return buy, sell
+
+def compute_score_series(kline_df, buy_threshold=8, sell_threshold=5, timeline=None):
+    """
+    計算每個歷史日期的技術面綜合分數（generate_comprehensive_conclusion_with_patterns 的技術面部分）
+
+    以向量化的指標、K線型態遮罩與滑動窗口趨勢型態一次算出整段序列，不逐日呼叫分析函數。
+    基本面沒有歷史資料，不列入分數。暖身不足（前 FIRST_SCORED_BAR 根）的日期不列入結果。
+    timeline: kline_df 整段的型態時間軸（例如資料庫中保存的），None 時即時掃描
+
+    返回以日期為索引的 DataFrame：BuyScore、SellScore、Conclusion，以及各訊號的布林欄位。
+    """
+    frame = add_indicators(kline_df)
+    close = frame['Close'].to_numpy(dtype=float)
+    high = frame['High'].to_numpy(dtype=float)
+    low = frame['Low'].to_numpy(dtype=float)
+    sma20, sma60 = frame['SMA_20'].to_numpy(dtype=float), frame['SMA_60'].to_numpy(dtype=float)
+    macd, signal = frame['MACD_12_26_9'].to_numpy(dtype=float), frame['MACDs_12_26_9'].to_numpy(dtype=float)
+    stoch_k = frame['STOCHk_14_3_3'].to_numpy(dtype=float)
+
+    # 技術指標評分（與結論函數相同，NaN 的比較視為不成立）
+    signals = {
+        '中期趨勢向上': sma20 > sma60,
+        '股價位於短期均線之上': close > sma20,
+        'MACD 指標看漲': macd > signal,
+        'KD 指標進入超賣區': stoch_k < 20,
+        'KD 指標進入超買區': stoch_k > 80,
+    }
+    buy = (np.where(signals['中期趨勢向上'], 2, 0) + np.where(signals['股價位於短期均線之上'], 1, 0) +
+           np.where(signals['MACD 指標看漲'], 1.5, 0) + np.where(signals['KD 指標進入超賣區'], 2, 0))
+    sell = (np.where(signals['中期趨勢向上'], 0, 2) + np.where(signals['股價位於短期均線之上'], 0, 1) +
+            np.where(signals['MACD 指標看漲'], 0, 1.5) +
+            np.where(~signals['KD 指標進入超賣區'] & signals['KD 指標進入超買區'], 2, 0))
+
+    # K線型態：訊號欄位為該日出現的型態，分數為 analyze_kline 最近訊號的加總
+    pattern_masks = _evaluate_patterns(frame['Open'].to_numpy(dtype=float), high, low, close,
+                                       frame['Volume'].to_numpy(dtype=float))
+    signals.update({p['name']: mask for p, mask in zip(PATTERNS, pattern_masks)})
+    kline_buy, kline_sell = _kline_signal_scores(pattern_masks)
+    buy, sell = buy + kline_buy, sell + kline_sell
+
+    # 趨勢型態
+    if timeline is None:
+        timeline = scan_pattern_timeline(frame)
+    pattern_scores = _trend_pattern_scores(frame, timeline)
+    pattern_scores.update(_cross_scores(frame))
+    for name, score in pattern_scores.items():
+        signals[name] = score != 0
+        buy, sell = buy + np.maximum(score, 0), sell + np.maximum(-score, 0)
+
+    conclusion = np.where((buy > sell) & (buy >= buy_threshold), 'conclusion-buy',
+                          np.where((sell > buy) & (sell >= sell_threshold), 'conclusion-sell', 'conclusion-hold'))
+    result = pd.DataFrame({'BuyScore': buy, 'SellScore': sell, 'Conclusion': conclusion}, index=frame.index)
+    result = pd.concat([result, pd.DataFrame(signals, index=frame.index)], axis=1)
+    return result.iloc[FIRST_SCORED_BAR:]
+
+def forward_returns(close, horizons):
+    """每個日期往後 h 根K線的報酬率（資料不足為 NaN），返回 {h: 陣列}"""
+    close = np.asarray(close, dtype=float)
+    returns = {}
+    for h in horizons:
+        future = np.full(len(close), np.nan)
+        future[:len(close) - h] = close[h:]
+        returns[h] = future / close - 1
+    return returns
+
+def _summarize(groups, returns, horizons):
+    """將單一股票各組日期 {(類別, 名稱): 布林遮罩} 彙總為可跨股票相加的統計（出現次數、報酬總和、上漲次數）"""
+    rows = {}
+    for key, mask in groups.items():
+        row = {'Days': int(mask.sum())}
+        for h in horizons:
+            r = returns[h][mask]
+            r = r[~np.isnan(r)]
+            row[f'N_{h}'] = len(r)
+            row[f'Sum_{h}'] = float(r.sum())
+            row[f'Wins_{h}'] = int((r > 0).sum())
+        rows[key] = row
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def _score_groups(scores):
+    """分數序列中各結論類別與各訊號出現的日期"""
+    groups = {('conclusion', name): (scores['Conclusion'] == name).to_numpy()
+              for name in ('conclusion-buy', 'conclusion-sell', 'conclusion-hold')}
+    groups.update({('signal', name): scores[name].to_numpy(dtype=bool)
+                   for name in scores.columns if name not in ('BuyScore', 'SellScore', 'Conclusion')})
+    return groups
+
+def _pattern_event_groups(timeline, index):
+    """
+    型態時間軸中每個型態出現的日期（每一列一次）：滑動窗口型態為第一個符合窗口的結束K線，
+    其他型態為結束日期再往後 TIMELINE_CONFIRM_BARS 根（型態可以確認的K線）；超出資料範圍的型態不列入
+    """
+    first, _ = _window_run_bars(timeline, index)
+    end = index.get_indexer(timeline['End'])
+    bars = np.where(end >= 0, end + timeline['Pattern'].map(TIMELINE_CONFIRM_BARS).fillna(0).to_numpy(dtype=int), -1)
+    windowed = timeline['Pattern'].isin(TIMELINE_WINDOWS).to_numpy()
+    bars = np.where(windowed, first, bars)
+    valid = (bars >= 0) & (bars < len(index))
+    groups = {}
+    for name in dict.fromkeys(timeline['Pattern']):
+        mask = np.zeros(len(index), dtype=bool)
+        mask[bars[valid & (timeline['Pattern'] == name).to_numpy()]] = True
+        groups[('pattern', name)] = mask
+    return groups
+
+def _stored_timeline(ticker, kline_df):
+    """資料庫中涵蓋 kline_df 最後一根K線的型態時間軸，尚未更新時為 None"""
+    import database
+    covered = database.get_pattern_timeline_date(ticker)
+    if covered is None or pd.Timestamp(covered) != kline_df.index[-1]:
+        return None
+    return database.get_pattern_timeline(ticker)
+
+def backtest_ticker(ticker, horizons, buy_threshold=8, sell_threshold=5, db_file=None):
+    """
+    回測單一股票：從資料庫讀取K線、預先計算的指標與型態時間軸（尚未更新時即時掃描），
+    返回 _summarize 的彙總（資料不足時為 None）
+
+    除了每日的結論與訊號，另以時間軸中每個型態出現後的報酬統計為 ('pattern', 型態名稱)，涵蓋完整歷史。
+    """
+    import database
+    if db_file is not None:
+        database.DB_FILE = db_file
+
+    kline_df = database.get_kline(ticker, with_indicators=True)
+    if len(kline_df) <= FIRST_SCORED_BAR:
+        return None
+    timeline = _stored_timeline(ticker, kline_df)
+    if timeline is None:
+        timeline = scan_pattern_timeline(kline_df)
+    scores = compute_score_series(kline_df, buy_threshold, sell_threshold, timeline)
+    returns = forward_returns(kline_df['Close'].to_numpy(), horizons)
+    summary = _summarize(_score_groups(scores), {h: r[FIRST_SCORED_BAR:] for h, r in returns.items()}, horizons)
+    events = _summarize(_pattern_event_groups(timeline, kline_df.index), returns, horizons)
+    return pd.concat([summary, events]) if not events.empty else summary
+
+def _backtest_chunk(tickers, horizons, buy_threshold, sell_threshold, db_file):
+    results = []
+    for ticker in tickers:
+        try:
+            summary = backtest_ticker(ticker, horizons, buy_threshold, sell_threshold, db_file)
+            if summary is not None:
+                results.append(summary)
+        except Exception as e:
+            logger.error(f"Backtest failed for {ticker}: {str(e)}")
+    return results
+
+def run_backtest(tickers=None, horizons=None, processes=None, buy_threshold=8, sell_threshold=5):
+    """
+    以多個行程回測所有股票的綜合分數，返回各訊號與各結論類別的未來報酬統計
+
+    參數:
+    - tickers: 股票代號清單（預設 config.TICKERS）
+    - horizons: 未來報酬的K線數（預設 config.BACKTEST_HORIZONS）
+    - processes: 行程數（預設 config.BACKTEST_PROCESSES，None 為 CPU 核心數）
+    - buy_threshold / sell_threshold: 結論的買進／賣出分數門檻（預設與 generate_comprehensive_conclusion_with_patterns 相同）
+
+    返回以 (類別, 名稱) 為索引的 DataFrame：類別為 conclusion / signal（每日的結論與訊號）或 pattern（型態時間軸中的型態），
+    Days 為出現天數，MeanReturn_h / WinRate_h 為 h 根K線後的平均報酬與上漲比例。
+    """
+    from config import TICKERS, BACKTEST_HORIZONS, BACKTEST_PROCESSES
+    import database
+
+    tickers = list(dict.fromkeys(tickers if tickers is not None else TICKERS.values()))
+    horizons = tuple(horizons or BACKTEST_HORIZONS)
+    processes = processes or BACKTEST_PROCESSES or os.cpu_count() or 1
+    start = time.perf_counter()
+
+    # 每個行程處理一段股票；以 spawn 啟動，避免子行程沿用父行程的 SQLite 連線
+    chunk_size = max(1, len(tickers) // (processes * 4))
+    chunks = [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+    summaries = []
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(_backtest_chunk, chunk, horizons, buy_threshold, sell_threshold,
+                                   database.DB_FILE) for chunk in chunks]
+            for future in futures:
+                summaries.extend(future.result())
+    else:
+        for chunk in chunks:
+            summaries.extend(_backtest_chunk(chunk, horizons, buy_threshold, sell_threshold, None))
+
+    if not summaries:
+        return pd.DataFrame()
+    totals = pd.concat(summaries).groupby(level=[0, 1], sort=False).sum()
+    stats = totals[['Days']].copy()
+    for h in horizons:
+        n = totals[f'N_{h}'].replace(0, np.nan)
+        stats[f'MeanReturn_{h}'] = totals[f'Sum_{h}'] / n
+        stats[f'WinRate_{h}'] = totals[f'Wins_{h}'] / n
+    logger.info(f"Backtested {len(summaries)}/{len(tickers)} tickers in {time.perf_counter() - start:.1f}s "
+                f"with {processes} processes")
+    return stats
+
+def main():
+    """回測 config.TICKERS 並輸出統計"""
+    pd.set_option('display.width', 200)
+    print(run_backtest())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+from analysis_context import get_context
+
+# 掃描結果（稀疏訊號表）的欄位；Bar 為該K線在序列中的位置
+SIGNAL_COLUMNS = ['Date', 'Bar', 'Pattern', 'Type', 'Recommendation', 'Score']
+
+RECOMMENDATIONS = {'bullish': '買進訊號', 'bearish': '賣出訊號'}
+
+class PatternTerms:
+    """
+    型態條件使用的K線陣列與衍生項
+
+    每一項都以 (名稱, 往前幾根) 計算一次後快取，所有型態共用；
+    t.close(1) 表示前一根的收盤價，前面不足的位置為 NaN（與 NaN 比較的結果皆為 False）。
+    """
+
+    def __init__(self, o, h, l, c, v):
+        self._base = {'open': o, 'high': h, 'low': l, 'close': c, 'volume': v}
+        self._cache = {}
+
+    def _term(self, name, shift, compute):
+        key = (name, shift)
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def _shifted(self, name, shift):
+        def compute():
+            values = self._base[name]
+            shifted = np.full(len(values), np.nan)
+            if shift < len(values):
+                shifted[shift:] = values[:len(values) - shift]
+            return shifted
+        return self._term(name, shift, compute) if shift else self._base[name]
+
+    def open(self, shift=0):
+        return self._shifted('open', shift)
+
+    def high(self, shift=0):
+        return self._shifted('high', shift)
+
+    def low(self, shift=0):
+        return self._shifted('low', shift)
+
+    def close(self, shift=0):
+        return self._shifted('close', shift)
+
+    def volume(self, shift=0):
+        return self._shifted('volume', shift)
+
+    def body(self, shift=0):
+        """實體大小 |收盤 - 開盤|"""
+        return self._term('body', shift, lambda: np.abs(self.close(shift) - self.open(shift)))
+
+    def range(self, shift=0):
+        """K線全長 最高 - 最低"""
+        return self._term('range', shift, lambda: self.high(shift) - self.low(shift))
+
+    def bullish(self, shift=0):
+        """紅K（收盤 > 開盤）"""
+        return self._term('bullish', shift, lambda: self.close(shift) > self.open(shift))
+
+    def bearish(self, shift=0):
+        """黑K（收盤 < 開盤）"""
+        return self._term('bearish', shift, lambda: self.close(shift) < self.open(shift))
+
+def pattern(name, direction, score, lookback, condition, type='K-Line', report_offset=0):
+    """
+    宣告一個K線型態
+
+    參數:
+    - name: 型態名稱
+    - direction: 'bullish' 或 'bearish'，決定建議的買進／賣出訊號
+    - score: 綜合評分時的分數
+    - lookback: 判斷時使用的K線數（含當根），序列開頭不足的K線不會符合
+    - condition: 接收 PatternTerms、返回布林陣列的函數
+    - type: 訊號類型（'K-Line' 或 'Breakout'）
+    - report_offset: analyze_kline 只從分析範圍的第 report_offset + 1 根開始回報此型態
+    """
+    return {
+        'name': name, 'direction': direction, 'score': score, 'lookback': lookback,
+        'condition': condition, 'type': type, 'report_offset': report_offset,
+    }
+
+PATTERNS = [
+    # Bullish Patterns (+1 score)
+    pattern('看漲吞噬', 'bullish', 1, 2,
+            lambda t: t.bearish(1) & t.bullish() & (t.close() > t.open(1)) & (t.open() < t.close(1))),
+    pattern('刺透線', 'bullish', 1, 2,
+            lambda t: t.bearish(1) & t.bullish() & (t.open() < t.close(1)) &
+                      (t.close() > (t.open(1) + t.close(1)) / 2) & (t.close() < t.open(1))),
+    pattern('早晨之星', 'bullish', 1, 3,
+            lambda t: t.bearish(2) & (t.body(1) < t.body(2) * 0.5) & t.bullish() & (t.close() > t.open(2))),
+    pattern('紅三兵', 'bullish', 1, 3,
+            lambda t: t.bullish(2) & t.bullish(1) & t.bullish() & (t.close(2) > t.open(2) * 1.01) &
+                      (t.close(1) > t.open(1) * 1.01) & (t.close() > t.open() * 1.01)),
+    pattern('上升三法', 'bullish', 1, 5,
+            lambda t: t.bullish(4) & t.bearish(3) & t.bearish(2) & t.bearish(1) & t.bullish() &
+                      (t.close() > t.close(4)),
+            report_offset=2),
+    pattern('三內升勢', 'bullish', 1, 3,
+            lambda t: t.bearish(2) & t.bullish(1) & (t.open(1) > t.close(2)) & (t.close(1) < t.open(2)) &
+                      t.bullish() & (t.close() > t.open(2))),
+    pattern('夾陽線', 'bullish', 1, 2,
+            lambda t: t.bearish(1) & t.bullish() & (t.open() > t.close(1)) & (t.close() < t.open(1))),
+    pattern('三空白', 'bullish', 1, 3,
+            lambda t: t.bullish(2) & t.bullish(1) & (t.open(1) > t.close(2)) & t.bullish() &
+                      (t.open() > t.close(1))),
+    # Bearish Patterns (-1 score)
+    pattern('看跌吞噬', 'bearish', -1, 2,
+            lambda t: t.bullish(1) & t.bearish() & (t.close() < t.open(1)) & (t.open() > t.close(1))),
+    pattern('烏雲蓋頂', 'bearish', -1, 2,
+            lambda t: t.bullish(1) & t.bearish() & (t.open() > t.close(1)) &
+                      (t.close() < (t.open(1) + t.close(1)) / 2) & (t.close() > t.open(1))),
+    pattern('黃昏之星', 'bearish', -1, 3,
+            lambda t: t.bullish(2) & (t.body(1) < t.body(2) * 0.5) & t.bearish() & (t.close() < t.open(2))),
+    pattern('黑三鴉', 'bearish', -1, 3,
+            lambda t: t.bearish(2) & t.bearish(1) & t.bearish() & (t.close(2) < t.open(2) * 0.99) &
+                      (t.close(1) < t.open(1) * 0.99) & (t.close() < t.open() * 0.99)),
+    pattern('下降三法', 'bearish', -1, 5,
+            lambda t: t.bearish(4) & t.bullish(3) & t.bullish(2) & t.bullish(1) & t.bearish() &
+                      (t.close() < t.close(4)),
+            report_offset=2),
+    pattern('三內下降勢', 'bearish', -1, 3,
+            lambda t: t.bullish(2) & t.bearish(1) & (t.open(1) < t.close(2)) & (t.close(1) > t.open(2)) &
+                      t.bearish() & (t.close() < t.open(2))),
+    pattern('夾陰線', 'bearish', -1, 2,
+            lambda t: t.bullish(1) & t.bearish() & (t.open() < t.close(1)) & (t.close() > t.open(1))),
+    pattern('三空黑', 'bearish', -1, 3,
+            lambda t: t.bearish(2) & t.bearish(1) & (t.open(1) < t.close(2)) & t.bearish() &
+                      (t.open() < t.close(1))),
+    # Price Breakout：收盤突破前兩根的最高價且量增
+    pattern('價格突破前高', 'bullish', 1, 3,
+            lambda t: (t.close() > np.fmax(t.high(1), t.high(2))) & (t.volume() > t.volume(1)),
+            type='Breakout'),
+]
+
+def compile_patterns(patterns):
+    """
+    將型態宣告編譯為單一評估函數
+
+    返回 evaluate(o, h, l, c, v)：以共用的 PatternTerms 依序計算每個型態，
+    返回與 patterns 同順序的布林陣列列表（已排除序列開頭 K 線數不足 lookback 的位置）。
+    """
+    conditions = [(p['condition'], p['lookback']) for p in patterns]
+
+    def evaluate(o, h, l, c, v):
+        terms = PatternTerms(o, h, l, c, v)
+        bars = np.arange(len(c))
+        return [condition(terms) & (bars >= lookback - 1) for condition, lookback in conditions]
+
+    return evaluate
+
+_evaluate = compile_patterns(PATTERNS)
+_pattern_table = pd.DataFrame({
+    'Pattern': [p['name'] for p in PATTERNS],
+    'Type': [p['type'] for p in PATTERNS],
+    'Recommendation': [RECOMMENDATIONS[p['direction']] for p in PATTERNS],
+    'Score': [p['score'] for p in PATTERNS],
+})
+# 各型態在 analyze_kline 中的回報起點偏移
+REPORT_OFFSET = {p['name']: p['report_offset'] for p in PATTERNS if p['report_offset']}
+
+def _scan(ctx):
+    masks = _evaluate(ctx.open, ctx.high, ctx.low, ctx.close, ctx.volume)
+    bars = [np.flatnonzero(mask) for mask in masks]
+    order = np.concatenate([np.full(len(b), k) for k, b in enumerate(bars)]).astype(int)
+    bars = np.concatenate(bars).astype(int)
+    # 依K線位置排序，同一根K線內保留型態的宣告順序
+    sort = np.lexsort((order, bars))
+    bars, order = bars[sort], order[sort]
+
+    table = _pattern_table.iloc[order].reset_index(drop=True)
+    table.insert(0, 'Bar', bars)
+    table.insert(0, 'Date', ctx.kline_df.index[bars])
+    return table[SIGNAL_COLUMNS]
+
+def scan_candlestick_patterns(data):
+    """
+    掃描整段K線的所有K線型態，返回稀疏訊號表（每個符合的型態一列，同一根K線可有多列，欄位見 SIGNAL_COLUMNS）
+
+    data 可以是 K 線 DataFrame 或 AnalysisContext（同一 context 內只掃描一次）。
+    """
+    ctx = get_context(data)
+    return ctx.memoize('candlestick_patterns', lambda: _scan(ctx))
@@ -7,3 +7,40 @@ TICKERS = {
     '鴻海': '2317.TW',
     'WAD': '2317.TW',
 }
+
+# 資料抓取設定
+FETCH_PARALLEL = True    # 是否以多執行緒平行抓取
+FETCH_MAX_WORKERS = 8    # 平行抓取的最大執行緒數
+KLINE_INCREMENTAL = True # K線增量更新（只抓最新日期之後的資料）
+KLINE_OVERLAP_DAYS = 5   # 增量更新時往前重疊的天數，用於偵測歷史價格調整
+PRICE_BATCH_DOWNLOAD = True  # 以批次請求下載多檔股票的K線
+PRICE_BATCH_SIZE = 50        # 每批次下載的股票數
+TRANSFORM_WORKERS = 2        # 轉換階段的執行緒數
+WRITER_BATCH_TICKERS = 50    # 寫入階段每個交易最多包含的股票數
+WRITER_FLUSH_SECONDS = 2.0   # 寫入階段累積資料的最長等待秒數
+
+# 各資料集的有效時間（小時），未過期的資料集在抓取時會被略過
+DATASET_TTL_HOURS = {
+    'kline': 20,            # 每日更新
+    'info': 24 * 7,         # 每週更新
+    'financials': 24 * 90,  # 每季更新（財報公布後也會提前更新）
+}
+FINANCIALS_EARNINGS_LAG_DAYS = 3  # 財報公布日後幾天視為財報資料已可取得
+
+# 對外請求的限速與重試設定
+RATE_LIMIT_PER_SECOND = 2.0  # 所有執行緒共用的平均請求速率
+RATE_LIMIT_BURST = 5         # 允許的瞬間突發請求數
+RETRY_MAX_ATTEMPTS = 4       # 每個請求的最大嘗試次數
+RETRY_BASE_DELAY = 1.0       # 指數退避的基準秒數
+RETRY_MAX_DELAY = 60.0       # 單次退避的最長秒數
+
+# 資料來源：'yahoo'（線上）、'record'（線上並錄製到磁碟）、'recorded'（重播錄製資料）、'synthetic'（合成資料）
+DATA_PROVIDER = 'yahoo'
+RECORDED_DATA_DIR = 'recorded_data'  # 相對路徑以程式（打包後為執行檔）所在目錄為準
+
+# 抓取後為每檔股票寫入K線快照（.npy），讀取時以 memory-map 取代 SQL 查詢
+KLINE_SNAPSHOTS = True
+
+# 回測（backtest.py）設定
+BACKTEST_HORIZONS = (5, 20, 60)  # 統計未來報酬的K線數
+BACKTEST_PROCESSES = None        # 平行回測的行程數，None 表示使用 CPU 核心數
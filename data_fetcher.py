@@ -1,9 +1,21 @@
-import yfinance as yf
 import pandas as pd
 import sqlite3
 from datetime import datetime
 import logging
-from database import init_db, save_data, get_db_connection
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limit import stats as fetch_stats
+from data_providers import get_provider
+from database import (init_db, save_data, get_db_connection, get_last_kline_date, get_stored_closes,
+                      write_ticker_data, write_kline_snapshot, get_dataset_freshness, get_kline,
+                      get_stale_indicator_tickers, get_indicator_state, get_stale_timeline_tickers,
+                      get_pattern_timeline_date, KLINE_COLUMNS, KLINE_ACTION_COLUMNS, FINANCIALS_COLUMNS,
+                      INDICATOR_COLUMNS, DATASETS)
+from indicators import compute_indicators, stream_indicators, IndicatorState, INDICATOR_WARMUP_BARS
+from trend_pattern_analysis import (scan_pattern_timeline, timeline_history_sufficient, TIMELINE_EXTREMA_ORDER,
+                                    TIMELINE_WARMUP_BARS)
 import os
 import sys
 
@@ -22,143 +34,697 @@ DB_FILE = os.path.join(application_path, 'stock_data.db')
 log_file = os.path.join(application_path, 'data_fetcher.log')
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
     filename=log_file
 )
 logger = logging.getLogger(__name__)
 
-def fetch_and_store_all_data():
-    """抓取所有公司的資料並儲存到資料庫"""
-    # 動態載入 TICKERS
-    from config import TICKERS
+# 抓取階段的唯讀連線由多個執行緒共用，以此鎖序列化存取
+_db_lock = threading.Lock()
+
+def _clean_kline(raw_df, ticker):
+    """
+    將 yfinance history 的結果整理為 kline_daily 的欄位格式
+    若有分割／股利欄位則一併保留，供歷史調整偵測使用
+    """
+    kline_df = raw_df.reset_index()
+    kline_df['Ticker'] = ticker
+    kline_df['Date'] = kline_df['Date'].dt.strftime('%Y-%m-%d')
+    columns = KLINE_COLUMNS + [c for c in KLINE_ACTION_COLUMNS if c in kline_df.columns]
+    kline_df = kline_df[columns]
+    return kline_df.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'])
+
+def _history_was_adjusted(kline_df, stored_df, last_date, tolerance=1e-4):
+    """
+    判斷新抓取的K線是否顯示歷史價格已被調整（分割或除權息）
     
-    logger.info("Starting data fetch process for all tickers...")
-    conn = get_db_connection()
+    - 資料庫最新日期之後出現分割或股利事件
+    - 資料庫最新日期之前的重疊日期，收盤價與資料庫中的值不一致
+    
+    資料庫最新的一根可能是盤中抓取的未完成K線或之後被更正，只有它變動時不視為歷史調整，由寫入時直接覆蓋。
+    """
+    new_bars = kline_df['Date'] > last_date
+    for column in KLINE_ACTION_COLUMNS:
+        if column in kline_df.columns and (kline_df.loc[new_bars, column].fillna(0) != 0).any():
+            return True
+    
+    if stored_df.empty:
+        return False
+    
+    new_close = kline_df.set_index('Date')['Close']
+    stored_close = stored_df.set_index('Date')['Close']
+    common = stored_close.index.intersection(new_close.index)
+    common = common[common < last_date]
+    if common.empty:
+        return False
+    diff = (new_close[common] - stored_close[common]).abs() / stored_close[common].abs()
+    return bool((diff > tolerance).any())
+
+def _read_stored_closes(conn, tickers, start):
+    """讀取多檔股票自 start 起已儲存的收盤價，用於比對歷史調整"""
+    with _db_lock:
+        return get_stored_closes(tickers, start, conn)
+
+def fetch_kline(provider, ticker, conn):
+    """
+    抓取單一公司的日K線資料
+    
+    若資料庫已有該股票的K線且啟用增量模式，只請求最新日期之後（含少量重疊）的K線；
+    偵測到分割或除權息造成歷史價格變動時，改為重新抓取完整5年資料。
+    返回: (kline_df, full_reload)，無可用資料時 kline_df 為 None
+    """
+    from config import KLINE_INCREMENTAL, KLINE_OVERLAP_DAYS
+    
+    last_date = None
+    if KLINE_INCREMENTAL:
+        with _db_lock:
+            last_date = get_last_kline_date(ticker, conn)
+    
+    if last_date is not None:
+        start = (pd.Timestamp(last_date) - pd.Timedelta(days=KLINE_OVERLAP_DAYS)).strftime('%Y-%m-%d')
+        raw_df = provider.history(ticker, start=start)
+        if raw_df.empty:
+            logger.info(f"No new K-line bars for {ticker} since {last_date}")
+            return pd.DataFrame(columns=KLINE_COLUMNS), False
+        
+        kline_df = _clean_kline(raw_df, ticker)
+        stored_df = _read_stored_closes(conn, [ticker], start)
+        if not _history_was_adjusted(kline_df, stored_df, last_date):
+            return kline_df, False
+        logger.info(f"Detected split/adjustment for {ticker}, falling back to full reload")
+    
+    raw_df = provider.history(ticker, period="5y")
+    if raw_df.empty:
+        logger.warning(f"No K-line data available for {ticker}")
+        return None, True
+    
+    kline_df = _clean_kline(raw_df, ticker)
+    if kline_df.empty:
+        logger.warning(f"Cleaned K-line data for {ticker} is empty after dropping NaN")
+        return None, True
+    return kline_df, True
+
+def _download_chunk(provider, symbols, **history_kwargs):
+    """
+    以單一請求下載多檔股票的K線，並將寬格式 (Price, Ticker) 欄位轉為 kline_daily 的長格式
+    返回: (kline_df, failed_symbols)
+    """
+    raw = provider.download(symbols, **history_kwargs)
+    if raw is None or raw.empty:
+        return pd.DataFrame(columns=KLINE_COLUMNS), list(symbols)
+    
+    if not isinstance(raw.columns, pd.MultiIndex):
+        # 只有一檔股票時部分版本回傳單層欄位
+        raw.columns = pd.MultiIndex.from_product([raw.columns, symbols], names=['Price', 'Ticker'])
+    raw.columns.names = ['Price', 'Ticker']
+    raw.index.name = 'Date'
+    
+    kline_df = raw.stack(level='Ticker').reset_index()
+    kline_df.columns.name = None
+    kline_df['Date'] = kline_df['Date'].dt.strftime('%Y-%m-%d')
+    kline_df = kline_df.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'])
+    columns = KLINE_COLUMNS + [c for c in KLINE_ACTION_COLUMNS if c in kline_df.columns]
+    kline_df = kline_df[columns]
+    
+    failed = sorted(set(symbols) - set(kline_df['Ticker'].unique()))
+    return kline_df, failed
+
+def _download_with_split_retry(provider, symbols, **history_kwargs):
+    """
+    下載一組股票，失敗時將失敗的股票對半切分後重試，直到單一股票為止
+    返回: (kline_df, failed_symbols)
+    """
+    try:
+        kline_df, failed = _download_chunk(provider, symbols, **history_kwargs)
+    except Exception as e:
+        logger.warning(f"Batch download failed for {len(symbols)} symbols: {str(e)}")
+        kline_df, failed = pd.DataFrame(columns=KLINE_COLUMNS), list(symbols)
+    
+    if not failed or len(symbols) == 1:
+        return kline_df, failed
+    
+    logger.info(f"Retrying {len(failed)} failed symbols out of {len(symbols)} in smaller chunks")
+    frames = [kline_df]
+    still_failed = []
+    mid = (len(failed) + 1) // 2
+    for part in (failed[:mid], failed[mid:]):
+        if not part:
+            continue
+        part_df, part_failed = _download_with_split_retry(provider, part, **history_kwargs)
+        frames.append(part_df)
+        still_failed.extend(part_failed)
+    return pd.concat(frames, ignore_index=True), still_failed
+
+def _download_batched(provider, symbols, batch_size, **history_kwargs):
+    """依 batch_size 分批下載，返回 (kline_df, failed_symbols)"""
+    frames, failed = [], []
+    for i in range(0, len(symbols), batch_size):
+        chunk_df, chunk_failed = _download_with_split_retry(provider, symbols[i:i + batch_size], **history_kwargs)
+        frames.append(chunk_df)
+        failed.extend(chunk_failed)
+    kline_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=KLINE_COLUMNS)
+    return kline_df, failed
+
+def fetch_klines_batched(provider, tickers, conn, batch_size=None):
+    """
+    以批次請求抓取多檔股票的日K線
+    
+    - 資料庫已有資料的股票以增量方式下載（同一批次使用最早的起始日期）
+    - 沒有資料或偵測到歷史調整的股票以批次方式重新下載完整5年資料
+    - 重試後仍失敗的股票不會出現在結果中，由逐檔抓取流程處理
+    返回: {ticker: (kline_df, full_reload)}
+    """
+    from config import KLINE_INCREMENTAL, KLINE_OVERLAP_DAYS, PRICE_BATCH_SIZE
     
-    for name, ticker in TICKERS.items():
-        logger.info(f"Fetching data for {name} ({ticker})...")
+    batch_size = max(1, batch_size or PRICE_BATCH_SIZE)
+    tickers = list(dict.fromkeys(tickers))
+    results = {}
+    
+    last_dates = {}
+    if KLINE_INCREMENTAL:
+        with _db_lock:
+            for ticker in tickers:
+                last_date = get_last_kline_date(ticker, conn)
+                if last_date is not None:
+                    last_dates[ticker] = last_date
+    
+    full_tickers = [t for t in tickers if t not in last_dates]
+    incremental_tickers = [t for t in tickers if t in last_dates]
+    
+    if incremental_tickers:
+        starts = pd.Series({
+            t: (pd.Timestamp(d) - pd.Timedelta(days=KLINE_OVERLAP_DAYS)).strftime('%Y-%m-%d')
+            for t, d in last_dates.items()
+        })
+        kline_df, failed = _download_batched(provider, incremental_tickers, batch_size, start=starts.min())
+        # 同批次以最早起始日下載，各股票只保留自己的重疊區間之後的K線
+        kline_df = kline_df[kline_df['Date'] >= kline_df['Ticker'].map(starts)]
+        stored_df = _read_stored_closes(conn, incremental_tickers, starts.min())
+        stored_groups = dict(tuple(stored_df.groupby('Ticker')))
+        
+        for ticker, ticker_df in kline_df.groupby('Ticker'):
+            ticker_stored = stored_groups.get(ticker, stored_df.iloc[0:0])
+            if _history_was_adjusted(ticker_df, ticker_stored, last_dates[ticker]):
+                logger.info(f"Detected split/adjustment for {ticker}, falling back to full reload")
+                full_tickers.append(ticker)
+            else:
+                results[ticker] = (ticker_df.reset_index(drop=True), False)
+        if failed:
+            logger.warning(f"Batched incremental download failed for: {', '.join(failed)}")
+    
+    if full_tickers:
+        kline_df, failed = _download_batched(provider, full_tickers, batch_size, period="5y")
+        for ticker, ticker_df in kline_df.groupby('Ticker'):
+            results[ticker] = (ticker_df.reset_index(drop=True), True)
+        if failed:
+            logger.warning(f"Batched full download failed for: {', '.join(failed)}")
+    
+    logger.info(f"Batched K-line download returned data for {len(results)}/{len(tickers)} tickers")
+    return results
+
+def get_stale_datasets(tickers, conn, force=False):
+    """
+    依 config.DATASET_TTL_HOURS 判斷每檔股票需要重新抓取的資料集
+    
+    - 從未抓取過或超過 TTL 的資料集視為過期
+    - 財報另外在財報公布日（加上 FINANCIALS_EARNINGS_LAG_DAYS）之後立即視為過期
+    - force=True 時忽略更新紀錄，全部重新抓取
+    返回: {ticker: set(需要抓取的資料集)}
+    """
+    from config import DATASET_TTL_HOURS, FINANCIALS_EARNINGS_LAG_DAYS
+    
+    if force:
+        return {ticker: set(DATASETS) for ticker in tickers}
+    
+    with _db_lock:
+        freshness = get_dataset_freshness(conn)
+    last_refreshed = {
+        (row.Ticker, row.Dataset): pd.Timestamp(row.LastRefreshed)
+        for row in freshness.itertuples(index=False)
+    }
+    earnings_dates = {
+        row.Ticker: pd.Timestamp(row.EarningsDate)
+        for row in freshness.itertuples(index=False) if pd.notnull(row.EarningsDate)
+    }
+    
+    now = pd.Timestamp.now()
+    stale = {}
+    for ticker in tickers:
+        datasets = set()
+        for dataset in DATASETS:
+            refreshed = last_refreshed.get((ticker, dataset))
+            if refreshed is None or now - refreshed >= pd.Timedelta(hours=DATASET_TTL_HOURS[dataset]):
+                datasets.add(dataset)
         
+        refreshed = last_refreshed.get((ticker, 'financials'))
+        if 'financials' not in datasets and ticker in earnings_dates:
+            available = earnings_dates[ticker] + pd.Timedelta(days=FINANCIALS_EARNINGS_LAG_DAYS)
+            if refreshed < available <= now:
+                datasets.add('financials')
+        stale[ticker] = datasets
+    return stale
+
+def fetch_ticker_data(provider, name, ticker, conn, datasets=None, prefetched_kline=None):
+    """
+    抓取階段：從資料來源下載單一公司的K線、基本資訊與財報
+    
+    各資料集各自處理錯誤，某一項失敗不影響其他項目。
+    datasets: 需要抓取的資料集（預設全部），其餘資料集視為仍在有效期內而略過
+    prefetched_kline: 批次下載取得的 (kline_df, full_reload)，為 None 時逐檔抓取K線
+    返回: 原始資料 dict，失敗或略過的資料集為 None
+    """
+    datasets = set(DATASETS) if datasets is None else datasets
+    logger.info(f"Fetching data for {name} ({ticker}): {', '.join(sorted(datasets))}...")
+    raw = {'name': name, 'ticker': ticker, 'kline': None, 'info': None, 'financials': None}
+    
+    # 1. 獲取日 K 線資料（增量模式只抓最新日期之後的K線）
+    if 'kline' in datasets:
         try:
-            stock = yf.Ticker(ticker)
-            
-            # 1. 獲取日 K 線資料 (近5年)
-            kline_df = stock.history(period="5y", auto_adjust=True, timeout=60)
-            if kline_df.empty:
-                logger.warning(f"No K-line data available for {ticker}")
-                continue
-            
-            kline_df.reset_index(inplace=True)
-            kline_df = kline_df.rename(columns={
-                'Date': 'Date',
-                'Open': 'Open',
-                'High': 'High',
-                'Low': 'Low',
-                'Close': 'Close',
-                'Volume': 'Volume'
-            })
-            kline_df['Ticker'] = ticker
-            kline_df['Date'] = kline_df['Date'].dt.strftime('%Y-%m-%d')
-            kline_df = kline_df[['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume']]
-            kline_df = kline_df.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'])
-            
-            if kline_df.empty:
-                logger.warning(f"Cleaned K-line data for {ticker} is empty after dropping NaN")
-                continue
-            
-            # 先刪除舊資料
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM kline_daily WHERE Ticker = ?", (ticker,))
-            conn.commit()
-            
-            kline_df.to_sql('kline_daily', conn, if_exists='append', index=False, 
-                           dtype={'Ticker': 'TEXT', 'Date': 'TEXT', 'Open': 'REAL', 
-                                  'High': 'REAL', 'Low': 'REAL', 'Close': 'REAL', 
-                                  'Volume': 'INTEGER'})
-            logger.info(f"Successfully stored K-line data for {ticker} with {len(kline_df)} rows")
-
-            # 2. 獲取公司基本資訊 with retry
-            info = stock.info
-            logger.debug(f"Raw info for {ticker} from yfinance: {info}")
+            if prefetched_kline is not None:
+                kline_df, full_reload = prefetched_kline
+            else:
+                kline_df, full_reload = fetch_kline(provider, ticker, conn)
+            if kline_df is not None:
+                raw['kline'] = (kline_df, full_reload)
+        except Exception as e:
+            logger.error(f"Error fetching K-line data for {ticker}: {str(e)}")
+    
+    # 2. 獲取公司基本資訊 with retry
+    if 'info' in datasets:
+        try:
+            info = provider.info(ticker)
+            logger.debug(f"Raw info for {ticker} from provider: {info}")
             if not info or 'longName' not in info:
                 logger.warning(f"No valid info data for {ticker}, retrying...")
-                stock = yf.Ticker(ticker)
-                info = stock.info
-                if not info or 'longName' not in info:
-                    logger.error(f"Failed to fetch valid info data for {ticker} after retry")
-                    continue
-            
-            # 先刪除舊資料
-            cursor.execute("DELETE FROM info WHERE Ticker = ?", (ticker,))
-            conn.commit()
-            
-            info_df = pd.DataFrame([{
-                'Ticker': ticker,
-                'Name': info.get('longName', 'N/A'),
-                'Industry': info.get('industry', 'N/A'),
-                'MarketCap': info.get('marketCap', None),
-                'TrailingPE': info.get('trailingPE', info.get('forwardPE', None)),
-                'ForwardPE': info.get('forwardPE', None),
-                'TrailingEps': info.get('trailingEps', None)
-            }])
-            info_df.to_sql('info', conn, if_exists='append', index=False, 
-                          dtype={'Ticker': 'TEXT', 'Name': 'TEXT', 'Industry': 'TEXT', 
-                                 'MarketCap': 'REAL', 'TrailingPE': 'REAL', 
-                                 'ForwardPE': 'REAL', 'TrailingEps': 'REAL'})
-            logger.info(f"Successfully stored info data for {ticker}")
-
-            # 3. 獲取財務報表 (年度和季報，優先使用最新數據)
-            financials = stock.financials
-            quarterly = stock.quarterly_financials
-            
+                info = provider.info(ticker)
+            if info and 'longName' in info:
+                raw['info'] = info
+            else:
+                logger.error(f"Failed to fetch valid info data for {ticker} after retry")
+        except Exception as e:
+            logger.error(f"Error fetching info data for {ticker}: {str(e)}")
+    
+    # 3. 獲取財務報表 (年度和季報，優先使用最新數據)
+    if 'financials' in datasets:
+        try:
+            financials = provider.financials(ticker)
+            quarterly = provider.quarterly_financials(ticker)
             if financials.empty and quarterly.empty:
                 logger.warning(f"No financials data available for {ticker}")
-                continue
-            
-            # 合併並轉置財務報表
-            combined_financials = pd.concat([financials.T, quarterly.T], axis=0, keys=['Annual', 'Quarterly'])
-            # 重塑為長格式
-            combined_financials = combined_financials.reset_index()
-            combined_financials = combined_financials.melt(
-                id_vars=['level_0', 'level_1'],
-                value_name='Value',
-                var_name='Metric'
-            ).drop(columns=['level_0'])  # 移除 ReportType
-            combined_financials = combined_financials.rename(columns={'level_1': 'ReportDate'})
-            combined_financials['Ticker'] = ticker
-            # 處理 ReportDate，添加錯誤處理
-            combined_financials['ReportDate'] = combined_financials['ReportDate'].apply(
-                lambda x: pd.to_datetime(x, errors='coerce').strftime('%Y-%m-%d') if pd.notnull(x) else None
-            )
-            # 清理無效數據並去重
-            combined_financials = combined_financials.dropna(subset=['ReportDate', 'Value'])
-            combined_financials = combined_financials.drop_duplicates(
-                subset=['Ticker', 'ReportDate', 'Metric'], keep='last'
-            )
-            # 選擇必要的欄位
-            combined_financials = combined_financials[['Ticker', 'ReportDate', 'Metric', 'Value']]
-            
-            if combined_financials.empty:
-                logger.warning(f"Cleaned financials data for {ticker} is empty after dropping NaN")
-                continue
-            
-            # 寫入資料庫前，先刪除該 ticker 的舊資料
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM financials WHERE Ticker = ?", (ticker,))
-            conn.commit()
-
-            # 使用 'append' 將新資料加入
-            combined_financials.to_sql('financials', conn, if_exists='append', index=False, 
-                                     dtype={'Ticker': 'TEXT', 'ReportDate': 'TEXT', 
-                                            'Metric': 'TEXT', 'Value': 'REAL'})
-            
-            logger.info(f"Successfully stored financials data for {ticker} with {len(combined_financials)} rows")
+            else:
+                raw['financials'] = (financials, quarterly)
+        except Exception as e:
+            logger.error(f"Error fetching financials data for {ticker}: {str(e)}")
+    
+    return raw
+
+def _transform_financials(financials, quarterly, ticker):
+    """將年度與季度財報轉為 financials 資料表的長格式"""
+    # 合併並轉置財務報表
+    combined_financials = pd.concat([financials.T, quarterly.T], axis=0, keys=['Annual', 'Quarterly'])
+    # 重塑為長格式
+    combined_financials = combined_financials.reset_index()
+    combined_financials = combined_financials.melt(
+        id_vars=['level_0', 'level_1'],
+        value_name='Value',
+        var_name='Metric'
+    ).drop(columns=['level_0'])  # 移除 ReportType
+    combined_financials = combined_financials.rename(columns={'level_1': 'ReportDate'})
+    combined_financials['Ticker'] = ticker
+    # 處理 ReportDate，添加錯誤處理
+    combined_financials['ReportDate'] = combined_financials['ReportDate'].apply(
+        lambda x: pd.to_datetime(x, errors='coerce').strftime('%Y-%m-%d') if pd.notnull(x) else None
+    )
+    # 清理無效數據並去重
+    combined_financials = combined_financials.dropna(subset=['ReportDate', 'Value'])
+    combined_financials = combined_financials.drop_duplicates(
+        subset=['Ticker', 'ReportDate', 'Metric'], keep='last'
+    )
+    # 選擇必要的欄位
+    return combined_financials[FINANCIALS_COLUMNS]
+
+def _earnings_date(info):
+    """從 yfinance info 取得財報公布日（'%Y-%m-%d'），無資料時回傳 None"""
+    timestamp = info.get('earningsTimestamp') or info.get('earningsTimestampStart')
+    if not timestamp:
+        return None
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+def _resume_indicator_state(ticker, new_df):
+    """
+    取得可以直接接續新K線的串流狀態：狀態必須涵蓋資料庫中最新的K線，且重疊日期的K線與資料庫相同
+    返回 (IndicatorState, 狀態的最後日期)，無法接續時為 (None, None)
+    """
+    state_date, data = get_indicator_state(ticker)
+    if data is None:
+        return None, None
+    state_date = pd.Timestamp(state_date)
+    stored = get_kline(ticker, start=min(new_df.index.min(), state_date))[new_df.columns]
+    if stored.empty or stored.index.max() != state_date:
+        return None, None
+    overlap = new_df[new_df.index <= state_date].astype(float)
+    if not overlap.equals(stored.reindex(overlap.index).astype(float)):
+        return None, None
+    return IndicatorState.from_dict(data), state_date
+
+def _indicator_rows(ticker, indicators):
+    indicators = indicators.reset_index()
+    indicators['Ticker'] = ticker
+    indicators['Date'] = indicators['Date'].dt.strftime('%Y-%m-%d')
+    return indicators[['Ticker', 'Date'] + INDICATOR_COLUMNS]
+
+def _transform_indicators(ticker, kline_df=None, full_reload=False, rebuild=False):
+    """
+    計算需要寫入 indicators_daily 的技術指標列與更新後的串流狀態
+    
+    增量更新時從保存的 IndicatorState 接續，只對資料庫最新日期之後的K線逐根更新；
+    沒有狀態或無法接續（例如重疊日期的K線有變動）時，以 compute_indicators 計算新抓取的日期，
+    並在前面接上資料庫中最近 INDICATOR_WARMUP_BARS 根K線作為暖身；
+    完整重載或 rebuild（指標表尚未涵蓋此股票）時以完整歷史重新計算所有日期。
+    後兩種情況的狀態由最近 INDICATOR_WARMUP_BARS 根K線串流建立。
+    返回 (欄位為 Ticker, Date 與 INDICATOR_COLUMNS 的 DataFrame, (最後一根K線日期, 狀態 dict))，
+    沒有可計算的K線或（非 rebuild 時）沒有新K線時回傳 (None, None)。
+    """
+    ohlcv = ['Open', 'High', 'Low', 'Close', 'Volume']
+    if (kline_df is None or kline_df.empty) and not rebuild:
+        # 沒有新K線時不可用僅含暖身K線的歷史重算並覆寫已儲存的指標
+        return None, None
+    frames = []
+    first_date = None
+    if kline_df is not None and not kline_df.empty:
+        new_df = kline_df.set_index(pd.to_datetime(kline_df['Date']).rename('Date'))[ohlcv]
+        frames.append(new_df)
+        first_date = new_df.index.min()
+        if not (full_reload or rebuild):
+            state, state_date = _resume_indicator_state(ticker, new_df)
+            if state is not None:
+                new_df = new_df[new_df.index > state_date]
+                indicators, state = stream_indicators(new_df, state)
+                last_date = new_df.index.max() if not new_df.empty else state_date
+                return _indicator_rows(ticker, indicators), (last_date.strftime('%Y-%m-%d'), state.to_dict())
+    if not full_reload:
+        end = first_date - pd.Timedelta(days=1) if first_date is not None else None
+        stored = get_kline(ticker, end=end, last_n=None if rebuild else INDICATOR_WARMUP_BARS)
+        frames.insert(0, stored[ohlcv])
+    
+    history = pd.concat(frames) if frames else pd.DataFrame(columns=ohlcv)
+    if history.empty:
+        return None, None
+    history = history.astype(float)
+    indicators = compute_indicators(history)
+    if first_date is not None and not (full_reload or rebuild):
+        indicators = indicators[indicators.index >= first_date]
+    _, state = stream_indicators(history.tail(INDICATOR_WARMUP_BARS))
+    return _indicator_rows(ticker, indicators), (history.index.max().strftime('%Y-%m-%d'), state.to_dict())
+
+def _transform_pattern_timeline(ticker, kline_df=None, full_reload=False, rebuild=False):
+    """
+    掃描需要寫入 pattern_timeline 的圖形型態
+    
+    增量更新時只掃描受新K線影響的尾段：資料庫中最近 TIMELINE_WARMUP_BARS 根K線接上新抓取的K線，
+    重新掃描結束於新抓取日期前 TIMELINE_EXTREMA_ORDER 根之後的型態；
+    暖身K線不足以判斷跨越邊界的型態（見 timeline_history_sufficient）、型態從暖身K線的第一根開始、
+    時間軸尚未涵蓋資料庫中最新的K線、完整重載或 rebuild 時以完整歷史重新掃描。
+    返回 (取代起點日期或 None（取代全部）, 型態 DataFrame, 最後一根K線日期)，
+    沒有K線或（非 rebuild 時）沒有新K線時回傳 None。
+    """
+    ohlcv = ['Open', 'High', 'Low', 'Close', 'Volume']
+    if (kline_df is None or kline_df.empty) and not rebuild:
+        return None
+    frames = []
+    end = None
+    if kline_df is not None and not kline_df.empty:
+        new_df = kline_df.set_index(pd.to_datetime(kline_df['Date']).rename('Date'))[ohlcv]
+        frames.append(new_df)
+        end = new_df.index.min() - pd.Timedelta(days=1)
+    
+    since = 0
+    if not full_reload:
+        stored = None
+        if frames and not rebuild:
+            stored = get_kline(ticker, end=end, last_n=TIMELINE_WARMUP_BARS)[ohlcv]
+            covered = get_pattern_timeline_date(ticker)
+            if stored.empty or covered is None or pd.Timestamp(covered) < stored.index.max():
+                stored = None
+            else:
+                since = max(len(stored) - TIMELINE_EXTREMA_ORDER, 0)
+                if len(stored) == TIMELINE_WARMUP_BARS and \
+                        not timeline_history_sufficient(pd.concat([stored] + frames).astype(float), since):
+                    stored, since = None, 0
+        if stored is None:
+            stored = get_kline(ticker, end=end)[ohlcv]
+        frames.insert(0, stored)
+    
+    history = pd.concat(frames) if frames else pd.DataFrame(columns=ohlcv)
+    if history.empty:
+        return None
+    history = history.astype(float)
+    timeline = scan_pattern_timeline(history, since)
+    if since and len(frames[0]) == TIMELINE_WARMUP_BARS and (timeline['Start'] == history.index[0]).any():
+        # 連續符合的窗口從暖身K線的第一根就已開始，型態的起點可能更早，改以完整歷史重新掃描
+        history = pd.concat([get_kline(ticker, end=end)[ohlcv]] + frames[1:]).astype(float)
+        since = 0
+        timeline = scan_pattern_timeline(history)
+    since_date = history.index[since].strftime('%Y-%m-%d') if since else None
+    return since_date, timeline, history.index.max().strftime('%Y-%m-%d')
+
+def transform_ticker_data(raw, rebuild_indicators=False, rebuild_timeline=False):
+    """
+    轉換階段：將原始資料整理為可直接寫入資料庫的格式
+    
+    有新K線時一併計算受影響日期的技術指標與型態時間軸；
+    rebuild_indicators / rebuild_timeline 為 True 時以該股票的完整歷史重新計算指標／型態時間軸。
+    返回: 寫入用 payload dict，沒有任何可寫入的資料時回傳 None
+    """
+    ticker = raw['ticker']
+    payload = {'ticker': ticker, 'kline': raw['kline'], 'info': None, 'financials': None, 'indicators': None,
+               'indicator_state': None, 'pattern_timeline': None}
+    
+    if raw['kline'] is not None:
+        kline_df, full_reload = raw['kline']
+        payload['indicators'], payload['indicator_state'] = _transform_indicators(
+            ticker, kline_df, full_reload, rebuild_indicators)
+        payload['pattern_timeline'] = _transform_pattern_timeline(ticker, kline_df, full_reload, rebuild_timeline)
+    else:
+        if rebuild_indicators:
+            payload['indicators'], payload['indicator_state'] = _transform_indicators(ticker, rebuild=True)
+        if rebuild_timeline:
+            payload['pattern_timeline'] = _transform_pattern_timeline(ticker, rebuild=True)
+    
+    info = raw['info']
+    if info is not None:
+        payload['info'] = {
+            'Ticker': ticker,
+            'Name': info.get('longName', 'N/A'),
+            'Industry': info.get('industry', 'N/A'),
+            'MarketCap': info.get('marketCap', None),
+            'TrailingPE': info.get('trailingPE', info.get('forwardPE', None)),
+            'ForwardPE': info.get('forwardPE', None),
+            'TrailingEps': info.get('trailingEps', None),
+            'EarningsDate': _earnings_date(info)
+        }
+    
+    if raw['financials'] is not None:
+        financials_df = _transform_financials(*raw['financials'], ticker)
+        if financials_df.empty:
+            logger.warning(f"Cleaned financials data for {ticker} is empty after dropping NaN")
+        else:
+            payload['financials'] = financials_df
+    
+    if all(payload[key] is None for key in ('kline', 'info', 'financials', 'indicators', 'pattern_timeline')):
+        return None
+    return payload
+
+def _on_written(conn, payload):
+    """單一股票寫入完成後記錄各資料集筆數，並更新K線快照"""
+    from config import KLINE_SNAPSHOTS
+    
+    ticker = payload['ticker']
+    if payload['kline'] is not None:
+        kline_df, full_reload = payload['kline']
+        mode = "full reload" if full_reload else "incremental"
+        logger.info(f"Successfully stored K-line data for {ticker} with {len(kline_df)} rows ({mode})")
+        if KLINE_SNAPSHOTS:
+            try:
+                write_kline_snapshot(ticker, conn)
+            except Exception as e:
+                logger.warning(f"Failed to write K-line snapshot for {ticker}: {str(e)}")
+    if payload.get('indicators') is not None:
+        logger.info(f"Successfully stored indicators for {ticker} with {len(payload['indicators'])} rows")
+    if payload.get('pattern_timeline') is not None:
+        since, timeline, _ = payload['pattern_timeline']
+        scope = f"since {since}" if since else "full history"
+        logger.info(f"Successfully stored pattern timeline for {ticker} with {len(timeline)} rows ({scope})")
+    if payload['info'] is not None:
+        logger.info(f"Successfully stored info data for {ticker}")
+    if payload['financials'] is not None:
+        logger.info(f"Successfully stored financials data for {ticker} with {len(payload['financials'])} rows")
 
+def _writer_loop(write_queue, written, batch_tickers, flush_seconds):
+    """
+    寫入階段：唯一的 SQLite 寫入者
+    
+    累積多檔股票的資料後在同一個交易中寫入，每檔股票的刪除與寫入都在交易內完成，
+    讀取端不會看到K線已刪除但尚未寫入的狀態。整批失敗時改為逐檔寫入以隔離錯誤。
+    """
+    conn = get_db_connection()
+    pending = []
+    deadline = None
+    
+    def flush():
+        if not pending:
+            return
+        try:
+            with conn:
+                for payload in pending:
+                    write_ticker_data(conn, payload)
+            for payload in pending:
+                written.add(payload['ticker'])
+                _on_written(conn, payload)
         except Exception as e:
-            logger.error(f"Error fetching data for {ticker}: {str(e)}")
-            continue
+            logger.warning(f"Batch write of {len(pending)} tickers failed, retrying one by one: {str(e)}")
+            for payload in pending:
+                try:
+                    with conn:
+                        write_ticker_data(conn, payload)
+                    written.add(payload['ticker'])
+                    _on_written(conn, payload)
+                except Exception as e:
+                    logger.error(f"Error storing data for {payload['ticker']}: {str(e)}")
+        pending.clear()
+    
+    try:
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                payload = write_queue.get(timeout=timeout)
+            except queue.Empty:
+                flush()
+                deadline = None
+                continue
+            if payload is None:
+                break
+            if not pending:
+                deadline = time.monotonic() + flush_seconds
+            pending.append(payload)
+            if len(pending) >= batch_tickers:
+                flush()
+                deadline = None
+        flush()
+    finally:
+        conn.close()
 
-    conn.close()
-    logger.info("Data fetch process completed for all tickers.")
+def fetch_and_store_all_data(parallel=None, max_workers=None, force=False, provider=None):
+    """
+    抓取所有公司的資料並儲存到資料庫
+    
+    以三段式管線執行：多個抓取執行緒 -> 轉換執行緒 -> 單一寫入執行緒。
+    仍在有效期內的資料集（見 get_stale_datasets）會被略過。
+    
+    參數:
+    - parallel: 是否以多執行緒平行抓取（預設讀取 config.FETCH_PARALLEL）
+    - max_workers: 平行抓取的最大執行緒數（預設讀取 config.FETCH_MAX_WORKERS）
+    - force: 忽略資料更新紀錄，重新抓取所有資料集
+    - provider: 資料來源（預設依 config.DATA_PROVIDER 建立，見 data_providers）
+    """
+    # 動態載入 TICKERS
+    from config import (TICKERS, FETCH_PARALLEL, FETCH_MAX_WORKERS, PRICE_BATCH_DOWNLOAD,
+                        TRANSFORM_WORKERS, WRITER_BATCH_TICKERS, WRITER_FLUSH_SECONDS)
+    
+    if parallel is None:
+        parallel = FETCH_PARALLEL
+    if max_workers is None:
+        max_workers = FETCH_MAX_WORKERS
+    max_workers = max(1, min(max_workers, len(TICKERS) or 1)) if parallel else 1
+    
+    if provider is None:
+        provider = get_provider()
+    
+    mode = f"parallel, {max_workers} workers" if parallel else "sequential"
+    logger.info(f"Starting data fetch process for all tickers ({mode})...")
+    conn = get_db_connection()
+    run_start = time.perf_counter()
+    fetch_stats.reset()
+    durations = {}
+    prefetch_elapsed = 0.0
+    write_queue = queue.Queue()
+    written = set()
+    
+    writer = threading.Thread(
+        target=_writer_loop, name='writer',
+        args=(write_queue, written, WRITER_BATCH_TICKERS, WRITER_FLUSH_SECONDS)
+    )
+    writer.start()
+    
+    def fetch_stage(name, ticker, datasets, prefetched_kline):
+        start = time.perf_counter()
+        try:
+            return fetch_ticker_data(provider, name, ticker, conn, datasets, prefetched_kline)
+        finally:
+            durations[ticker] = time.perf_counter() - start
+    
+    def transform_stage(raw):
+        start = time.perf_counter()
+        try:
+            payload = transform_ticker_data(raw, rebuild_indicators=raw['ticker'] in stale_indicators,
+                                            rebuild_timeline=raw['ticker'] in stale_timelines)
+            if payload is not None:
+                write_queue.put(payload)
+        except Exception as e:
+            logger.error(f"Error transforming data for {raw['ticker']}: {str(e)}")
+        finally:
+            durations[raw['ticker']] = durations.get(raw['ticker'], 0.0) + time.perf_counter() - start
+    
+    try:
+        stale = get_stale_datasets(list(TICKERS.values()), conn, force=force)
+        # 指標表尚未涵蓋最新K線的股票（例如剛升級資料庫）需要以完整歷史重新計算指標
+        stale_indicators = set(get_stale_indicator_tickers(conn)) & set(TICKERS.values())
+        stale_timelines = set(get_stale_timeline_tickers(conn)) & set(TICKERS.values())
+        due = {name: ticker for name, ticker in TICKERS.items() if stale[ticker]}
+        skipped = len(TICKERS) - len(due)
+        if skipped:
+            logger.info(f"Skipping {skipped} tickers whose datasets are all still fresh")
+        
+        prefetched = {}
+        kline_tickers = [ticker for ticker in due.values() if 'kline' in stale[ticker]]
+        if PRICE_BATCH_DOWNLOAD and kline_tickers:
+            prefetch_start = time.perf_counter()
+            try:
+                prefetched = fetch_klines_batched(provider, kline_tickers, conn)
+            except Exception as e:
+                logger.error(f"Batched K-line download failed, falling back to per-ticker: {str(e)}")
+            prefetch_elapsed = time.perf_counter() - prefetch_start
+        
+        with ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS, thread_name_prefix='transform') as transform_pool:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch') as fetch_pool:
+                futures = {
+                    fetch_pool.submit(fetch_stage, name, ticker, stale[ticker], prefetched.get(ticker)): ticker
+                    for name, ticker in due.items()
+                }
+                for future in as_completed(futures):
+                    try:
+                        transform_pool.submit(transform_stage, future.result())
+                    except Exception as e:
+                        logger.error(f"Error fetching data for {futures[future]}: {str(e)}")
+            
+            # 本次不更新K線的股票直接以資料庫中的K線補算指標與型態時間軸
+            for ticker in (stale_indicators | stale_timelines) - set(kline_tickers):
+                raw = {'ticker': ticker, 'kline': None, 'info': None, 'financials': None}
+                transform_pool.submit(transform_stage, raw)
+    finally:
+        write_queue.put(None)
+        writer.join()
+        conn.close()
+    
+    # 批次下載K線的時間加上各檔耗時總和，估計循序執行所需的時間（未計入寫入與等待）
+    total_elapsed = time.perf_counter() - run_start
+    sequential_elapsed = prefetch_elapsed + sum(durations.values())
+    speedup = sequential_elapsed / total_elapsed if total_elapsed > 0 else 1.0
+    logger.info(
+        f"Data fetch process completed for all tickers: {len(written & set(due.values()))}/{len(due)} stored, "
+        f"total {total_elapsed:.1f}s vs estimated sequential {sequential_elapsed:.1f}s (x{speedup:.1f})"
+    )
+    logger.info(f"Request stats: {fetch_stats.snapshot()}")
 
 def main():
     """主函數，初始化資料庫並執行數據抓取"""
@@ -0,0 +1,230 @@
+import json
+import os
+import sys
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from rate_limit import call_with_retry
+
+# 取得執行檔案的目錄（錄製資料的相對路徑以此為準，與資料庫相同）
+if getattr(sys, 'frozen', False):
+    # 如果是打包後的 exe
+    application_path = os.path.dirname(sys.executable)
+else:
+    # 如果是開發環境
+    application_path = os.path.dirname(os.path.abspath(__file__))
+
+class DataProvider:
+    """
+    資料來源介面，data_fetcher 只透過這些方法取得資料
+
+    history 回傳以 Date 為索引、含 Open/High/Low/Close/Volume（與 Dividends/Stock Splits）的 DataFrame；
+    download 回傳多檔股票的寬格式 (Price, Ticker) DataFrame；
+    info 回傳 yfinance 格式的 dict；financials / quarterly_financials 回傳「指標 × 報表日期」的 DataFrame。
+    """
+
+    def history(self, ticker, period="5y", start=None):
+        raise NotImplementedError
+
+    def download(self, symbols, period=None, start=None):
+        """預設逐檔呼叫 history 並組成寬格式；支援多檔請求的資料來源可覆寫"""
+        frames = {}
+        for symbol in symbols:
+            try:
+                df = self.history(symbol, period=period, start=start)
+            except Exception:
+                continue
+            if not df.empty:
+                frames[symbol] = df
+        if not frames:
+            return pd.DataFrame()
+        wide = pd.concat(frames, axis=1, names=['Ticker', 'Price'])
+        return wide.swaplevel(0, 1, axis=1).sort_index(axis=1)
+
+    def info(self, ticker):
+        raise NotImplementedError
+
+    def financials(self, ticker):
+        raise NotImplementedError
+
+    def quarterly_financials(self, ticker):
+        raise NotImplementedError
+
+class YahooProvider(DataProvider):
+    """透過 yfinance 取得線上資料，所有請求都經過共用的限速與重試"""
+
+    def __init__(self):
+        import yfinance as yf
+        self._yf = yf
+
+    def history(self, ticker, period="5y", start=None):
+        stock = self._yf.Ticker(ticker)
+        if start is not None:
+            return call_with_retry(lambda: stock.history(start=start, auto_adjust=True, timeout=60),
+                                   f"history({ticker})")
+        return call_with_retry(lambda: stock.history(period=period, auto_adjust=True, timeout=60),
+                               f"history({ticker})")
+
+    def download(self, symbols, period=None, start=None):
+        kwargs = {'start': start} if start is not None else {'period': period}
+        return call_with_retry(
+            lambda: self._yf.download(symbols, auto_adjust=True, actions=True, group_by='column',
+                                      progress=False, timeout=60, **kwargs),
+            f"download({len(symbols)} symbols)"
+        )
+
+    def info(self, ticker):
+        return call_with_retry(lambda: self._yf.Ticker(ticker).info, f"info({ticker})")
+
+    def financials(self, ticker):
+        return call_with_retry(lambda: self._yf.Ticker(ticker).financials, f"financials({ticker})")
+
+    def quarterly_financials(self, ticker):
+        return call_with_retry(lambda: self._yf.Ticker(ticker).quarterly_financials,
+                               f"quarterly_financials({ticker})")
+
+class RecordedProvider(DataProvider):
+    """
+    從磁碟重播先前錄製的回應，不需要網路
+
+    目錄結構: <directory>/<ticker>/{history.pkl, info.json, financials.pkl, quarterly_financials.pkl}
+    若指定 source，則改為錄製模式：呼叫 source 取得資料並寫入目錄後回傳。
+    """
+
+    def __init__(self, directory, source=None):
+        self.directory = directory
+        self.source = source
+
+    def _path(self, ticker, name):
+        return os.path.join(self.directory, ticker.replace('/', '_'), name)
+
+    def _load_frame(self, ticker, name, fetch):
+        path = self._path(ticker, f"{name}.pkl")
+        if self.source is not None:
+            df = fetch()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_pickle(path)
+            return df
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        return pd.read_pickle(path)
+
+    def history(self, ticker, period="5y", start=None):
+        # 錄製時一律保存完整歷史，重播時再依 start 篩選
+        df = self._load_frame(ticker, 'history', lambda: self.source.history(ticker, period="5y"))
+        if start is not None and not df.empty:
+            start_ts = pd.Timestamp(start)
+            if df.index.tz is not None:
+                start_ts = start_ts.tz_localize(df.index.tz)
+            df = df[df.index >= start_ts]
+        return df
+
+    def info(self, ticker):
+        path = self._path(ticker, 'info.json')
+        if self.source is not None:
+            info = self.source.info(ticker)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(info, f, ensure_ascii=False, default=str)
+            return info
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def financials(self, ticker):
+        return self._load_frame(ticker, 'financials', lambda: self.source.financials(ticker))
+
+    def quarterly_financials(self, ticker):
+        return self._load_frame(ticker, 'quarterly_financials',
+                                lambda: self.source.quarterly_financials(ticker))
+
+class SyntheticProvider(DataProvider):
+    """
+    為任意股票代號產生合成資料，用於離線壓力測試
+
+    價格為以代號為種子的幾何布朗運動，同一代號每次產生的資料都相同。
+    """
+
+    FINANCIAL_METRICS = ['Total Revenue', 'Gross Profit', 'Operating Income', 'Net Income', 'EBITDA']
+
+    def __init__(self, years=5, seed=0, end=None):
+        self.years = years
+        self.seed = seed
+        self.end = pd.Timestamp(end or datetime.now().date())
+
+    def _rng(self, ticker, salt=''):
+        return np.random.default_rng(zlib.crc32(f"{self.seed}:{ticker}:{salt}".encode()))
+
+    def history(self, ticker, period="5y", start=None):
+        dates = pd.bdate_range(end=self.end, periods=self.years * 252, name='Date')
+        rng = self._rng(ticker, 'history')
+        n = len(dates)
+
+        start_price = rng.uniform(10, 500)
+        returns = rng.normal(0.0003, 0.02, n)
+        close = start_price * np.exp(np.cumsum(returns))
+        open_ = np.concatenate(([start_price], close[:-1])) * (1 + rng.normal(0, 0.003, n))
+        spread = np.abs(rng.normal(0, 0.01, n))
+        high = np.maximum(open_, close) * (1 + spread)
+        low = np.minimum(open_, close) * (1 - spread)
+        volume = rng.integers(100_000, 10_000_000, n)
+
+        df = pd.DataFrame({
+            'Open': open_, 'High': high, 'Low': low, 'Close': close, 'Volume': volume,
+            'Dividends': 0.0, 'Stock Splits': 0.0
+        }, index=dates)
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+        return df
+
+    def info(self, ticker):
+        rng = self._rng(ticker, 'info')
+        eps = float(rng.uniform(-1, 20))
+        pe = float(rng.uniform(5, 60))
+        earnings = self.end - pd.Timedelta(days=int(rng.integers(0, 90)))
+        return {
+            'longName': f"Synthetic {ticker}",
+            'industry': 'Synthetic',
+            'marketCap': float(rng.uniform(1e8, 1e12)),
+            'trailingPE': pe if eps > 0 else None,
+            'forwardPE': pe * 0.9,
+            'trailingEps': eps,
+            'earningsTimestamp': int(earnings.timestamp()),
+        }
+
+    def _statements(self, ticker, months, periods, scale):
+        rng = self._rng(ticker, f"financials-{months}")
+        dates = [self.end - pd.DateOffset(months=months * i) for i in range(periods)]
+        revenue = rng.uniform(1e8, 1e11) * scale * (1 + rng.normal(0.05, 0.1, periods)).cumprod()
+        margins = np.array([0.5, 0.25, 0.15, 0.3])[:, None] * (1 + rng.normal(0, 0.1, (4, periods)))
+        values = np.vstack([revenue, revenue * margins])
+        return pd.DataFrame(values, index=self.FINANCIAL_METRICS, columns=dates)
+
+    def financials(self, ticker):
+        return self._statements(ticker, 12, 4, 1.0)
+
+    def quarterly_financials(self, ticker):
+        return self._statements(ticker, 3, 5, 0.25)
+
+def get_provider(name=None):
+    """
+    依名稱（預設 config.DATA_PROVIDER）建立資料來源：'yahoo'、'recorded'、'record' 或 'synthetic'
+    config.RECORDED_DATA_DIR 為相對路徑時以執行檔案的目錄為準，不受目前工作目錄影響
+    """
+    from config import DATA_PROVIDER, RECORDED_DATA_DIR
+
+    name = name or DATA_PROVIDER
+    recorded_dir = os.path.join(application_path, RECORDED_DATA_DIR)
+    if name == 'yahoo':
+        return YahooProvider()
+    if name == 'recorded':
+        return RecordedProvider(recorded_dir)
+    if name == 'record':
+        return RecordedProvider(recorded_dir, source=YahooProvider())
+    if name == 'synthetic':
+        return SyntheticProvider()
+    raise ValueError(f"Unknown data provider: {name}")
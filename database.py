@@ -1,4 +1,9 @@
+import json
 import sqlite3
+import numpy as np
+import threading
+from contextlib import contextmanager
+from datetime import datetime
 import pandas as pd
 import os
 import sys
@@ -14,21 +19,96 @@ else:
 # 設定資料庫路徑
 DB_FILE = os.path.join(application_path, 'stock_data.db')
 
+# K線 DataFrame 的欄位順序（資料庫中以 TickerId / Day 整數儲存，讀寫時自動轉換）
+KLINE_COLUMNS = ['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+# yfinance 回傳的分割／股利欄位（不寫入資料庫，僅用於偵測歷史調整）
+KLINE_ACTION_COLUMNS = ['Dividends', 'Stock Splits']
+# info 與 financials 的欄位順序
+INFO_COLUMNS = ['Ticker', 'Name', 'Industry', 'MarketCap', 'TrailingPE', 'ForwardPE', 'TrailingEps', 'EarningsDate']
+FINANCIALS_COLUMNS = ['Ticker', 'ReportDate', 'Metric', 'Value']
+# indicators_daily 儲存的技術指標欄位（欄名與 pandas_ta 產生的相同，由 indicators.compute_indicators 計算）
+INDICATOR_COLUMNS = ['SMA_20', 'SMA_60', 'MACD_12_26_9', 'MACDh_12_26_9', 'MACDs_12_26_9',
+                     'STOCHk_14_3_3', 'STOCHd_14_3_3']
+# pattern_timeline 讀出的欄位：Start / End 為型態開始與結束的日期（由 trend_pattern_analysis.scan_pattern_timeline 產生）
+PATTERN_TIMELINE_COLUMNS = ['Start', 'End', 'Pattern', 'Score']
+# 抓取流程中各自追蹤更新時間的資料集
+DATASETS = ['kline', 'info', 'financials']
+
+# 每個連線建立時套用的 PRAGMA：WAL 讓讀取不會被抓取流程的寫入阻塞
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',    # WAL 模式下只在 checkpoint 時 fsync
+    'cache_size': -65536,       # 64 MB page cache（負數單位為 KB）
+    'mmap_size': 268435456,     # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+# 連線池保留的閒置連線數上限
+POOL_SIZE = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+
 def get_db_connection():
-    """建立資料庫連線"""
+    """建立新的資料庫連線並套用 PRAGMA 設定，呼叫端負責關閉"""
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    for name, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
     return conn
 
-def init_db():
-    """初始化資料庫和資料表"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@contextmanager
+def pooled_connection():
+    """
+    從連線池借用連線，離開時歸還（不關閉）
     
-    for table_name in ['kline_daily', 'financials', 'info']:
-        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+    借用期間該連線只由目前執行緒使用；池中沒有閒置連線時建立新連線，
+    歸還時超過 POOL_SIZE 的連線會被關閉。連線池依 DB_FILE 區分。
+    """
+    db_file = DB_FILE
+    with _pools_lock:
+        idle = _pools.setdefault(db_file, [])
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        with _pools_lock:
+            idle = _pools.setdefault(db_file, [])
+            if len(idle) < POOL_SIZE:
+                idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+def close_pooled_connections():
+    """關閉連線池中所有閒置連線"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for idle in pools:
+        for conn in idle:
+            conn.close()
+
+@contextmanager
+def _connection(conn=None):
+    """使用呼叫端提供的連線，未提供時從連線池借用"""
+    if conn is not None:
+        yield conn
+    else:
+        with pooled_connection() as pooled:
+            yield pooled
 
+def _column_exists(cursor, table_name, column_name):
+    """檢查資料表是否已有指定欄位"""
+    return any(row[1] == column_name for row in cursor.execute(f"PRAGMA table_info({table_name})"))
+
+def _migration_1(cursor):
+    """建立 K 線、財報與基本資訊資料表"""
     cursor.execute('''
-    CREATE TABLE kline_daily (
+    CREATE TABLE IF NOT EXISTS kline_daily (
         Ticker TEXT,
         Date TEXT,
         Open REAL,
@@ -41,7 +121,7 @@ def init_db():
     ''')
     
     cursor.execute('''
-    CREATE TABLE financials (
+    CREATE TABLE IF NOT EXISTS financials (
         Ticker TEXT,
         ReportDate TEXT,
         Metric TEXT,
@@ -51,7 +131,7 @@ def init_db():
     ''')
     
     cursor.execute('''
-    CREATE TABLE info (
+    CREATE TABLE IF NOT EXISTS info (
         Ticker TEXT PRIMARY KEY,
         Name TEXT,
         Industry TEXT,
@@ -61,41 +141,631 @@ def init_db():
         TrailingEps REAL
     )
     ''')
+
+def _migration_2(cursor):
+    """新增財報公布日欄位與資料集更新時間表"""
+    if not _column_exists(cursor, 'info', 'EarningsDate'):
+        cursor.execute("ALTER TABLE info ADD COLUMN EarningsDate TEXT")
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS dataset_freshness (
+        Ticker TEXT,
+        Dataset TEXT,
+        LastRefreshed TEXT,
+        PRIMARY KEY (Ticker, Dataset)
+    )
+    ''')
+
+def _migration_3(cursor):
+    """
+    K線改用精簡格式：股票代號改為 symbols 表的整數 TickerId，日期改為 1970-01-01 起算的日數 Day，
+    並以 WITHOUT ROWID 依 (TickerId, Day) 叢集存放，讓單一股票的區間讀取為連續掃描
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS symbols (
+        TickerId INTEGER PRIMARY KEY,
+        Ticker TEXT NOT NULL UNIQUE
+    )
+    ''')
+    
+    if not _column_exists(cursor, 'kline_daily', 'Ticker'):
+        return
+    
+    cursor.execute("INSERT OR IGNORE INTO symbols (Ticker) SELECT DISTINCT Ticker FROM kline_daily")
+    cursor.execute('''
+    CREATE TABLE kline_daily_compact (
+        TickerId INTEGER NOT NULL,
+        Day INTEGER NOT NULL,
+        Open REAL,
+        High REAL,
+        Low REAL,
+        Close REAL,
+        Volume INTEGER,
+        PRIMARY KEY (TickerId, Day)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    INSERT INTO kline_daily_compact (TickerId, Day, Open, High, Low, Close, Volume)
+    SELECT s.TickerId, CAST(julianday(k.Date) - 2440587.5 AS INTEGER), k.Open, k.High, k.Low, k.Close, k.Volume
+    FROM kline_daily k JOIN symbols s ON s.Ticker = k.Ticker
+    ''')
+    cursor.execute("DROP TABLE kline_daily")
+    cursor.execute("ALTER TABLE kline_daily_compact RENAME TO kline_daily")
+
+def _migration_4(cursor):
+    """新增 indicators_daily：抓取流程寫入K線後預先計算的技術指標，與 kline_daily 同樣以 (TickerId, Day) 叢集"""
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS indicators_daily (
+        TickerId INTEGER NOT NULL,
+        Day INTEGER NOT NULL,
+        {', '.join(f'{column} REAL' for column in INDICATOR_COLUMNS)},
+        PRIMARY KEY (TickerId, Day)
+    ) WITHOUT ROWID
+    ''')
+
+def _migration_5(cursor):
+    """新增 indicator_state：每檔股票技術指標的串流計算狀態（JSON），Day 為狀態涵蓋的最後一根K線"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS indicator_state (
+        TickerId INTEGER PRIMARY KEY,
+        Day INTEGER NOT NULL,
+        State TEXT NOT NULL
+    )
+    ''')
+
+def _migration_6(cursor):
+    """
+    新增 pattern_timeline：每檔股票完整歷史中偵測到的所有圖形型態（滑動窗口型態每段連續符合的窗口一列），
+    以 (TickerId, EndDay) 叢集，增量更新時只取代尾段；pattern_timeline_state 記錄時間軸已掃描到的最後一根K線
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pattern_timeline (
+        TickerId INTEGER NOT NULL,
+        EndDay INTEGER NOT NULL,
+        Pattern TEXT NOT NULL,
+        StartDay INTEGER NOT NULL,
+        Score INTEGER NOT NULL,
+        PRIMARY KEY (TickerId, EndDay, Pattern, StartDay)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pattern_timeline_state (
+        TickerId INTEGER PRIMARY KEY,
+        Day INTEGER NOT NULL
+    )
+    ''')
+
+# 依序套用的資料表結構遷移 (版本, 函數)；新增結構變更時只能在最後追加
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+]
+
+def get_schema_version(conn):
+    """取得資料庫目前的結構版本，尚未初始化時為 0"""
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (Version INTEGER NOT NULL)")
+    row = conn.execute("SELECT MAX(Version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def init_db():
+    """
+    初始化資料庫：依序套用尚未執行的結構遷移，保留既有資料
     
-    conn.commit()
-    conn.close()
-    print("Database initialized.")
+    每個遷移都可重複執行（CREATE ... IF NOT EXISTS），並與版本紀錄在同一個交易中提交。
+    本次套用了遷移 3（重建K線表並刪除舊表）時，提交後執行 VACUUM 釋放舊表留下的空間。
+    """
+    conn = get_db_connection()
+    try:
+        version = get_schema_version(conn)
+        conn.commit()
+        applied = []
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+            with conn:
+                conn.execute("BEGIN")
+                migration(conn.cursor())
+                conn.execute("INSERT INTO schema_version (Version) VALUES (?)", (target,))
+            version = target
+            applied.append(target)
+        if 3 in applied:
+            # VACUUM 不能在交易中執行
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    print(f"Database initialized (schema version {version}).")
+
+def dates_to_days(dates):
+    """將日期（字串或 datetime）轉為 1970-01-01 起算的整數日數"""
+    return pd.to_datetime(pd.Series(dates)).values.astype('datetime64[D]').astype(np.int64)
+
+def days_to_dates(days):
+    """將整數日數轉為 DatetimeIndex"""
+    return pd.to_datetime(np.asarray(days, dtype=np.int64), unit='D')
+
+def get_ticker_ids(conn, tickers, create=False):
+    """取得股票代號對應的 TickerId；create=True 時為不存在的代號建立新 id"""
+    tickers = list(dict.fromkeys(tickers))
+    if create:
+        conn.executemany("INSERT OR IGNORE INTO symbols (Ticker) VALUES (?)", [(t,) for t in tickers])
+    ids = {}
+    for i in range(0, len(tickers), 500):
+        chunk = tickers[i:i + 500]
+        rows = conn.execute(
+            f"SELECT Ticker, TickerId FROM symbols WHERE Ticker IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        ids.update(rows)
+    return ids
 
 def save_data(df, table_name, ticker):
     """將 DataFrame 存入指定資料表"""
-    conn = get_db_connection()
-    if not df.empty:
-        conn.execute(f"DELETE FROM {table_name} WHERE Ticker = ?", (ticker,))
-        df.to_sql(table_name, conn, if_exists='append', index=False)
-    conn.close()
+    if df.empty:
+        return
+    with pooled_connection() as conn:
+        with conn:
+            if table_name == 'kline_daily':
+                write_ticker_data(conn, {'ticker': ticker, 'kline': (df, True)})
+                return
+            conn.execute(f"DELETE FROM {table_name} WHERE Ticker = ?", (ticker,))
+            df.to_sql(table_name, conn, if_exists='append', index=False)
 
-def get_kline(ticker, period='daily'):
-    """從資料庫讀取K線資料"""
-    conn = get_db_connection()
-    table_name = f"kline_{period}"
-    df = pd.read_sql_query(f"SELECT * FROM {table_name} WHERE Ticker = ? ORDER BY Date ASC", conn, params=(ticker,))
-    conn.close()
+def get_last_kline_date(ticker, conn=None):
+    """取得某檔股票在 kline_daily 中的最新日期（'%Y-%m-%d'），無資料時回傳 None"""
+    with _connection(conn) as conn:
+        row = conn.execute(
+            "SELECT MAX(k.Day) FROM kline_daily k JOIN symbols s ON s.TickerId = k.TickerId WHERE s.Ticker = ?",
+            (ticker,)
+        ).fetchone()
+    if not row or row[0] is None:
+        return None
+    return days_to_dates([row[0]])[0].strftime('%Y-%m-%d')
+
+def get_stored_closes(tickers, start, conn=None):
+    """讀取多檔股票自 start 起已儲存的收盤價，返回欄位 Ticker, Date（'%Y-%m-%d'）, Close"""
+    tickers = list(tickers)
+    with _connection(conn) as conn:
+        df = pd.read_sql_query(
+            f"SELECT s.Ticker, k.Day, k.Close FROM kline_daily k JOIN symbols s ON s.TickerId = k.TickerId "
+            f"WHERE s.Ticker IN ({','.join('?' * len(tickers))}) AND k.Day >= ?",
+            conn, params=(*tickers, int(dates_to_days([start])[0]))
+        )
+    df['Date'] = days_to_dates(df['Day']).strftime('%Y-%m-%d')
+    return df[['Ticker', 'Date', 'Close']]
+
+def _upsert_kline_rows(conn, df):
+    """在目前交易中以 executemany 寫入K線（不提交）"""
+    ids = get_ticker_ids(conn, df['Ticker'].unique(), create=True)
+    rows = zip(
+        df['Ticker'].map(ids).astype(np.int64).tolist(),
+        dates_to_days(df['Date']).tolist(),
+        df['Open'].astype(float).tolist(),
+        df['High'].astype(float).tolist(),
+        df['Low'].astype(float).tolist(),
+        df['Close'].astype(float).tolist(),
+        df['Volume'].astype(np.int64).tolist(),
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO kline_daily (TickerId, Day, Open, High, Low, Close, Volume) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+
+def _upsert_indicator_rows(conn, df):
+    """在目前交易中寫入技術指標（欄位 Ticker, Date 與 INDICATOR_COLUMNS，不提交）"""
+    ids = get_ticker_ids(conn, df['Ticker'].unique(), create=True)
+    values = df[INDICATOR_COLUMNS].astype(float)
+    rows = zip(
+        df['Ticker'].map(ids).astype(np.int64).tolist(),
+        dates_to_days(df['Date']).tolist(),
+        *(values[column].where(values[column].notna(), None).tolist() for column in INDICATOR_COLUMNS)
+    )
+    conn.executemany(
+        f"INSERT OR REPLACE INTO indicators_daily (TickerId, Day, {', '.join(INDICATOR_COLUMNS)}) "
+        f"VALUES ({', '.join('?' * (len(INDICATOR_COLUMNS) + 2))})",
+        rows
+    )
+
+def get_indicator_state(ticker, conn=None):
+    """讀取保存的技術指標串流狀態，返回 (最後一根K線日期 '%Y-%m-%d', 狀態 dict)，不存在時為 (None, None)"""
+    with _connection(conn) as conn:
+        row = conn.execute(
+            "SELECT Day, State FROM indicator_state WHERE TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?)",
+            (ticker,)
+        ).fetchone()
+    if row is None:
+        return None, None
+    return days_to_dates([row[0]])[0].strftime('%Y-%m-%d'), json.loads(row[1])
+
+def _upsert_indicator_state(conn, ticker, date, state):
+    """在目前交易中保存技術指標串流狀態（不提交）"""
+    ids = get_ticker_ids(conn, [ticker], create=True)
+    conn.execute(
+        "INSERT OR REPLACE INTO indicator_state (TickerId, Day, State) VALUES (?, ?, ?)",
+        (ids[ticker], int(dates_to_days([date])[0]), json.dumps(state))
+    )
+
+def get_stale_indicator_tickers(conn=None):
+    """返回指標尚未涵蓋最新K線的股票代號（例如升級資料庫後尚未計算過指標）"""
+    with _connection(conn) as conn:
+        rows = conn.execute('''
+        SELECT s.Ticker FROM symbols s
+        JOIN (SELECT TickerId, MAX(Day) AS Day FROM kline_daily GROUP BY TickerId) k ON k.TickerId = s.TickerId
+        LEFT JOIN (SELECT TickerId, MAX(Day) AS Day FROM indicators_daily GROUP BY TickerId) i ON i.TickerId = s.TickerId
+        WHERE i.Day IS NULL OR i.Day < k.Day
+        ''').fetchall()
+    return [row[0] for row in rows]
+
+def get_pattern_timeline(ticker, start=None, end=None, conn=None):
+    """
+    讀取保存的型態時間軸，返回欄位為 PATTERN_TIMELINE_COLUMNS、依結束日期排序的 DataFrame
+    start / end 限定型態的結束日期範圍（含），None 表示不限
+    """
+    start_day, end_day = _day_bounds(start, end)
+    conditions = ["TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?)"]
+    params = [ticker]
+    if start_day is not None:
+        conditions.append("EndDay >= ?")
+        params.append(start_day)
+    if end_day is not None:
+        conditions.append("EndDay <= ?")
+        params.append(end_day)
+    with _connection(conn) as conn:
+        rows = conn.execute(
+            f"SELECT StartDay, EndDay, Pattern, Score FROM pattern_timeline WHERE {' AND '.join(conditions)} "
+            f"ORDER BY EndDay, StartDay", params
+        ).fetchall()
+    start_days, end_days, patterns, scores = zip(*rows) if rows else ((), (), (), ())
+    return pd.DataFrame({
+        'Start': days_to_dates(start_days), 'End': days_to_dates(end_days),
+        'Pattern': list(patterns), 'Score': np.asarray(scores, dtype=np.int64),
+    }, columns=PATTERN_TIMELINE_COLUMNS)
+
+def get_pattern_timeline_date(ticker, conn=None):
+    """型態時間軸已掃描到的最後一根K線日期 '%Y-%m-%d'，尚未掃描時為 None"""
+    with _connection(conn) as conn:
+        row = conn.execute(
+            "SELECT Day FROM pattern_timeline_state WHERE TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?)",
+            (ticker,)
+        ).fetchone()
+    return days_to_dates([row[0]])[0].strftime('%Y-%m-%d') if row is not None else None
+
+def _replace_pattern_timeline(conn, ticker, since, timeline, last_date):
+    """
+    在目前交易中以 timeline 取代結束日期在 since 之後（含）的型態，since 為 None 時取代全部（不提交）
+    last_date 為這次掃描涵蓋的最後一根K線
+    """
+    ids = get_ticker_ids(conn, [ticker], create=True)
+    ticker_id = ids[ticker]
+    if since is None:
+        conn.execute("DELETE FROM pattern_timeline WHERE TickerId = ?", (ticker_id,))
+    else:
+        conn.execute("DELETE FROM pattern_timeline WHERE TickerId = ? AND EndDay >= ?",
+                     (ticker_id, int(dates_to_days([since])[0])))
+    if not timeline.empty:
+        conn.executemany(
+            "INSERT OR REPLACE INTO pattern_timeline (TickerId, EndDay, Pattern, StartDay, Score) VALUES (?, ?, ?, ?, ?)",
+            zip([ticker_id] * len(timeline), dates_to_days(timeline['End']).tolist(), timeline['Pattern'].tolist(),
+                dates_to_days(timeline['Start']).tolist(), timeline['Score'].astype(np.int64).tolist())
+        )
+    conn.execute("INSERT OR REPLACE INTO pattern_timeline_state (TickerId, Day) VALUES (?, ?)",
+                 (ticker_id, int(dates_to_days([last_date])[0])))
+
+def get_stale_timeline_tickers(conn=None):
+    """返回型態時間軸尚未涵蓋最新K線的股票代號（例如升級資料庫後尚未掃描過）"""
+    with _connection(conn) as conn:
+        rows = conn.execute('''
+        SELECT s.Ticker FROM symbols s
+        JOIN (SELECT TickerId, MAX(Day) AS Day FROM kline_daily GROUP BY TickerId) k ON k.TickerId = s.TickerId
+        LEFT JOIN pattern_timeline_state p ON p.TickerId = s.TickerId
+        WHERE p.Day IS NULL OR p.Day < k.Day
+        ''').fetchall()
+    return [row[0] for row in rows]
+
+def upsert_kline(df, conn=None):
+    """將K線資料以 (Ticker, Date) 為鍵寫入 kline_daily，已存在的日期會被覆寫"""
+    if df.empty:
+        return
+    refreshed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    with _connection(conn) as conn:
+        _upsert_kline_rows(conn, df)
+        # 更新時間同時作為K線快照的版本，確保舊快照不會再被讀取
+        conn.executemany(
+            "INSERT OR REPLACE INTO dataset_freshness (Ticker, Dataset, LastRefreshed) VALUES (?, 'kline', ?)",
+            [(ticker, refreshed_at) for ticker in df['Ticker'].unique()]
+        )
+        conn.commit()
+
+def write_ticker_data(conn, payload):
+    """
+    在目前交易中寫入單一股票的K線、基本資訊與財報（不提交，由呼叫端控制交易）
+    
+    payload: {'ticker', 'kline': (kline_df, full_reload) 或 None,
+              'info': dict 或 None, 'financials': DataFrame 或 None,
+              'indicators': DataFrame 或 None（可省略，只包含需要更新的日期）,
+              'indicator_state': (最後一根K線日期, 狀態 dict) 或 None（可省略）,
+              'pattern_timeline': (取代起點日期或 None, 型態 DataFrame, 最後一根K線日期) 或 None（可省略，見 _replace_pattern_timeline）}
+    寫入的資料集會同時更新 dataset_freshness 的更新時間。
+    """
+    ticker = payload['ticker']
+    refreshed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    
+    if payload.get('kline') is not None:
+        kline_df, full_reload = payload['kline']
+        if full_reload:
+            for table_name in ('kline_daily', 'indicators_daily', 'indicator_state', 'pattern_timeline',
+                               'pattern_timeline_state'):
+                conn.execute(
+                    f"DELETE FROM {table_name} WHERE TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?)",
+                    (ticker,)
+                )
+        if not kline_df.empty:
+            _upsert_kline_rows(conn, kline_df)
+    
+    if payload.get('indicators') is not None and not payload['indicators'].empty:
+        _upsert_indicator_rows(conn, payload['indicators'])
+    if payload.get('indicator_state') is not None:
+        _upsert_indicator_state(conn, ticker, *payload['indicator_state'])
+    if payload.get('pattern_timeline') is not None:
+        _replace_pattern_timeline(conn, ticker, *payload['pattern_timeline'])
     
-    if not df.empty:
-        df['Date'] = pd.to_datetime(df['Date'])
-        df.set_index('Date', inplace=True)
+    if payload.get('info') is not None:
+        info = payload['info']
+        conn.execute(
+            f"INSERT OR REPLACE INTO info ({', '.join(INFO_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(INFO_COLUMNS))})",
+            [info.get(column) for column in INFO_COLUMNS]
+        )
+    
+    if payload.get('financials') is not None:
+        conn.execute("DELETE FROM financials WHERE Ticker = ?", (ticker,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO financials (Ticker, ReportDate, Metric, Value) VALUES (?, ?, ?, ?)",
+            [(t, d, m, float(v)) for t, d, m, v in
+             payload['financials'][FINANCIALS_COLUMNS].itertuples(index=False, name=None)]
+        )
+    
+    conn.executemany(
+        "INSERT OR REPLACE INTO dataset_freshness (Ticker, Dataset, LastRefreshed) VALUES (?, ?, ?)",
+        [(ticker, dataset, refreshed_at) for dataset in DATASETS if payload.get(dataset) is not None]
+    )
+
+def get_dataset_freshness(conn=None):
+    """讀取各股票各資料集的最後更新時間，並附上 info 中的財報公布日"""
+    with _connection(conn) as conn:
+        return pd.read_sql_query(
+            "SELECT f.Ticker, f.Dataset, f.LastRefreshed, i.EarningsDate "
+            "FROM dataset_freshness f LEFT JOIN info i ON i.Ticker = f.Ticker",
+            conn
+        )
+
+# K線快照欄位（依序存放在 (6, N) 的 float64 陣列中，每一列為一個連續的欄位）
+SNAPSHOT_FIELDS = ['Day', 'Open', 'High', 'Low', 'Close', 'Volume']
+
+def get_snapshot_dir():
+    """K線快照目錄，與目前的 DB_FILE 對應"""
+    return os.path.splitext(DB_FILE)[0] + '_snapshots'
+
+def _snapshot_paths(ticker):
+    safe_name = ''.join(c if c.isalnum() or c in '.-_' else '_' for c in ticker)
+    base = os.path.join(get_snapshot_dir(), safe_name)
+    return base + '.npy', base + '.json'
+
+def _get_kline_version(conn, ticker):
+    """K線的版本即 dataset_freshness 中 kline 的最後更新時間"""
+    row = conn.execute(
+        "SELECT LastRefreshed FROM dataset_freshness WHERE Ticker = ? AND Dataset = 'kline'", (ticker,)
+    ).fetchone()
+    return row[0] if row else None
+
+def write_kline_snapshot(ticker, conn=None):
+    """
+    將單一股票的完整K線寫成欄式 .npy 快照，供 get_kline 以 memory-map 零複製讀取
+    
+    先寫陣列再寫版本檔，兩者都以暫存檔加 os.replace 原子替換；
+    讀取端先讀版本檔，因此版本相符時陣列必定已是新的。
+    """
+    with _connection(conn) as conn:
+        version = _get_kline_version(conn, ticker)
+        df = pd.read_sql_query(
+            "SELECT k.Day, k.Open, k.High, k.Low, k.Close, k.Volume FROM kline_daily k "
+            "WHERE k.TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?) ORDER BY k.Day ASC",
+            conn, params=(ticker,)
+        )
+    if version is None or df.empty:
+        return
+    
+    array_path, meta_path = _snapshot_paths(ticker)
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+    columns = np.ascontiguousarray(df[SNAPSHOT_FIELDS].to_numpy(dtype=np.float64).T)
+    
+    tmp_array = array_path + '.tmp'
+    with open(tmp_array, 'wb') as f:
+        np.save(f, columns)
+    os.replace(tmp_array, array_path)
+    
+    tmp_meta = meta_path + '.tmp'
+    with open(tmp_meta, 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'rows': len(df)}, f)
+    os.replace(tmp_meta, meta_path)
+
+def _day_bounds(start=None, end=None):
+    """將 start / end 日期轉為 Day 編號，None 表示不限"""
+    start_day = int(dates_to_days([start])[0]) if start is not None else None
+    end_day = int(dates_to_days([end])[0]) if end is not None else None
+    return start_day, end_day
+
+def _read_kline_snapshot(ticker, conn, start_day=None, end_day=None, last_n=None):
+    """快照版本與資料庫相符時以 memory-map 讀取快照（可限定 Day 範圍與最後 N 筆），否則回傳 None"""
+    array_path, meta_path = _snapshot_paths(ticker)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != _get_kline_version(conn, ticker):
+            return None
+        columns = np.load(array_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    
+    # Day 列已排序，以二分搜尋切出範圍，切片仍是 mmap 的視圖
+    lo = int(np.searchsorted(columns[0], start_day, side='left')) if start_day is not None else 0
+    hi = int(np.searchsorted(columns[0], end_day, side='right')) if end_day is not None else columns.shape[1]
+    if last_n is not None:
+        lo = max(lo, hi - last_n)
+    columns = columns[:, lo:hi]
+    
+    # Open/High/Low/Close 直接使用 mmap 陣列的轉置視圖，不複製資料
+    df = pd.DataFrame(columns[1:5].T, columns=['Open', 'High', 'Low', 'Close'],
+                      index=days_to_dates(columns[0]).rename('Date'), copy=False)
+    df.insert(0, 'Ticker', ticker)
+    df['Volume'] = columns[5].astype(np.int64)
     return df
 
+def _join_indicators(conn, ticker, df):
+    """為以 Date 為索引的單一股票K線加上 indicators_daily 中對應日期的指標欄位（沒有的日期為 NaN）"""
+    if df.empty:
+        return df.reindex(columns=list(df.columns) + INDICATOR_COLUMNS)
+    days = dates_to_days(df.index)
+    indicators = pd.read_sql_query(
+        f"SELECT Day, {', '.join(INDICATOR_COLUMNS)} FROM indicators_daily "
+        f"WHERE TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?) AND Day BETWEEN ? AND ?",
+        conn, params=(ticker, int(days.min()), int(days.max()))
+    ).set_index('Day').reindex(days)
+    return df.assign(**{column: indicators[column].to_numpy(dtype=float) for column in INDICATOR_COLUMNS})
+
+def get_kline(ticker, period='daily', use_snapshot=True, start=None, end=None, last_n=None,
+              with_indicators=False):
+    """
+    從資料庫讀取K線資料
+    
+    日K線若有版本相符的快照（見 write_kline_snapshot）則直接 memory-map 讀取，否則查詢 SQLite。
+    
+    參數:
+    - start / end: 日期範圍（含），格式 '%Y-%m-%d' 或 datetime，None 表示不限
+    - last_n: 只讀取範圍內最後 N 根K線，None 表示全部
+    - with_indicators: 一併讀取 indicators_daily 中預先計算的技術指標欄位（僅日K線）
+    
+    範圍條件直接轉為主鍵 (TickerId, Day) 上的 WHERE / ORDER BY ... LIMIT，只讀取需要的資料頁。
+    """
+    empty_columns = KLINE_COLUMNS + (INDICATOR_COLUMNS if with_indicators else [])
+    if last_n is not None and last_n <= 0:
+        return pd.DataFrame(columns=empty_columns).set_index('Date')
+    start_day, end_day = _day_bounds(start, end)
+    
+    table_name = f"kline_{period}"
+    conditions = ["k.TickerId = (SELECT TickerId FROM symbols WHERE Ticker = ?)"]
+    params = [ticker]
+    if start_day is not None:
+        conditions.append("k.Day >= ?")
+        params.append(start_day)
+    if end_day is not None:
+        conditions.append("k.Day <= ?")
+        params.append(end_day)
+    query = f"SELECT k.Day, k.Open, k.High, k.Low, k.Close, k.Volume FROM {table_name} k WHERE {' AND '.join(conditions)}"
+    if last_n is not None:
+        # 由最新往回取 N 筆，稍後再轉回時間順序
+        query += " ORDER BY k.Day DESC LIMIT ?"
+        params.append(int(last_n))
+    else:
+        query += " ORDER BY k.Day ASC"
+    
+    with pooled_connection() as conn:
+        if period == 'daily' and use_snapshot:
+            df = _read_kline_snapshot(ticker, conn, start_day, end_day, last_n)
+            if df is not None:
+                return _join_indicators(conn, ticker, df) if with_indicators else df
+        df = pd.read_sql_query(query, conn, params=params)
+        if df.empty:
+            return pd.DataFrame(columns=empty_columns).set_index('Date')
+        if last_n is not None:
+            df = df.iloc[::-1].reset_index(drop=True)
+        df.insert(0, 'Ticker', ticker)
+        df.index = days_to_dates(df.pop('Day')).rename('Date')
+        return _join_indicators(conn, ticker, df) if with_indicators else df
+
+def get_klines(tickers, start=None, end=None, fields=None, last_n=None, with_indicators=False):
+    """
+    以單一查詢讀取多檔股票的K線，返回長格式 DataFrame（欄位 Date, Ticker, 各價量欄位）
+    
+    參數:
+    - tickers: 股票代號清單
+    - start / end: 日期範圍（含），格式 '%Y-%m-%d' 或 datetime，None 表示不限
+    - fields: 要讀取的欄位（預設 Open/High/Low/Close/Volume）
+    - last_n: 每檔股票只讀取範圍內最後 N 根K線，None 表示全部
+    - with_indicators: 一併讀取 indicators_daily 中預先計算的技術指標欄位（沒有的日期為 NaN）
+    """
+    fields = list(fields) if fields is not None else KLINE_COLUMNS[2:]
+    invalid = set(fields) - set(KLINE_COLUMNS[2:])
+    if invalid:
+        raise ValueError(f"Unknown K-line fields: {sorted(invalid)}")
+    
+    tickers = list(dict.fromkeys(tickers)) if last_n is None or last_n > 0 else []
+    start_day, end_day = _day_bounds(start, end)
+    conditions, bounds = [], []
+    if start_day is not None:
+        conditions.append("k.Day >= ?")
+        bounds.append(start_day)
+    if end_day is not None:
+        conditions.append("k.Day <= ?")
+        bounds.append(end_day)
+    if last_n is not None:
+        # 每檔股票以主鍵倒序找出第 N 新的 Day 作為下限，不掃描更早的資料；不足 N 筆時不設下限
+        cutoff = ["k2.TickerId = k.TickerId"] + [c.replace('k.', 'k2.') for c in conditions]
+        conditions.append(f"k.Day >= COALESCE((SELECT k2.Day FROM kline_daily k2 WHERE {' AND '.join(cutoff)} "
+                          f"ORDER BY k2.Day DESC LIMIT 1 OFFSET ?), k.Day)")
+        bounds = bounds * 2 + [int(last_n) - 1]
+    
+    columns = [f"k.{f}" for f in fields]
+    joins = "JOIN symbols s ON s.TickerId = k.TickerId"
+    if with_indicators:
+        columns += [f"i.{c}" for c in INDICATOR_COLUMNS]
+        joins += " LEFT JOIN indicators_daily i ON i.TickerId = k.TickerId AND i.Day = k.Day"
+        fields = fields + INDICATOR_COLUMNS
+    
+    frames = []
+    with pooled_connection() as conn:
+        # 分段查詢以避免超過 SQLite 的參數數量上限
+        for i in range(0, len(tickers), 500):
+            chunk = tickers[i:i + 500]
+            where = [f"s.Ticker IN ({','.join('?' * len(chunk))})"] + conditions
+            frames.append(pd.read_sql_query(
+                f"SELECT s.Ticker, k.Day, {', '.join(columns)} FROM kline_daily k {joins} "
+                f"WHERE {' AND '.join(where)} ORDER BY k.TickerId, k.Day",
+                conn, params=(*chunk, *bounds)
+            ))
+    
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Ticker', 'Day'] + fields)
+    df['Date'] = days_to_dates(df['Day'])
+    return df[['Date', 'Ticker'] + fields]
+
+def get_price_panel(tickers, fields='Close', start=None, end=None):
+    """
+    讀取多檔股票的寬格式價格面板（Date × Ticker）
+    
+    fields 為單一欄位名稱時返回 Date × Ticker 的 DataFrame；
+    為欄位清單時返回欄位為 (field, Ticker) MultiIndex 的 DataFrame。
+    """
+    single = isinstance(fields, str)
+    field_list = [fields] if single else list(fields)
+    long_df = get_klines(tickers, start=start, end=end, fields=field_list)
+    panel = long_df.pivot(index='Date', columns='Ticker', values=field_list)
+    panel = panel.reindex(columns=pd.MultiIndex.from_product([field_list, list(dict.fromkeys(tickers))]))
+    panel.columns.names = [None, 'Ticker']
+    return panel[fields] if single else panel
+
 def get_info(ticker):
     """從資料庫讀取公司基本資訊"""
-    conn = get_db_connection()
-    df = pd.read_sql_query(f"SELECT * FROM info WHERE Ticker = ?", conn, params=(ticker,))
-    conn.close()
+    with pooled_connection() as conn:
+        df = pd.read_sql_query(f"SELECT * FROM info WHERE Ticker = ?", conn, params=(ticker,))
     return df.iloc[0] if not df.empty else None
 
 def get_financials(ticker):
     """從資料庫讀取財報"""
-    conn = get_db_connection()
-    df = pd.read_sql_query(f"SELECT * FROM financials WHERE Ticker = ?", conn, params=(ticker,))
-    conn.close()
+    with pooled_connection() as conn:
+        df = pd.read_sql_query(f"SELECT * FROM financials WHERE Ticker = ?", conn, params=(ticker,))
     return df if not df.empty else pd.DataFrame()
\ No newline at end of file
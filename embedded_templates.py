@@ -268,6 +268,30 @@ STOCK_DETAIL_TEMPLATE = """
         </div>
     </div>
     
+    <div class="container">
+        <h2>歷史型態紀錄（最近{{ pattern_history|length }}筆）</h2>
+        {% if pattern_history %}
+            <table style="width: 100%; border-collapse: collapse;">
+                <tr style="text-align: left; border-bottom: 1px solid #ddd;">
+                    <th>型態名稱</th>
+                    <th>開始日期</th>
+                    <th>結束日期</th>
+                    <th>評分</th>
+                </tr>
+                {% for item in pattern_history %}
+                    <tr style="border-bottom: 1px solid #eee;{% if item.score > 0 %} color: #4CAF50;{% elif item.score < 0 %} color: #f44336;{% endif %}">
+                        <td>{{ item.pattern }}</td>
+                        <td>{{ item.start }}</td>
+                        <td>{{ item.end }}</td>
+                        <td>{% if item.score > 0 %}+{{ item.score }}{% else %}{{ item.score }}{% endif %}</td>
+                    </tr>
+                {% endfor %}
+            </table>
+        {% else %}
+            <p>尚無歷史型態紀錄，請確認資料庫是否已更新。</p>
+        {% endif %}
+    </div>
+    
     <script>
         // K線圖
         var klineData = {{ kline_json|safe }};
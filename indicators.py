@@ -0,0 +1,177 @@
+import sys
+from collections import deque
+
+import pandas as pd
+import pandas_ta as ta
+from database import INDICATOR_COLUMNS
+
+# EMA 沒有固定窗口，起始值的影響每根K線衰減 (1 - 2/(span+1)) 倍；
+# 暖身 250 根後 26 日 EMA 起始值的權重約 5e-9，計算結果與使用完整歷史相同
+EMA_WARMUP_BARS = 250
+
+# 各技術指標需要的最少K線數
+INDICATOR_LOOKBACK = {
+    'SMA_20': 20,
+    'SMA_60': 60,
+    'MACD_12_26_9': 26 + 9 + EMA_WARMUP_BARS,
+    'STOCHk_14_3_3': 14 + 3 + 3,
+}
+# 計算最新一根K線的全部指標需要的K線數
+INDICATOR_WARMUP_BARS = max(INDICATOR_LOOKBACK.values())
+
+def compute_indicators(kline_df):
+    """
+    以 pandas_ta 計算 SMA20/60、MACD 與 KD
+
+    返回與 kline_df 相同索引、欄位為 INDICATOR_COLUMNS 的 DataFrame；資料不足以計算的指標為 NaN。
+    """
+    df = kline_df[['Open', 'High', 'Low', 'Close', 'Volume']].copy()
+    df.ta.sma(length=20, append=True)
+    df.ta.sma(length=60, append=True)
+    df.ta.macd(append=True)
+    df.ta.stoch(append=True)
+    return df.reindex(columns=INDICATOR_COLUMNS)
+
+def has_indicators(kline_df):
+    """K線是否已帶有預先計算的指標欄位（例如由 indicators_daily 讀出）"""
+    if kline_df.empty or not set(INDICATOR_COLUMNS).issubset(kline_df.columns):
+        return False
+    # 有 20 根以上K線時最新一根至少有 SMA_20；全為 NaN 表示指標表尚未涵蓋最新的K線
+    return not kline_df[INDICATOR_COLUMNS].iloc[-1].isna().all()
+
+def add_indicators(kline_df):
+    """返回帶有指標欄位的 K 線；已有預先計算的指標時直接使用，否則即時計算"""
+    if has_indicators(kline_df):
+        return kline_df
+    df = kline_df.drop(columns=[c for c in INDICATOR_COLUMNS if c in kline_df.columns])
+    return pd.concat([df, compute_indicators(df)], axis=1)
+
+def _rolling_mean(window, length, value):
+    """將 value 加入 {'values', 'sum'} 滑動窗口，返回最近 length 個值的平均（不足時為 NaN）"""
+    window['values'].append(value)
+    window['sum'] += value
+    if len(window['values']) > length:
+        window['sum'] -= window['values'].popleft()
+    return window['sum'] / length if len(window['values']) == length else float('nan')
+
+def _ema(ema, length, value):
+    """
+    與 pandas_ta 相同的 EMA：前 length 個值的平均作為起始值，之後以 alpha = 2 / (length + 1) 遞推
+    起始值之前返回 NaN
+    """
+    ema['count'] += 1
+    if ema['count'] < length:
+        ema['value'] += value
+        return float('nan')
+    if ema['count'] == length:
+        ema['value'] = (ema['value'] + value) / length
+    else:
+        alpha = 2 / (length + 1)
+        ema['value'] = alpha * value + (1 - alpha) * ema['value']
+    return ema['value']
+
+def _rolling_extreme(window, length, bar, value, keep):
+    """
+    單調佇列：加入第 bar 根的 value，返回最近 length 根的極值
+    keep(a, b) 為 True 表示較舊的 a 在 b 加入後仍可能成為極值（最高價用 >、最低價用 <）
+    """
+    while window and not keep(window[-1][1], value):
+        window.pop()
+    window.append((bar, value))
+    if window[0][0] <= bar - length:
+        window.popleft()
+    return window[0][1]
+
+class IndicatorState:
+    """
+    技術指標的串流計算狀態：每加入一根K線以固定時間更新 SMA20/60、MACD 與 KD，不需重算歷史
+
+    保存移動平均的滑動窗口與累計和、EMA 目前的值，以及 KD 最高價／最低價的單調佇列；
+    to_dict / from_dict 用於保存到資料庫（見 database.get_indicator_state）。
+    第一根K線開始串流時結果與 compute_indicators 相同；從任意位置開始時 MACD 需經過 EMA_WARMUP_BARS 根暖身。
+    盤中報價等暫時性的K線可以在 copy() 上更新，不影響保存的狀態。
+    """
+
+    def __init__(self):
+        self.bars = 0
+        self.sma = {length: {'values': deque(), 'sum': 0.0} for length in (20, 60)}
+        self.ema = {length: {'count': 0, 'value': 0.0} for length in (12, 26)}
+        self.signal = {'count': 0, 'value': 0.0}
+        self.highs = deque()
+        self.lows = deque()
+        self.stoch = {'values': deque(), 'sum': 0.0}
+        self.stoch_k = {'values': deque(), 'sum': 0.0}
+
+    def update(self, high, low, close):
+        """加入下一根K線，返回該K線的指標值（依 INDICATOR_COLUMNS 順序的 tuple，資料不足為 NaN）"""
+        nan = float('nan')
+        bar = self.bars
+        self.bars += 1
+
+        sma_20 = _rolling_mean(self.sma[20], 20, close)
+        sma_60 = _rolling_mean(self.sma[60], 60, close)
+
+        fast = _ema(self.ema[12], 12, close)
+        slow = _ema(self.ema[26], 26, close)
+        macd = macd_signal = nan
+        if self.ema[26]['count'] >= 26:
+            macd = fast - slow
+            macd_signal = _ema(self.signal, 9, macd)
+
+        highest = _rolling_extreme(self.highs, 14, bar, high, lambda a, b: a > b)
+        lowest = _rolling_extreme(self.lows, 14, bar, low, lambda a, b: a < b)
+        stoch_k = stoch_d = nan
+        if self.bars >= 14:
+            # 與 pandas_ta 的 non_zero_range 相同，區間為 0 時以極小值代替
+            price_range = highest - lowest or sys.float_info.epsilon
+            stoch_k = _rolling_mean(self.stoch, 3, 100 * (close - lowest) / price_range)
+            if stoch_k == stoch_k:
+                stoch_d = _rolling_mean(self.stoch_k, 3, stoch_k)
+
+        return sma_20, sma_60, macd, macd - macd_signal, macd_signal, stoch_k, stoch_d
+
+    def copy(self):
+        return IndicatorState.from_dict(self.to_dict())
+
+    def to_dict(self):
+        """可序列化為 JSON 的狀態"""
+        def window(w):
+            return {'values': list(w['values']), 'sum': w['sum']}
+        return {
+            'bars': self.bars,
+            'sma': {str(length): window(w) for length, w in self.sma.items()},
+            'ema': {str(length): dict(e) for length, e in self.ema.items()},
+            'signal': dict(self.signal),
+            'highs': [list(item) for item in self.highs],
+            'lows': [list(item) for item in self.lows],
+            'stoch': window(self.stoch),
+            'stoch_k': window(self.stoch_k),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        def window(w):
+            return {'values': deque(w['values']), 'sum': w['sum']}
+        state = cls()
+        state.bars = data['bars']
+        state.sma = {int(length): window(w) for length, w in data['sma'].items()}
+        state.ema = {int(length): dict(e) for length, e in data['ema'].items()}
+        state.signal = dict(data['signal'])
+        state.highs = deque(tuple(item) for item in data['highs'])
+        state.lows = deque(tuple(item) for item in data['lows'])
+        state.stoch = window(data['stoch'])
+        state.stoch_k = window(data['stoch_k'])
+        return state
+
+def stream_indicators(kline_df, state=None):
+    """
+    依序以 IndicatorState 逐根更新 kline_df 的K線
+
+    返回 (與 kline_df 相同索引、欄位為 INDICATOR_COLUMNS 的 DataFrame, 更新後的狀態)；
+    state 為 None 時從空的狀態開始，傳入的 state 會被直接更新。
+    """
+    state = state if state is not None else IndicatorState()
+    rows = [state.update(h, l, c) for h, l, c in zip(kline_df['High'].astype(float).tolist(),
+                                                     kline_df['Low'].astype(float).tolist(),
+                                                     kline_df['Close'].astype(float).tolist())]
+    return pd.DataFrame(rows, index=kline_df.index, columns=INDICATOR_COLUMNS), state
@@ -0,0 +1,127 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """
+    執行緒安全的 token bucket 限速器
+
+    參數:
+    - rate: 每秒補充的 token 數（即長期平均請求速率）
+    - capacity: bucket 容量（允許的瞬間突發請求數）
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，必要時阻塞等待，返回等待的秒數"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """被限流時暫停所有執行緒的請求一段時間"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+class FetchStats:
+    """累計對外請求的次數、重試與限流事件，用於調整請求速率"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清除所有計數"""
+        with self._lock:
+            self.calls = 0
+            self.retries = 0
+            self.throttled = 0
+            self.failures = 0
+            self.wait_seconds = 0.0
+
+    def record(self, **counts):
+        """累加指定的計數，例如 record(calls=1, retries=1)"""
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        """返回目前計數的 dict"""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'failures': self.failures,
+                'wait_seconds': round(self.wait_seconds, 1),
+            }
+
+stats = FetchStats()
+_bucket = None
+_bucket_lock = threading.Lock()
+
+def get_rate_limiter():
+    """取得全域共用的限速器（依 config 設定建立）"""
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            from config import RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST
+            _bucket = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+        return _bucket
+
+def is_throttle_error(error):
+    """判斷例外是否為資料來源的限流回應（HTTP 429 / Too Many Requests）"""
+    message = str(error).lower()
+    return ('ratelimit' in type(error).__name__.lower() or
+            '429' in message or 'too many requests' in message or 'rate limit' in message)
+
+def call_with_retry(func, description):
+    """
+    透過全域限速器呼叫 func，失敗時以 jitter 指數退避重試
+
+    每次嘗試前都會向限速器取得 token；遇到限流錯誤時額外暫停所有執行緒的請求。
+    超過 config.RETRY_MAX_ATTEMPTS 次仍失敗時拋出最後一次的例外。
+    """
+    from config import RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+    bucket = get_rate_limiter()
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        waited = bucket.acquire()
+        stats.record(calls=1, wait_seconds=waited)
+        try:
+            return func()
+        except Exception as e:
+            throttled = is_throttle_error(e)
+            if throttled:
+                stats.record(throttled=1)
+            if attempt == RETRY_MAX_ATTEMPTS - 1:
+                stats.record(failures=1)
+                raise
+            # full jitter: 在 [0, base * 2^attempt] 之間隨機等待
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if throttled:
+                bucket.pause(delay)
+            stats.record(retries=1)
+            logger.warning(f"{description} failed ({'throttled' if throttled else str(e)}), "
+                           f"retry {attempt + 1}/{RETRY_MAX_ATTEMPTS - 1} in {delay:.1f}s")
+            time.sleep(delay)
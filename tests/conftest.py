@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模組位於專案根目錄（平面結構），讓測試可以直接 import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('pandas_ta')
+pytest.importorskip('flask')
+
+import app as app_module
+import config
+import data_fetcher
+import database
+from data_providers import SyntheticProvider
+from trend_pattern_analysis import scan_multiscale_patterns
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'stock_data.db'))
+    database.init_db()
+    app_module.app.config['TESTING'] = True
+    with app_module.app.test_client() as client:
+        yield client
+    database.close_pooled_connections()
+
+@pytest.mark.parametrize('query', ['start=garbage', 'end=2025-13-01', 'start=', 'start=2025-02-01&end=2025-01-01'])
+def test_pattern_timeline_rejects_bad_dates(client, query):
+    response = client.get(f'/api/pattern_timeline/AAA?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+@pytest.mark.parametrize('query', ['', 'start=2025-01-01', 'start=2025-01-01&end=2025-03-31'])
+def test_pattern_timeline_accepts_dates(client, query):
+    response = client.get(f'/api/pattern_timeline/AAA?{query}')
+    assert response.status_code == 200
+    assert response.get_json() == []
+
+@pytest.fixture
+def stored_client(client, monkeypatch):
+    monkeypatch.setattr(config, 'TICKERS', {'AAA': 'AAA'})
+    monkeypatch.setattr(config, 'FETCH_PARALLEL', False)
+    data_fetcher.fetch_and_store_all_data(provider=SyntheticProvider(years=2, end='2025-06-30'))
+    return client
+
+def test_multiscale_patterns_scans_every_order(stored_client):
+    kline = database.get_kline('AAA')[['Open', 'High', 'Low', 'Close', 'Volume']].astype(float)
+    expected = scan_multiscale_patterns(kline)
+    response = stored_client.get('/api/multiscale_patterns/AAA')
+    assert response.status_code == 200
+    rows = response.get_json()
+    assert [(row['order'], row['end'], row['pattern']) for row in rows] == \
+        [(order, end.strftime('%Y-%m-%d'), name) for order, end, name in
+         zip(expected['Order'], expected['End'], expected['Pattern'])]
+    assert len({row['order'] for row in rows}) > 1
+
+def test_multiscale_patterns_filters(stored_client):
+    rows = stored_client.get('/api/multiscale_patterns/AAA?order=5&start=2025-01-01').get_json()
+    assert rows and all(row['order'] == 5 and row['end'] >= '2025-01-01' for row in rows)
+
+@pytest.mark.parametrize('query', ['order=1', 'order=abc', 'order=21', 'end=garbage'])
+def test_multiscale_patterns_rejects_bad_arguments(client, query):
+    assert client.get(f'/api/multiscale_patterns/AAA?{query}').status_code == 400
+
+@pytest.mark.parametrize('embedded', [False, True], ids=['templates', 'embedded'])
+def test_stock_detail_shows_pattern_history(stored_client, monkeypatch, embedded):
+    if embedded:
+        import embedded_templates
+        monkeypatch.setattr(app_module, 'USE_EMBEDDED_TEMPLATES', True)
+        monkeypatch.setattr(app_module, 'STOCK_DETAIL_TEMPLATE', embedded_templates.STOCK_DETAIL_TEMPLATE,
+                            raising=False)
+    html = stored_client.get('/stock/AAA').get_data(as_text=True)
+    latest = database.get_pattern_timeline('AAA').iloc[-1]
+    assert '歷史型態紀錄' in html
+    assert latest['End'].strftime('%Y-%m-%d') in html
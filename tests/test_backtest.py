@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+import backtest
+import config
+import data_fetcher
+import database
+from analysis_engine import generate_comprehensive_conclusion_with_patterns
+from data_providers import SyntheticProvider
+from indicators import add_indicators
+
+def _kline(ticker, smooth):
+    df = SyntheticProvider(years=3, end='2025-06-30').history(ticker)[['Open', 'High', 'Low', 'Close', 'Volume']]
+    if smooth:
+        # 平滑後趨勢型態較常出現
+        df = df.copy()
+        df[['Open', 'High', 'Low', 'Close']] = df[['Open', 'High', 'Low', 'Close']].rolling(7, min_periods=1).mean()
+    return df
+
+@pytest.mark.parametrize('ticker, smooth', [('T0', False), ('T1', True), ('T2', False), ('T3', True)])
+def test_score_series_matches_live_conclusion(ticker, smooth):
+    df = _kline(ticker, smooth)
+    frame = add_indicators(df)
+    scores = backtest.compute_score_series(df)
+    assert scores.index[0] == df.index[backtest.FIRST_SCORED_BAR]
+    rng = np.random.default_rng(0)
+    for t in rng.choice(np.arange(backtest.FIRST_SCORED_BAR, len(df)), 30, replace=False):
+        live = generate_comprehensive_conclusion_with_patterns(frame.iloc[:t + 1], {})
+        row = scores.loc[df.index[t]]
+        assert (live['buy_score'], live['sell_score'], live['class']) == \
+            (round(row['BuyScore'], 1), round(row['SellScore'], 1), row['Conclusion']), df.index[t]
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'stock_data.db'))
+    monkeypatch.setattr(config, 'TICKERS', {'S1': 'S1', 'S2': 'S2', 'S3': 'S3'})
+    monkeypatch.setattr(config, 'FETCH_PARALLEL', False)
+    database.init_db()
+    data_fetcher.fetch_and_store_all_data(provider=SyntheticProvider(years=2, end='2025-06-30'))
+    yield
+    database.close_pooled_connections()
+
+def test_run_backtest_single_process(tmp_db):
+    horizons = (5, 20)
+    stats = backtest.run_backtest(horizons=horizons, processes=1)
+
+    # 各結論類別的統計等於逐檔計算分數與未來報酬後的合計
+    days, sums, counts = {}, {h: {} for h in horizons}, {h: {} for h in horizons}
+    for ticker in config.TICKERS:
+        kline = database.get_kline(ticker, with_indicators=True)
+        scores = backtest.compute_score_series(kline, timeline=database.get_pattern_timeline(ticker))
+        returns = backtest.forward_returns(kline['Close'].to_numpy(), horizons)
+        for name, group in scores.groupby('Conclusion'):
+            positions = kline.index.get_indexer(group.index)
+            days[name] = days.get(name, 0) + len(group)
+            for h in horizons:
+                r = returns[h][positions]
+                r = r[~np.isnan(r)]
+                sums[h][name] = sums[h].get(name, 0) + r.sum()
+                counts[h][name] = counts[h].get(name, 0) + len(r)
+
+    for name, count in days.items():
+        row = stats.loc[('conclusion', name)]
+        assert row['Days'] == count
+        for h in horizons:
+            assert row[f'MeanReturn_{h}'] == pytest.approx(sums[h][name] / counts[h][name])
+    assert stats.loc['conclusion', 'Days'].sum() == sum(days.values())
+    assert 'pattern' in stats.index.get_level_values(0)
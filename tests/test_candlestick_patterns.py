@@ -0,0 +1,103 @@
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+from analysis_engine import analyze_kline
+from candlestick_patterns import REPORT_OFFSET, scan_candlestick_patterns
+from data_providers import SyntheticProvider
+
+BUY, SELL = ('買進訊號', 1), ('賣出訊號', -1)
+
+def legacy_signals(df, start_index):
+    """
+    原本 analyze_kline 的逐根K線判斷（向量化前的實作），作為比對基準
+
+    依K線順序、同一根K線內依原本的判斷順序返回 (位置, 型態, 類型, 建議, 分數)。
+    """
+    hits = []
+    for i in range(start_index, len(df)):
+        last, prev, prev2 = df.iloc[i], df.iloc[i-1], df.iloc[i-2]
+        bars = lambda k: df.iloc[i-k]
+        checks = [
+            ('看漲吞噬', BUY, prev['Close'] < prev['Open'] and last['Close'] > last['Open'] and
+                last['Close'] > prev['Open'] and last['Open'] < prev['Close']),
+            ('刺透線', BUY, prev['Close'] < prev['Open'] and last['Close'] > last['Open'] and
+                last['Open'] < prev['Close'] and last['Close'] > (prev['Open'] + prev['Close']) / 2 and
+                last['Close'] < prev['Open']),
+            ('早晨之星', BUY, prev2['Close'] < prev2['Open'] and
+                abs(prev['Close'] - prev['Open']) < abs(prev2['Close'] - prev2['Open']) * 0.5 and
+                last['Close'] > last['Open'] and last['Close'] > prev2['Open']),
+            ('紅三兵', BUY, prev2['Close'] > prev2['Open'] and prev['Close'] > prev['Open'] and
+                last['Close'] > last['Open'] and prev2['Close'] > prev2['Open'] * 1.01 and
+                prev['Close'] > prev['Open'] * 1.01 and last['Close'] > last['Open'] * 1.01),
+            ('上升三法', BUY, i >= 5 and i >= start_index + 2 and
+                bars(4)['Close'] > bars(4)['Open'] and bars(3)['Close'] < bars(3)['Open'] and
+                bars(2)['Close'] < bars(2)['Open'] and bars(1)['Close'] < bars(1)['Open'] and
+                last['Close'] > last['Open'] and last['Close'] > bars(4)['Close']),
+            ('三內升勢', BUY, prev2['Close'] < prev2['Open'] and prev['Close'] > prev['Open'] and
+                prev['Open'] > prev2['Close'] and prev['Close'] < prev2['Open'] and
+                last['Close'] > last['Open'] and last['Close'] > prev2['Open']),
+            ('夾陽線', BUY, prev['Close'] < prev['Open'] and last['Close'] > last['Open'] and
+                last['Open'] > prev['Close'] and last['Close'] < prev['Open']),
+            ('三空白', BUY, i >= 3 and prev2['Close'] > prev2['Open'] and prev['Close'] > prev['Open'] and
+                prev['Open'] > prev2['Close'] and last['Close'] > last['Open'] and last['Open'] > prev['Close']),
+            ('看跌吞噬', SELL, prev['Close'] > prev['Open'] and last['Close'] < last['Open'] and
+                last['Close'] < prev['Open'] and last['Open'] > prev['Close']),
+            ('烏雲蓋頂', SELL, prev['Close'] > prev['Open'] and last['Close'] < last['Open'] and
+                last['Open'] > prev['Close'] and last['Close'] < (prev['Open'] + prev['Close']) / 2 and
+                last['Close'] > prev['Open']),
+            ('黃昏之星', SELL, prev2['Close'] > prev2['Open'] and
+                abs(prev['Close'] - prev['Open']) < abs(prev2['Close'] - prev2['Open']) * 0.5 and
+                last['Close'] < last['Open'] and last['Close'] < prev2['Open']),
+            ('黑三鴉', SELL, prev2['Close'] < prev2['Open'] and prev['Close'] < prev['Open'] and
+                last['Close'] < last['Open'] and prev2['Close'] < prev2['Open'] * 0.99 and
+                prev['Close'] < prev['Open'] * 0.99 and last['Close'] < last['Open'] * 0.99),
+            ('下降三法', SELL, i >= 5 and i >= start_index + 2 and
+                bars(4)['Close'] < bars(4)['Open'] and bars(3)['Close'] > bars(3)['Open'] and
+                bars(2)['Close'] > bars(2)['Open'] and bars(1)['Close'] > bars(1)['Open'] and
+                last['Close'] < last['Open'] and last['Close'] < bars(4)['Close']),
+            ('三內下降勢', SELL, prev2['Close'] > prev2['Open'] and prev['Close'] < prev['Open'] and
+                prev['Open'] < prev2['Close'] and prev['Close'] > prev2['Open'] and
+                last['Close'] < last['Open'] and last['Close'] < prev2['Open']),
+            ('夾陰線', SELL, prev['Close'] > prev['Open'] and last['Close'] < last['Open'] and
+                last['Open'] < prev['Close'] and last['Close'] > prev['Open']),
+            ('三空黑', SELL, i >= 3 and prev2['Close'] < prev2['Open'] and prev['Close'] < prev['Open'] and
+                prev['Open'] < prev2['Close'] and last['Close'] < last['Open'] and last['Open'] < prev['Close']),
+        ]
+        for name, (recommendation, score), hit in checks:
+            if hit:
+                hits.append((i, name, 'K-Line', recommendation, score))
+        if i > 1 and last['Close'] > df['High'].iloc[i-2:i].max() and last['Volume'] > df['Volume'].iloc[i-1]:
+            hits.append((i, '價格突破前高', 'Breakout', '買進訊號', 1))
+    return hits
+
+def _frames():
+    provider = SyntheticProvider(years=1, end='2025-06-30')
+    for ticker in ('AAA', 'BBB', 'CCC'):
+        df = provider.history(ticker)[['Open', 'High', 'Low', 'Close', 'Volume']]
+        yield pytest.param(df, id=ticker)
+        # 價格取整後常出現相等的開收盤，檢查嚴格不等式的邊界
+        yield pytest.param(df.round(0), id=f'{ticker}-rounded')
+
+FRAMES = list(_frames())
+
+@pytest.mark.parametrize('df', FRAMES)
+def test_scan_matches_legacy_loop(df):
+    start_index = 3
+    table = scan_candlestick_patterns(df)
+    table = table[table['Bar'] >= start_index + table['Pattern'].map(REPORT_OFFSET).fillna(0)]
+    rows = list(zip(table['Bar'], table['Pattern'], table['Type'], table['Recommendation'], table['Score']))
+    assert rows == legacy_signals(df, start_index)
+    assert (table['Date'] == df.index[table['Bar']]).all()
+
+@pytest.mark.parametrize('df', FRAMES)
+@pytest.mark.parametrize('end', [60, 61, 100, 180, 252])
+def test_analyze_kline_matches_legacy_loop(df, end):
+    """analyze_kline 以 (日期, 型態) 為鍵保留同一根K線的所有型態，取最近 5 筆（同一根K線依宣告順序）"""
+    df = df.iloc[:end]
+    hits = legacy_signals(df, max(3, len(df) - 15))
+    recent = sorted(hits, key=lambda hit: hit[0], reverse=True)[:5]
+    expected = [((df.index[i], name), {'type': type, 'signal': name, 'recommendation': recommendation,
+                                       'score': score, 'date': df.index[i].strftime('%Y-%m-%d')})
+                for i, name, type, recommendation, score in recent]
+    assert list(analyze_kline(df).items()) == expected
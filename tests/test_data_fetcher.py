@@ -0,0 +1,135 @@
+import logging
+import re
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+import config
+import data_fetcher
+import database
+from data_providers import SyntheticProvider
+from database import INDICATOR_COLUMNS
+from indicators import compute_indicators
+from trend_pattern_analysis import TIMELINE_WARMUP_BARS, scan_pattern_timeline
+
+TICKERS = {'S1': 'S1', 'S2': 'S2'}
+
+class NoNewBarsProvider(SyntheticProvider):
+    """增量抓取（指定 start）時不回傳任何K線"""
+
+    def history(self, ticker, period="5y", start=None):
+        df = super().history(ticker, period)
+        return df.iloc[:0] if start is not None else df
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'stock_data.db'))
+    monkeypatch.setattr(config, 'TICKERS', TICKERS)
+    monkeypatch.setattr(config, 'FETCH_PARALLEL', False)
+    database.init_db()
+    yield
+    database.close_pooled_connections()
+
+def _stored(ticker):
+    kline = database.get_kline(ticker, use_snapshot=False, with_indicators=True)
+    return kline, database.get_indicator_state(ticker), database.get_pattern_timeline(ticker)
+
+def test_incremental_fetch_without_new_bars_keeps_stored_data(tmp_db, monkeypatch):
+    provider = NoNewBarsProvider(years=2, end='2025-06-30')
+    data_fetcher.fetch_and_store_all_data(provider=provider)
+    before = {ticker: _stored(ticker) for ticker in TICKERS}
+
+    monkeypatch.setitem(config.DATASET_TTL_HOURS, 'kline', 0)
+    data_fetcher.fetch_and_store_all_data(provider=provider)
+
+    for ticker, (kline, state, timeline) in before.items():
+        after_kline, after_state, after_timeline = _stored(ticker)
+        assert kline['SMA_60'].notna().sum() > 0
+        pd.testing.assert_frame_equal(after_kline, kline)
+        assert after_state == state
+        pd.testing.assert_frame_equal(after_timeline, timeline)
+
+class PrefixProvider(SyntheticProvider):
+    """只提供到 cut 為止的K線，模擬逐日增加的資料"""
+
+    def __init__(self, cut):
+        super().__init__(years=2, end='2025-06-30')
+        self.cut = pd.Timestamp(cut)
+
+    def history(self, ticker, period="5y", start=None):
+        df = super().history(ticker, period, start)
+        return df[df.index <= self.cut]
+
+# 暖身 40 根時，2024-09-10 的增量更新中有從暖身K線第一根之前就已開始的型態，需以完整歷史重新掃描
+@pytest.mark.parametrize('warmup', [TIMELINE_WARMUP_BARS, 40])
+def test_incremental_timeline_matches_full_scan(tmp_db, monkeypatch, warmup):
+    monkeypatch.setattr(data_fetcher, 'TIMELINE_WARMUP_BARS', warmup)
+    data_fetcher.fetch_and_store_all_data(provider=PrefixProvider('2024-09-09'))
+    monkeypatch.setitem(config.DATASET_TTL_HOURS, 'kline', 0)
+    for cut in ('2024-09-10', '2024-09-11', '2025-04-15', '2025-06-30'):
+        data_fetcher.fetch_and_store_all_data(provider=PrefixProvider(cut))
+
+    for ticker in TICKERS:
+        kline = database.get_kline(ticker, use_snapshot=False)
+        expected = scan_pattern_timeline(kline[['Open', 'High', 'Low', 'Close', 'Volume']].astype(float))
+        stored = database.get_pattern_timeline(ticker)
+        key = lambda df: sorted(zip(df['Start'], df['End'], df['Pattern'], df['Score'].astype(int)))
+        assert key(stored) == key(expected)
+
+class RevisedBarProvider(PrefixProvider):
+    """第 revised 根（由 cut 往前數，1 為最後一根）的收盤價高 1%，模擬盤中抓取或之後被更正的K線；記錄是否完整重抓"""
+
+    def __init__(self, cut, revised=None):
+        super().__init__(cut)
+        self.revised = revised
+        self.full_reloads = 0
+
+    def history(self, ticker, period="5y", start=None):
+        df = super().history(ticker, period)
+        if self.revised is not None:
+            df = df.copy()
+            df.loc[df.index[-self.revised], 'Close'] *= 1.01
+        if start is None:
+            self.full_reloads += 1
+        else:
+            df = df[df.index >= pd.Timestamp(start)]
+        return df
+
+@pytest.mark.parametrize('revised, full_reloads', [(1, 0), (2, len(TICKERS))])
+def test_revised_last_bar_does_not_trigger_full_reload(tmp_db, monkeypatch, revised, full_reloads):
+    data_fetcher.fetch_and_store_all_data(provider=RevisedBarProvider('2025-03-31', revised=revised))
+    monkeypatch.setitem(config.DATASET_TTL_HOURS, 'kline', 0)
+    provider = RevisedBarProvider('2025-04-15')
+    data_fetcher.fetch_and_store_all_data(provider=provider)
+
+    # 只有最後一根變動時增量更新並覆蓋該K線；更早的重疊K線變動表示歷史調整，完整重抓
+    assert provider.full_reloads == full_reloads
+    for ticker in TICKERS:
+        kline = database.get_kline(ticker, use_snapshot=False, with_indicators=True)
+        expected = provider.history(ticker)
+        expected.index = expected.index.as_unit(kline.index.unit)
+        pd.testing.assert_series_equal(kline['Close'], expected['Close'], check_names=False, check_freq=False)
+        pd.testing.assert_frame_equal(kline[INDICATOR_COLUMNS], compute_indicators(expected)[INDICATOR_COLUMNS],
+                                      check_freq=False, rtol=1e-6)
+
+class SlowDownloadProvider(SyntheticProvider):
+    """批次下載K線需要 delay 秒"""
+
+    def __init__(self, delay):
+        super().__init__(years=2, end='2025-06-30')
+        self.delay = delay
+
+    def download(self, symbols, period=None, start=None):
+        time.sleep(self.delay)
+        return super().download(symbols, period, start)
+
+def test_summary_counts_batched_download_in_sequential_time(tmp_db, caplog):
+    caplog.set_level(logging.INFO, logger='data_fetcher')
+    data_fetcher.fetch_and_store_all_data(provider=SlowDownloadProvider(0.5))
+    summary = next(record.getMessage() for record in caplog.records
+                   if record.getMessage().startswith('Data fetch process completed'))
+    sequential = float(re.search(r'estimated sequential ([\d.]+)s', summary).group(1))
+    assert sequential >= 0.5
@@ -0,0 +1,12 @@
+import os
+
+import config
+import data_providers
+
+def test_recorded_dir_is_relative_to_application_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('recorded', 'record'):
+        provider = data_providers.get_provider(name)
+        assert provider.directory == os.path.join(data_providers.application_path, config.RECORDED_DATA_DIR)
+    monkeypatch.setattr(config, 'RECORDED_DATA_DIR', str(tmp_path / 'responses'))
+    assert data_providers.get_provider('recorded').directory == str(tmp_path / 'responses')
@@ -0,0 +1,25 @@
+import os
+
+import database
+
+def test_kline_migration_vacuums_old_table(tmp_path, monkeypatch):
+    """遷移 3 重建K線表後執行 VACUUM，刪除舊表的空間歸還給檔案系統"""
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'stock_data.db'))
+    with monkeypatch.context() as m:
+        m.setattr(database, 'MIGRATIONS', database.MIGRATIONS[:2])
+        database.init_db()
+    conn = database.get_db_connection()
+    rows = [(f'T{t}', f'2020-01-{d:02d}', 1.0, 2.0, 0.5, 1.5, 100) for t in range(300) for d in range(1, 29)]
+    with conn:
+        conn.executemany("INSERT INTO kline_daily VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.close()
+    before = os.path.getsize(database.DB_FILE)
+
+    database.init_db()
+    conn = database.get_db_connection()
+    try:
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM kline_daily").fetchone()[0] == len(rows)
+    finally:
+        conn.close()
+    assert os.path.getsize(database.DB_FILE) < before
@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+from data_providers import SyntheticProvider
+from database import INDICATOR_COLUMNS
+from indicators import INDICATOR_WARMUP_BARS, IndicatorState, compute_indicators, stream_indicators
+
+def _kline(ticker='AAA', years=2):
+    df = SyntheticProvider(years=years, end='2025-06-30').history(ticker)
+    return df[['Open', 'High', 'Low', 'Close', 'Volume']].astype(float)
+
+def _flat_kline():
+    """中間一段K線的最高價、最低價與收盤價相同，KD 的最高最低區間為 0"""
+    df = _kline('BBB', years=1)
+    flat = df.index[100:130]
+    df.loc[flat, ['Open', 'High', 'Low', 'Close']] = df['Close'].iloc[99]
+    return df
+
+def assert_indicators_close(actual, expected, rtol=1e-9):
+    assert list(actual.columns) == INDICATOR_COLUMNS
+    for column in INDICATOR_COLUMNS:
+        np.testing.assert_allclose(actual[column].to_numpy(), expected[column].to_numpy(),
+                                   rtol=rtol, atol=1e-9, equal_nan=True, err_msg=column)
+
+@pytest.mark.parametrize('df', [_kline(), _flat_kline()], ids=['synthetic', 'zero-range'])
+def test_stream_matches_compute_indicators(df):
+    streamed, state = stream_indicators(df)
+    assert state.bars == len(df)
+    assert_indicators_close(streamed, compute_indicators(df))
+
+def test_zero_range_stoch_is_finite():
+    df = _flat_kline()
+    streamed, _ = stream_indicators(df)
+    # 區間為 0 時 %K 為 0（收盤等於最低價），不是 NaN 或無限大
+    np.testing.assert_allclose(streamed['STOCHk_14_3_3'].iloc[120:130], 0, atol=1e-9)
+
+@pytest.mark.parametrize('split', [1, 13, 20, 59, 200, 400])
+def test_resume_from_serialized_state(split):
+    df = _kline()
+    head, state = stream_indicators(df.iloc[:split])
+    resumed = IndicatorState.from_dict(json.loads(json.dumps(state.to_dict())))
+    tail, resumed = stream_indicators(df.iloc[split:], resumed)
+    assert resumed.bars == len(df)
+    assert_indicators_close(pd.concat([head, tail]), compute_indicators(df))
+
+def test_copy_does_not_touch_saved_state():
+    df = _kline()
+    _, state = stream_indicators(df.iloc[:-1])
+    saved = state.to_dict()
+    stream_indicators(df.iloc[-1:], state.copy())
+    assert state.to_dict() == saved
+
+def test_warmup_tail_matches_full_history():
+    """從最近 INDICATOR_WARMUP_BARS 根開始串流時，最新一根的指標與使用完整歷史相同"""
+    df = _kline(years=3)
+    streamed, _ = stream_indicators(df.tail(INDICATOR_WARMUP_BARS))
+    assert_indicators_close(streamed.tail(1), compute_indicators(df).tail(1), rtol=1e-6)
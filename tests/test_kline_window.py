@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+from analysis_engine import (analyze_kline, generate_comprehensive_conclusion_with_patterns, plan_kline_window)
+from data_providers import SyntheticProvider
+from trend_pattern_analysis import analyze_trend_patterns
+
+ANALYZERS = [analyze_kline, analyze_trend_patterns, generate_comprehensive_conclusion_with_patterns]
+
+def _cases():
+    provider = SyntheticProvider(years=3, end='2025-06-30')
+    for ticker in ('AAA', 'BBB', 'CCC', 'DDD'):
+        df = provider.history(ticker)[['Open', 'High', 'Low', 'Close', 'Volume']]
+        for end in range(plan_kline_window(ANALYZERS) + 1, len(df) + 1, 40):
+            yield pytest.param(df.iloc[:end], id=f'{ticker}-{end}')
+
+@pytest.mark.parametrize('history', list(_cases()))
+@pytest.mark.parametrize('analyzer', ANALYZERS, ids=lambda f: f.__name__)
+def test_planned_window_matches_full_history(analyzer, history):
+    """只讀取 plan_kline_window 根K線的分析結果與使用完整歷史相同"""
+    window = history.tail(plan_kline_window([analyzer]))
+    if analyzer is generate_comprehensive_conclusion_with_patterns:
+        assert analyzer(window, {}) == analyzer(history, {})
+    else:
+        assert analyzer(window) == analyzer(history)
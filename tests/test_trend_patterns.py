@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pandas_ta')
+
+from data_providers import SyntheticProvider
+from scipy.signal import argrelextrema
+from scipy.stats import linregress
+from trend_pattern_analysis import (TIMELINE_WINDOWS, ExtremaIndex, MultiScaleExtrema, analyze_trend_patterns,
+                                    detect_flag_patterns, detect_rounded_patterns, detect_triangle_patterns,
+                                    detect_wedge_patterns, regression_from_sums, rolling_regression,
+                                    scan_flag_patterns, scan_head_and_shoulders, scan_multiscale_patterns,
+                                    scan_pattern_timeline, scan_rounded_patterns, scan_triangle_patterns,
+                                    scan_wedge_patterns, window_sums)
+
+def _kline(ticker):
+    df = SyntheticProvider(years=3, end='2025-06-30').history(ticker)
+    return df[['Open', 'High', 'Low', 'Close', 'Volume']].astype(float)
+
+@pytest.mark.parametrize('ticker', ['AAA', 'BBB', 'CCC'])
+def test_timeline_merges_consecutive_windows(ticker):
+    """時間軸中每段連續符合的窗口只有一列，展開後與逐窗口掃描的結果相同"""
+    df = _kline(ticker)
+    timeline = scan_pattern_timeline(df)
+    windows = scan_rounded_patterns(df)
+    for name in ('圓弧頂', '圓弧底'):
+        rows = timeline[timeline['Pattern'] == name]
+        first = df.index.get_indexer(rows['Start']) + TIMELINE_WINDOWS[name] - 1
+        last = df.index.get_indexer(rows['End'])
+        expanded = np.concatenate([np.arange(a, b + 1) for a, b in zip(first, last)] or [[]])
+        assert list(expanded) == list(windows.loc[windows['Pattern'] == name, 'Bar'])
+        # 相鄰兩列之間至少隔一個不符合的窗口
+        assert (first[1:] > last[:-1] + 1).all()
+
+def _noisy_series(seed, n=300):
+    """含平台（取整後的相等值）與 NaN 的隨機序列"""
+    rng = np.random.default_rng(seed)
+    values = np.round(np.cumsum(rng.normal(0, 1, n)), 0)
+    values[rng.choice(n, 5, replace=False)] = np.nan
+    return values
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('order', [1, 3, 7])
+@pytest.mark.parametrize('comparator', [np.greater, np.less], ids=['high', 'low'])
+@pytest.mark.parametrize('multiscale', [False, True], ids=['direct', 'multiscale'])
+def test_extrema_index_append_matches_rebuild(seed, order, comparator, multiscale):
+    values = _noisy_series(seed)
+    split = 40
+    if multiscale:
+        shared = MultiScaleExtrema(values[:split], comparator)
+        before = shared.values.copy()
+        index = shared.index(order)
+    else:
+        index = ExtremaIndex(values[:split], order, comparator)
+    for value in values[split:]:
+        index.append(value)
+    rebuilt = ExtremaIndex(values, order, comparator)
+    np.testing.assert_array_equal(index.left, rebuilt.left)
+    np.testing.assert_array_equal(index.right, rebuilt.right)
+    for start, end in [(0, len(values)), (0, 50), (37, 120), (200, 300), (250, 262)]:
+        np.testing.assert_array_equal(index.query(start, end), rebuilt.query(start, end))
+    if multiscale:
+        np.testing.assert_array_equal(shared.values, before)
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('comparator', [np.greater, np.less], ids=['high', 'low'])
+def test_multiscale_index_matches_argrelextrema(seed, comparator):
+    """每個 order 的 index(order).query 與對窗口切片呼叫 argrelextrema 相同（含水平段落、NaN 與窗口邊界）"""
+    rng = np.random.default_rng(seed)
+    # 四捨五入的隨機漫步有大量相等的相鄰值，且在較大的 order 仍有極值
+    values = np.round(np.cumsum(rng.normal(0, 1, 400)))
+    for start in rng.integers(0, 380, 6):
+        values[start:start + rng.integers(2, 12)] = values[start]
+    values[rng.choice(400, 8, replace=False)] = np.nan
+    multiscale = MultiScaleExtrema(values, comparator)
+    found = {}
+    windows = [(0, 400), (0, 1), (0, 3), (397, 400), (399, 400), (10, 10)]
+    windows += [tuple(sorted(rng.integers(0, 401, 2))) for _ in range(30)]
+    for order in range(2, 21):
+        index = multiscale.index(order)
+        for start, end in windows:
+            expected = argrelextrema(values[start:end], comparator, order=order)[0]
+            np.testing.assert_array_equal(index.query(start, end), expected, err_msg=f'{order} {start}:{end}')
+        found[order] = len(index.query())
+    assert sum(found[order] for order in range(10, 21)) > 0
+
+def _series_frames():
+    """隨機、平滑（較常出現型態）、含水平段落、三角形震盪與完全水平的K線"""
+    frames = {}
+    base = SyntheticProvider(years=2, end='2025-06-30').history('REG')[['Open', 'High', 'Low', 'Close', 'Volume']]
+    frames['random'] = base.astype(float)
+    smooth = frames['random'].copy()
+    smooth[['Open', 'High', 'Low', 'Close']] = smooth[['Open', 'High', 'Low', 'Close']].rolling(7, min_periods=1).mean()
+    frames['smooth'] = smooth
+    plateaus = frames['random'].copy()
+    for start in range(50, len(plateaus), 120):
+        plateaus.iloc[start:start + 25, :4] = plateaus.iloc[start, 3]
+    frames['plateaus'] = plateaus
+    # 觸頂價位固定、低點逐步墊高（後半段反之）的震盪，產生上升與下降三角形
+    t = np.arange(len(base))
+    wave = 0.5 + 0.5 * np.sin(2 * np.pi * t / 8)
+    squeeze = 0.08 * (t % 120)
+    ascending = (90 + squeeze) + (110 - 90 - squeeze) * wave
+    descending = 90 + (20 - squeeze) * wave
+    triangles = frames['random'].copy()
+    triangles.iloc[:, :4] = np.where(t < len(t) // 2, ascending, descending)[:, None]
+    frames['triangles'] = triangles
+    flat = frames['random'].copy()
+    flat.iloc[:, :4] = 100.0
+    frames['flat'] = flat
+    return frames
+
+SERIES = _series_frames()
+
+@pytest.mark.parametrize('name', SERIES)
+@pytest.mark.parametrize('window', [5, 20])
+def test_window_regression_matches_linregress(name, window):
+    y = SERIES[name]['Close'].to_numpy()[:200]
+    weights = (np.arange(len(y)) % 3 != 0).astype(float)
+    slope, intercept, residual_std = regression_from_sums(window_sums(np.arange(len(y)), y, window))
+    weighted_slope, _, _ = regression_from_sums(window_sums(np.arange(len(y)), y, window, weights))
+    for r in range(len(y) - window + 1):
+        x = np.arange(r, r + window)
+        fit = linregress(x, y[x])
+        assert slope[r] == pytest.approx(fit.slope, rel=1e-6, abs=1e-9)
+        assert intercept[r] == pytest.approx(fit.intercept, rel=1e-6, abs=1e-6)
+        # 殘差由累計和相減而得，水平窗口會留下與價格平方成比例的捨入誤差，因此比較變異數
+        residuals = y[x] - (fit.intercept + fit.slope * x)
+        assert residual_std[r] ** 2 == pytest.approx(np.mean(residuals ** 2), rel=1e-6,
+                                                     abs=1e-12 * np.mean(y[x] ** 2))
+        kept = x[weights[x] > 0]
+        assert weighted_slope[r] == pytest.approx(linregress(kept, y[kept]).slope, rel=1e-6, abs=1e-9)
+    rolled_slope, rolled_intercept, _ = rolling_regression(y, window)
+    for end in range(window - 1, len(y)):
+        fit = linregress(np.arange(window), y[end - window + 1:end + 1])
+        assert rolled_slope[end] == pytest.approx(fit.slope, rel=1e-6, abs=1e-9)
+        assert rolled_intercept[end] == pytest.approx(fit.intercept, rel=1e-6, abs=1e-6)
+    assert np.isnan(rolled_slope[:window - 1]).all()
+
+WINDOW_SCANS = [
+    (scan_triangle_patterns, detect_triangle_patterns, 20),
+    (scan_wedge_patterns, detect_wedge_patterns, 20),
+    (scan_flag_patterns, detect_flag_patterns, 20),
+    (scan_rounded_patterns, detect_rounded_patterns, 30),
+]
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('name', SERIES)
+@pytest.mark.parametrize('scan, detect, window', WINDOW_SCANS, ids=lambda v: getattr(v, '__name__', str(v)))
+def test_window_scan_matches_detector(name, scan, detect, window):
+    """滑動窗口掃描的每個窗口與對該窗口呼叫偵測函數的結果相同"""
+    df = SERIES[name]
+    windows = scan(df)
+    found = dict(zip(windows['Bar'], windows['Pattern']))
+    for end in range(window - 1, len(df)):
+        pattern, _, _ = detect(df.iloc[end - window + 1:end + 1])
+        assert found.get(end) == pattern, (end, df.index[end])
+
+def test_head_and_shoulders_is_disabled():
+    """頭肩型態已停用：不列入綜合分析、型態時間軸與多尺度掃描，但 scan_head_and_shoulders 仍可直接使用"""
+    df = _kline('HNS')
+    assert not scan_head_and_shoulders(df).empty
+    names = {'頭肩頂', '頭肩底'}
+    assert not names & set(analyze_trend_patterns(df))
+    assert not names & set(scan_pattern_timeline(df)['Pattern'])
+    assert not names & set(scan_multiscale_patterns(df)['Pattern'])
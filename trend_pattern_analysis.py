@@ -1,115 +1,422 @@
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.signal import argrelextrema
 from scipy.stats import linregress
+from analysis_context import AnalysisContext
+from database import PATTERN_TIMELINE_COLUMNS
 
-def find_local_extrema(df, order=5):
+# analyze_trend_patterns 預設只分析最近的K線數
+TREND_LOOKBACK_DAYS = 200
+
+class ExtremaIndex:
+    """
+    單一序列在固定 order 下的局部極值索引，可查詢任意窗口 [start, end) 內的極值
+
+    對每根K線記錄左右兩側最近的「阻擋者」（不小於它的值，最低價序列則為不大於）距離，
+    窗口內第 i 根為極值的條件是 start < i < end - 1，且窗口內距離 order 以內沒有阻擋者，
+    與對該窗口切片呼叫 argrelextrema 的結果相同。建立為 O(n * order)（由 MultiScaleExtrema.index 取得時為 O(n)），
+    append 新K線為 O(order)（陣列保存在容量倍增的緩衝區中，均攤後不需複製）。
+    """
+
+    def __init__(self, values, order, comparator=np.greater):
+        self.order = order
+        # 最低價以負值處理，統一為「嚴格大於」的比較
+        self.sign = 1.0 if comparator is np.greater else -1.0
+        values = self.sign * np.asarray(values, dtype=float)
+        n = len(values)
+        self.multiscale = None
+        self._store(values, np.full(n, order + 1), np.full(n, order + 1))
+        # 由遠到近更新，最後保留最近的阻擋距離；與 argrelextrema 相同，NaN 的比較視為不成立（即阻擋）
+        for k in range(min(order, n - 1), 0, -1):
+            self.left[k:][~(self.values[k:] > self.values[:n - k])] = k
+            self.right[:n - k][~(self.values[:n - k] > self.values[k:])] = k
+
+    @classmethod
+    def from_multiscale(cls, multiscale, order):
+        """由 MultiScaleExtrema 的阻擋距離直接取得 order 的索引（O(n)，不需重新比較）"""
+        index = cls.__new__(cls)
+        index.order = order
+        index.sign = multiscale.sign
+        index.multiscale = multiscale
+        index._store(multiscale.values, np.minimum(multiscale.left, order + 1),
+                     np.minimum(multiscale.right, order + 1))
+        return index
+
+    def _store(self, values, left, right):
+        """以 values / left / right 作為緩衝區，目前長度為全部"""
+        self._size = len(values)
+        self._values, self._left, self._right = values, left, right
+
+    @property
+    def values(self):
+        return self._values[:self._size]
+
+    @property
+    def left(self):
+        return self._left[:self._size]
+
+    @property
+    def right(self):
+        return self._right[:self._size]
+
+    def append(self, value):
+        """加入下一根K線，只更新新K線的左側距離與前 order 根的右側距離"""
+        value = self.sign * float(value)
+        n = self._size
+        if n == len(self._values):
+            # 緩衝區已滿時容量加倍（from_multiscale 共用的 values 也在此複製，不會修改 MultiScaleExtrema）
+            capacity = max(2 * n, 16)
+            self._values, self._left, self._right = (
+                np.concatenate((buffer[:n], np.empty(capacity - n, dtype=buffer.dtype)))
+                for buffer in (self._values, self._left, self._right))
+        left = self.order + 1
+        for k in range(1, min(self.order, n) + 1):
+            if not value > self._values[n - k]:
+                left = k
+                break
+        for k in range(1, min(self.order, n) + 1):
+            if not self._values[n - k] > value and self._right[n - k] > k:
+                self._right[n - k] = k
+        self._values[n], self._left[n], self._right[n] = value, left, self.order + 1
+        self._size = n + 1
+        # 新K線之後的區間極值不再由 MultiScaleExtrema 的稀疏表提供
+        self.multiscale = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def range_argmax(self, start, length):
+        """每個 start 的區間 [start, start + length) 內最大值（NaN 視為最大）的位置"""
+        if self.multiscale is not None:
+            return self.multiscale.range_argmax(start, length)
+        values = np.where(np.isnan(self.values), np.inf, self.values)
+        return start + sliding_window_view(values, length)[start].argmax(axis=1)
+
+    def query(self, start=0, end=None):
+        """返回窗口 [start, end) 內的極值位置（相對於 start）"""
+        end = len(self.values) if end is None else end
+        i = np.arange(start + 1, end - 1)
+        is_extremum = ((self.left[i] > np.minimum(self.order, i - start)) &
+                       (self.right[i] > np.minimum(self.order, end - 1 - i)))
+        return i[is_extremum] - start
+
+def _blocker_distances(values):
+    """
+    以單調堆疊一次計算每根K線左右兩側最近的阻擋者（不小於它的值）的距離，沒有阻擋者時為 len(values) + 1
+    與 argrelextrema 相同，NaN 的比較視為不成立：NaN 阻擋所有K線，本身也被相鄰的K線阻擋
+    """
+    n = len(values)
+    missing = np.isnan(values)
+    blocking = np.where(missing, np.inf, values).tolist()
+    left = [n + 1] * n
+    right = [n + 1] * n
+    stack = []
+    for i, value in enumerate(blocking):
+        while stack and blocking[stack[-1]] < value:
+            j = stack.pop()
+            right[j] = i - j
+        if stack:
+            j = stack[-1]
+            left[i] = i - j
+            if blocking[j] == value:
+                # 相同的值互相阻擋；之後的K線會先遇到較近的 i，j 可以移出堆疊
+                right[j] = i - j
+                stack.pop()
+        stack.append(i)
+    left, right = np.array(left), np.array(right)
+    left[1:][missing[1:]] = 1
+    right[:-1][missing[:-1]] = 1
+    return left, right
+
+class MultiScaleExtrema:
+    """
+    單一序列在所有 order 下的局部極值，一次計算、所有尺度共用
+
+    以單調堆疊記錄每根K線左右兩側最近阻擋者的實際距離（不限於某個 order），
+    第 i 根在 order k 為整段序列極值的條件即兩側距離都大於 k；index(order) 由距離直接取得該尺度的 ExtremaIndex。
+    另以 sparse table 查詢固定長度區間的最大值位置，供滑動窗口兩端放寬條件的極值使用。
+    建立為 O(n)，sparse table 依查詢的區間長度建立到 O(n log length)。
+    """
+
+    def __init__(self, values, comparator=np.greater):
+        self.sign = 1.0 if comparator is np.greater else -1.0
+        self.values = self.sign * np.asarray(values, dtype=float)
+        self.left, self.right = _blocker_distances(self.values)
+        # 每根K線為整段序列極值的最大 order（第一根與最後一根只有一側，不會是極值）
+        self.strength = np.minimum(self.left, self.right) - 1
+        self._blocking = np.where(np.isnan(self.values), np.inf, self.values)
+        self._argmax = [np.arange(len(self.values))]
+
+    def __len__(self):
+        return len(self.values)
+
+    def extrema(self, order):
+        """order 下整段序列的極值位置（與 argrelextrema 相同，只是兩端 order 根內的極值另有放寬條件，見 ExtremaIndex.query）"""
+        return np.flatnonzero(self.strength >= order)
+
+    def index(self, order):
+        return ExtremaIndex.from_multiscale(self, order)
+
+    def range_argmax(self, start, length):
+        """每個 start 的區間 [start, start + length) 內最大值（NaN 視為最大）的位置，以 sparse table O(1) 查詢"""
+        level = int(length).bit_length() - 1
+        while len(self._argmax) <= level:
+            width = 1 << (len(self._argmax) - 1)
+            previous = self._argmax[-1]
+            first, second = previous[:len(previous) - width], previous[width:]
+            self._argmax.append(np.where(self._blocking[first] >= self._blocking[second], first, second))
+        table = self._argmax[level]
+        first, second = table[start], table[start + length - (1 << level)]
+        return np.where(self._blocking[first] >= self._blocking[second], first, second)
+
+def get_multiscale_extrema(ctx, column):
+    """context 中 'high'（局部高點）或 'low'（局部低點）序列的 MultiScaleExtrema，同一個 context 只建立一次"""
+    comparator = np.greater if column == 'high' else np.less
+    return ctx.memoize(('multiscale_extrema', column),
+                       lambda: MultiScaleExtrema(getattr(ctx, column), comparator))
+
+def get_extrema_index(ctx, column, order):
+    """context 中 'high' 或 'low' 序列在 order 下的 ExtremaIndex，所有 order 共用同一個 MultiScaleExtrema"""
+    return ctx.memoize(('extrema', column, order), lambda: get_multiscale_extrema(ctx, column).index(order))
+
+def find_local_extrema(df, order=5, ctx=None):
     """
     尋找局部極值點（高點和低點）
     order: 用於判斷極值的窗口大小
+    ctx: df 為 ctx 中K線的最後一段時，改從共用的 ExtremaIndex 查詢，同一次分析只計算一次極值
+    返回的位置相對於 df
     """
+    start = len(ctx) - len(df) if ctx is not None else -1
+    if start >= 0 and len(df) and df.index[0] == ctx.kline_df.index[start] \
+            and df.index[-1] == ctx.kline_df.index[-1]:
+        highs = get_extrema_index(ctx, 'high', order).query(start)
+        lows = get_extrema_index(ctx, 'low', order).query(start)
+        return highs, lows
     highs = argrelextrema(df['High'].values, np.greater, order=order)[0]
     lows = argrelextrema(df['Low'].values, np.less, order=order)[0]
     return highs, lows
 
-def detect_head_and_shoulders(df, min_pattern_bars=20):
+def window_sums(x, y, window, weights=None):
+    """
+    所有長度 window 的滑動窗口內的 (點數, Σx, Σy, Σx², Σxy, Σy²)，以累計和一次計算（O(n)）
+    weights 為 0/1 陣列時只計入為 1 的點；返回 shape (6, n - window + 1)，第 r 欄為窗口 [r, r + window)
+    """
+    w = np.ones(len(y)) if weights is None else np.asarray(weights, dtype=float)
+    x = np.where(w > 0, np.asarray(x, dtype=float), 0.0)
+    y = np.where(w > 0, np.asarray(y, dtype=float), 0.0)
+    terms = np.vstack([w, w * x, w * y, w * x * x, w * x * y, w * y * y])
+    cumulative = np.concatenate([np.zeros((6, 1)), np.cumsum(terms, axis=1)], axis=1)
+    return cumulative[:, window:] - cumulative[:, :len(y) + 1 - window]
+
+def regression_from_sums(sums):
+    """
+    由 window_sums 的結果計算每個窗口的最小平方法直線
+    返回 (slope, intercept, residual_std)：intercept 為 x = 0 處的值，residual_std 為殘差的標準差（除以點數）；
+    點數不足兩點的窗口為 NaN
+    """
+    count, sx, sy, sxx, sxy, syy = sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sxx_c = sxx - sx * sx / count
+        sxy_c = sxy - sx * sy / count
+        syy_c = syy - sy * sy / count
+        slope = np.where((count >= 2) & (sxx_c > 0), sxy_c / sxx_c, np.nan)
+        # 累計和的捨入誤差會讓完全水平的點得到極小的斜率，小於平均價格 1e-9 倍的斜率視為 0
+        slope = np.where(np.abs(slope) <= 1e-9 * np.abs(sy / count), 0.0, slope)
+        intercept = (sy - slope * sx) / count
+        residual_std = np.sqrt(np.maximum(syy_c - slope * sxy_c, 0) / count)
+    return slope, intercept, residual_std
+
+def rolling_regression(y, window):
+    """
+    每根K線往前 window 根（含）的線性回歸，等同對每個窗口呼叫 linregress(range(window), y)
+    返回與 y 同長度的 (slope, intercept, residual_std)，intercept 為窗口第一根的回歸值；前 window - 1 根為 NaN
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    result = [np.full(n, np.nan) for _ in range(3)]
+    if n < window:
+        return tuple(result)
+    positions = np.arange(n)
+    slope, intercept, residual_std = regression_from_sums(window_sums(positions, y, window))
+    # x 為整段序列的位置，換算為以窗口第一根為 0
+    intercept = intercept + slope * positions[:n - window + 1]
+    for full, values in zip(result, (slope, intercept, residual_std)):
+        full[window - 1:] = values
+    return tuple(result)
+
+def _window_extrema_slope(index, window, rank=False):
+    """
+    所有長度 window 的窗口內局部極值的回歸斜率（極值與對窗口切片呼叫 find_local_extrema 相同）
+
+    窗口內距兩端 order 根以上的極值即整段序列的極值，以 window_sums 累計；
+    兩端 order 根以內各最多一個放寬條件的極值，以區間最大值位置一次補上所有窗口。
+    rank=True 時 x 為極值在窗口內的序號，否則為K線位置。
+    返回 (點數, 斜率)，第 r 個為窗口 [r, r + window)
+    """
+    order = index.order
+    n = len(index)
+    prices = index.sign * index.values
+    interior = (index.left > order) & (index.right > order)
+    before = np.cumsum(interior) - interior  # 每個位置之前的整段序列極值數
+    x = before if rank else np.arange(n)
+    start = np.arange(n - window + 1)
+    sums = window_sums(x, prices, window - 2 * order, interior)[:, start + order]
+
+    # 放寬條件的極值必為該端 order 根內的唯一最大值：以 range_argmax 取得候選，再檢查兩側的阻擋距離
+    left_edge = index.range_argmax(start, order)
+    right_edge = index.range_argmax(start + window - order, order)
+    for position, j, near, far, edge_x in (
+            (left_edge, left_edge - start, index.left, index.right, before[start + order] - 1),
+            (right_edge, start + window - 1 - right_edge, index.right, index.left, before[start + window - order])):
+        edge = (j > 0) & (near[position] > j) & (far[position] > order)
+        px = np.where(edge, edge_x if rank else position, 0.0)
+        py = np.where(edge, prices[position], 0.0)
+        sums = sums + np.vstack([edge, px, py, px * px, px * py, py * py])
+    return sums[0], regression_from_sums(sums)[0]
+
+# scan_head_and_shoulders 的欄位：Start / Head / End 為左肩、頭部、右肩的日期，Bar 為右肩的位置，
+# Level 為頭部價格，NecklineLeft / NecklineRight 為左肩與頭部、頭部與右肩之間的回檔低點（頭肩底為反彈高點）
+HEAD_AND_SHOULDERS_COLUMNS = ['Pattern', 'Score', 'Start', 'Head', 'End', 'Bar', 'Level',
+                              'NecklineLeft', 'NecklineRight']
+# scan_double_tops_bottoms 的欄位：Start / End 為兩個高點（低點）的日期，Bar 為第二個的位置，
+# Level 為第一個高點（低點）的價格，Neckline 為兩者之間的回檔低點（雙重底為反彈高點）
+DOUBLE_TOP_BOTTOM_COLUMNS = ['Pattern', 'Score', 'Start', 'End', 'Bar', 'Level', 'Neckline']
+
+def _date_str(date):
+    return date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else str(date)
+
+def _pattern_frame(columns, parts, df):
+    """將各型態的 {欄位: 陣列或單一值} 合併為依 Bar 排序的 DataFrame，日期欄位由位置轉為 df 的索引"""
+    sizes = [len(part['Bar']) for part in parts]
+    if not sum(sizes):
+        return pd.DataFrame(columns=columns)
+    order = np.argsort(np.concatenate([part['Bar'] for part in parts]), kind='stable')
+    data = {}
+    for column in columns:
+        values = np.concatenate([np.broadcast_to(part[column], size) for part, size in zip(parts, sizes)])[order]
+        data[column] = df.index[values] if column in ('Start', 'Head', 'End') else values
+    return pd.DataFrame(data, columns=columns)
+
+def scan_head_and_shoulders(df, order=3, tolerance=0.05, ctx=None):
+    """
+    找出 df 中所有的頭肩頂和頭肩底
+
+    以連續三個局部高點（低點）為左肩、頭部、右肩，一次檢查所有組合：頭部最高（最低）且兩肩差距小於頭部的 tolerance。
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
+    返回: 每個型態一列的 DataFrame（欄位見 HEAD_AND_SHOULDERS_COLUMNS），依右肩位置排序
+    """
+    return _pattern_frame(HEAD_AND_SHOULDERS_COLUMNS, _head_and_shoulders_parts(df, order, tolerance, ctx), df)
+
+def _head_and_shoulders_parts(df, order, tolerance, ctx):
+    """scan_head_and_shoulders 的各型態 {欄位: 陣列}（見 _pattern_frame）"""
+    high = df['High'].to_numpy(dtype=float)
+    low = df['Low'].to_numpy(dtype=float)
+    highs, lows = find_local_extrema(df, order=order, ctx=ctx)
+    
+    parts = []
+    for name, score, points, price, opposite, reduce in (('頭肩頂', -1, highs, high, low, np.minimum),
+                                                         ('頭肩底', 1, lows, low, high, np.maximum)):
+        if len(points) < 3:
+            continue
+        triples = sliding_window_view(points, 3)
+        left, head, right = price[triples].T
+        # 相鄰兩個極值之間的回檔低點（反彈高點），第 k 個為 [points[k], points[k+1]) 的範圍
+        between = reduce.reduceat(opposite, points)
+        if score < 0:
+            found = (head > left) & (head > right) & (np.abs(left - right) / head < tolerance)
+        else:
+            found = (head < left) & (head < right) & (np.abs(left - right) / np.abs(head) < tolerance)
+        k = np.flatnonzero(found)
+        parts.append({
+            'Pattern': name, 'Score': score,
+            'Start': triples[k, 0], 'Head': triples[k, 1], 'End': triples[k, 2], 'Bar': triples[k, 2],
+            'Level': head[k], 'NecklineLeft': between[k], 'NecklineRight': between[k + 1],
+        })
+    return parts
+
+def scan_double_tops_bottoms(df, order=3, tolerance=0.02, min_retrace=0.05, ctx=None):
+    """
+    找出 df 中所有的雙重頂和雙重底
+
+    一次檢查所有相鄰的兩個局部高點（低點）：兩者差距小於 tolerance，且中間的回檔（反彈）超過 min_retrace。
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
+    返回: 每個型態一列的 DataFrame（欄位見 DOUBLE_TOP_BOTTOM_COLUMNS），依第二個高點（低點）的位置排序
     """
-    偵測頭肩頂和頭肩底型態
+    return _pattern_frame(DOUBLE_TOP_BOTTOM_COLUMNS,
+                          _double_top_bottom_parts(df, order, tolerance, min_retrace, ctx), df)
+
+def _double_top_bottom_parts(df, order, tolerance, min_retrace, ctx):
+    """scan_double_tops_bottoms 的各型態 {欄位: 陣列}（見 _pattern_frame）"""
+    high = df['High'].to_numpy(dtype=float)
+    low = df['Low'].to_numpy(dtype=float)
+    highs, lows = find_local_extrema(df, order=order, ctx=ctx)
+    
+    parts = []
+    for name, score, points, price, opposite, reduce in (('雙重頂', -1, highs, high, low, np.minimum),
+                                                         ('雙重底', 1, lows, low, high, np.maximum)):
+        if len(points) < 2:
+            continue
+        first, second = price[points[:-1]], price[points[1:]]
+        between = reduce.reduceat(opposite, points)[:-1]
+        if score < 0:
+            found = ((np.abs(first - second) / np.maximum(first, second) < tolerance) &
+                     ((first - between) / first > min_retrace))
+        else:
+            found = ((np.abs(first - second) / np.minimum(first, second) < tolerance) &
+                     ((between - first) / first > min_retrace))
+        k = np.flatnonzero(found)
+        parts.append({
+            'Pattern': name, 'Score': score, 'Start': points[k], 'End': points[k + 1], 'Bar': points[k + 1],
+            'Level': first[k], 'Neckline': between[k],
+        })
+    return parts
+
+def detect_head_and_shoulders(df, min_pattern_bars=20, ctx=None):
+    """
+    偵測頭肩頂和頭肩底型態（已停用：一律不回報型態，也不列入 analyze_trend_patterns、型態時間軸與多尺度掃描）
+    原本的逐一檢查從超出極值陣列的位置開始而必定中斷，頭肩型態從未計入綜合評分；
+    計入評分會改變綜合結論與回測結果，需另行評估後再啟用。需要頭肩型態時直接使用 scan_head_and_shoulders。
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
     返回: (pattern_type, score, description)
     """
     if len(df) < min_pattern_bars:
         return None, 0, "資料長度不足以判斷頭肩型態"
     
-    highs, lows = find_local_extrema(df, order=3)
-    
-    # 頭肩頂檢測 - 只檢查最近的型態
-    if len(highs) >= 3:
-        # 從最近的高點開始往前檢查
-        for i in range(len(highs) - 2, -1, -1):
-            if highs[i+2] < len(df) - 10:  # 確保型態不是太久以前的
-                left_shoulder = df.iloc[highs[i]]['High']
-                head = df.iloc[highs[i+1]]['High']
-                right_shoulder = df.iloc[highs[i+2]]['High']
-                
-                # 頭肩頂條件：頭部最高，兩肩高度相近
-                if (head > left_shoulder and head > right_shoulder and
-                    abs(left_shoulder - right_shoulder) / head < 0.05):
-                    # 檢查時間是否在近期
-                    pattern_date = df.index[highs[i+1]]
-                    days_ago = (df.index[-1] - pattern_date).days if hasattr(df.index, 'date') else len(df) - highs[i+1]
-                    date_str = pattern_date.strftime('%Y-%m-%d') if hasattr(pattern_date, 'strftime') else str(pattern_date)
-                    return "頭肩頂", -1, f"在 {date_str} 形成頭肩頂，預示下跌"
-    
-    # 頭肩底檢測
-    if len(lows) >= 3:
-        # 從最近的低點開始往前檢查
-        for i in range(len(lows) - 2, -1, -1):
-            if lows[i+2] < len(df) - 10:  # 確保型態不是太久以前的
-                left_shoulder = df.iloc[lows[i]]['Low']
-                head = df.iloc[lows[i+1]]['Low']
-                right_shoulder = df.iloc[lows[i+2]]['Low']
-                
-                # 頭肩底條件：頭部最低，兩肩低度相近
-                if (head < left_shoulder and head < right_shoulder and
-                    abs(left_shoulder - right_shoulder) / abs(head) < 0.05):
-                    pattern_date = df.index[lows[i+1]]
-                    days_ago = (df.index[-1] - pattern_date).days if hasattr(df.index, 'date') else len(df) - lows[i+1]
-                    date_str = pattern_date.strftime('%Y-%m-%d') if hasattr(pattern_date, 'strftime') else str(pattern_date)
-                    return "頭肩底", 1, f"在 {date_str} 形成頭肩底，預示上漲"
-    
     return None, 0, None
 
-def detect_double_top_bottom(df, min_pattern_bars=15, tolerance=0.02):
+def detect_double_top_bottom(df, min_pattern_bars=15, tolerance=0.02, ctx=None):
     """
     偵測雙重頂和雙重底
+    只檢查最近的兩個高點（低點），且第二個在最近30根K線內，雙重頂優先
     tolerance: 兩個峰/谷的價格容忍度
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
     """
     if len(df) < min_pattern_bars:
         return None, 0, "資料長度不足以判斷雙重頂底"
     
-    highs, lows = find_local_extrema(df, order=3)
-    
-    # 雙重頂檢測 - 只檢查最近的高點
-    if len(highs) >= 2:
-        # 確保是最近的型態
-        if highs[-1] > len(df) - 30:  # 最近30根K線內
-            recent_highs = highs[-2:]
-            peak1 = df.iloc[recent_highs[0]]['High']
-            peak2 = df.iloc[recent_highs[1]]['High']
-            
-            if abs(peak1 - peak2) / max(peak1, peak2) < tolerance:
-                # 檢查中間是否有明顯回檔
-                valley_between = df.iloc[recent_highs[0]:recent_highs[1]]['Low'].min()
-                if (peak1 - valley_between) / peak1 > 0.05:
-                    date_str = df.index[recent_highs[-1]].strftime('%Y-%m-%d') if hasattr(df.index[0], 'strftime') else str(df.index[recent_highs[-1]])
-                    return "雙重頂", -1, f"在 {date_str} 形成雙重頂，兩個高點在 {peak1:.2f} 附近"
-    
-    # 雙重底檢測
-    if len(lows) >= 2:
-        # 確保是最近的型態
-        if lows[-1] > len(df) - 30:  # 最近30根K線內
-            recent_lows = lows[-2:]
-            valley1 = df.iloc[recent_lows[0]]['Low']
-            valley2 = df.iloc[recent_lows[1]]['Low']
-            
-            if abs(valley1 - valley2) / min(valley1, valley2) < tolerance:
-                # 檢查中間是否有明顯反彈
-                peak_between = df.iloc[recent_lows[0]:recent_lows[1]]['High'].max()
-                if (peak_between - valley1) / valley1 > 0.05:
-                    date_str = df.index[recent_lows[-1]].strftime('%Y-%m-%d') if hasattr(df.index[0], 'strftime') else str(df.index[recent_lows[-1]])
-                    return "雙重底", 1, f"在 {date_str} 形成雙重底，兩個低點在 {valley1:.2f} 附近"
+    highs, lows = find_local_extrema(df, order=3, ctx=ctx)
+    patterns = scan_double_tops_bottoms(df, order=3, tolerance=tolerance, ctx=ctx)
+    for name, points, label in (("雙重頂", highs, "高點"), ("雙重底", lows, "低點")):
+        if len(points) >= 2 and points[-1] > len(df) - 30:
+            matches = patterns[(patterns['Pattern'] == name) & (patterns['Bar'] == points[-1])]
+            if not matches.empty:
+                last = matches.iloc[-1]
+                return (name, int(last['Score']),
+                        f"在 {_date_str(last['End'])} 形成{name}，兩個{label}在 {last['Level']:.2f} 附近")
     
     return None, 0, None
 
-def detect_triangle_patterns(df, min_pattern_bars=20):
+def detect_triangle_patterns(df, min_pattern_bars=20, ctx=None):
     """
     偵測三角形型態（上升三角形、下降三角形）
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
     """
     if len(df) < min_pattern_bars:
         return None, 0, "資料長度不足以判斷三角形型態"
     
     recent_df = df.tail(min_pattern_bars)
-    highs, lows = find_local_extrema(recent_df, order=2)
+    highs, lows = find_local_extrema(recent_df, order=2, ctx=ctx)
     
     if len(highs) < 2 or len(lows) < 2:
         return None, 0, None
@@ -173,15 +480,16 @@ def detect_flag_patterns(df, min_pattern_bars=10):
     
     return None, 0, None
 
-def detect_wedge_patterns(df, min_pattern_bars=20):
+def detect_wedge_patterns(df, min_pattern_bars=20, ctx=None):
     """
     偵測楔形型態
+    ctx: 可選的 AnalysisContext，用於共用極值索引（見 find_local_extrema）
     """
     if len(df) < min_pattern_bars:
         return None, 0, "資料長度不足以判斷楔形"
     
     recent_df = df.tail(min_pattern_bars)
-    highs, lows = find_local_extrema(recent_df, order=3)
+    highs, lows = find_local_extrema(recent_df, order=3, ctx=ctx)
     
     if len(highs) < 2 or len(lows) < 2:
         return None, 0, None
@@ -233,14 +541,215 @@ def detect_rounded_patterns(df, min_pattern_bars=30):
     
     return None, 0, None
 
-def analyze_trend_patterns(df, lookback_days=200):
+# 滑動窗口型態（三角形、楔形、旗型）掃描結果的欄位：Start / End 為窗口第一根與最後一根的日期，Bar 為最後一根的位置
+WINDOW_PATTERN_COLUMNS = ['Pattern', 'Score', 'Start', 'End', 'Bar']
+
+def _full_extrema_index(df, column, order, ctx):
+    """df 整段的 ExtremaIndex；df 即為 ctx 的K線時使用 ctx 中共用的索引"""
+    if ctx is not None and len(ctx) == len(df) and len(df) and df.index[0] == ctx.kline_df.index[0] \
+            and df.index[-1] == ctx.kline_df.index[-1]:
+        return get_extrema_index(ctx, column, order)
+    comparator = np.greater if column == 'high' else np.less
+    return ExtremaIndex(df['High' if column == 'high' else 'Low'].to_numpy(dtype=float), order, comparator)
+
+def _window_parts(window, patterns):
+    """patterns: [(名稱, 分數, 每個窗口是否符合的布林陣列)]，第 r 個窗口為 [r, r + window)；返回 _pattern_frame 的各型態"""
+    parts = []
+    for name, score, found in patterns:
+        start = np.flatnonzero(found)
+        parts.append({'Pattern': name, 'Score': score, 'Start': start, 'End': start + window - 1,
+                      'Bar': start + window - 1})
+    return parts
+
+def scan_triangle_patterns(df, window=20, order=2, ctx=None):
+    """
+    以滑動窗口回歸一次檢查所有長度 window 的窗口（與 detect_triangle_patterns 對每個窗口的判斷相同）
+    ctx: 可選的 AnalysisContext，df 為其整段K線時共用極值索引
+    返回: 每個符合的窗口一列的 DataFrame（欄位見 WINDOW_PATTERN_COLUMNS），依窗口結束位置排序
+    """
+    return _pattern_frame(WINDOW_PATTERN_COLUMNS, _triangle_parts(df, window, order, ctx), df)
+
+def _triangle_parts(df, window, order, ctx):
+    """scan_triangle_patterns 的各型態 {欄位: 陣列}（見 _pattern_frame）"""
+    if len(df) < window:
+        return []
+    high_count, high_slope = _window_extrema_slope(_full_extrema_index(df, 'high', order, ctx), window, rank=True)
+    low_count, low_slope = _window_extrema_slope(_full_extrema_index(df, 'low', order, ctx), window, rank=True)
+    enough = (high_count >= 2) & (low_count >= 2)
+    with np.errstate(invalid='ignore'):
+        ascending = enough & (low_slope > 0) & (np.abs(high_slope) < 0.001)
+        descending = enough & ~ascending & (high_slope < 0) & (np.abs(low_slope) < 0.001)
+    return _window_parts(window, [("上升三角形", 1, ascending), ("下降三角形", -1, descending)])
+
+def scan_wedge_patterns(df, window=20, order=3, ctx=None):
+    """
+    以滑動窗口回歸一次檢查所有長度 window 的窗口（與 detect_wedge_patterns 對每個窗口的判斷相同）
+    ctx: 可選的 AnalysisContext，df 為其整段K線時共用極值索引
+    返回: 每個符合的窗口一列的 DataFrame（欄位見 WINDOW_PATTERN_COLUMNS），依窗口結束位置排序
+    """
+    return _pattern_frame(WINDOW_PATTERN_COLUMNS, _wedge_parts(df, window, order, ctx), df)
+
+def _wedge_parts(df, window, order, ctx):
+    """scan_wedge_patterns 的各型態 {欄位: 陣列}（見 _pattern_frame）"""
+    if len(df) < window:
+        return []
+    high_count, high_slope = _window_extrema_slope(_full_extrema_index(df, 'high', order, ctx), window)
+    low_count, low_slope = _window_extrema_slope(_full_extrema_index(df, 'low', order, ctx), window)
+    enough = (high_count >= 2) & (low_count >= 2)
+    with np.errstate(invalid='ignore'):
+        rising = enough & (high_slope > 0) & (low_slope > 0) & (low_slope > high_slope)
+        falling = enough & ~rising & (high_slope < 0) & (low_slope < 0) & (high_slope > low_slope)
+    return _window_parts(window, [("上升楔形", -1, rising), ("下降楔形", 1, falling)])
+
+def scan_flag_patterns(df, min_pattern_bars=10):
+    """
+    一次檢查所有長度 min_pattern_bars + 10 的窗口（與 detect_flag_patterns 對每個窗口的判斷相同）
+    旗面的斜率與波動度由 window_sums 的累計和計算
+    返回: 每個符合的窗口一列的 DataFrame（欄位見 WINDOW_PATTERN_COLUMNS），依窗口結束位置排序
+    """
+    window = min_pattern_bars + 10
+    if len(df) < window:
+        return pd.DataFrame(columns=WINDOW_PATTERN_COLUMNS)
+    close = df['Close'].to_numpy(dtype=float)
+    windows = len(close) - window + 1
+    # 旗桿為窗口前 10 根的漲跌幅，旗面為最後 min_pattern_bars 根
+    pole_return = (close[9:9 + windows] - close[:windows]) / close[:windows]
+    sums = window_sums(np.arange(len(close)), close, min_pattern_bars)[:, 10:]
+    flag_slope = regression_from_sums(sums)[0]
+    count, _, total, _, _, squares = sums
+    flag_mean = total / count
+    flag_volatility = np.sqrt(np.maximum(squares - total * flag_mean, 0) / (count - 1)) / flag_mean
+    bull = (pole_return > 0.1) & (flag_slope < 0) & (flag_volatility < 0.05)
+    bear = ~bull & (pole_return < -0.1) & (flag_slope > 0) & (flag_volatility < 0.05)
+    return _pattern_frame(WINDOW_PATTERN_COLUMNS, _window_parts(window, [("多頭旗型", 1, bull), ("空頭旗型", -1, bear)]),
+                          df)
+
+def scan_rounded_patterns(df, min_pattern_bars=30):
+    """
+    一次檢查所有長度 min_pattern_bars 的窗口（與 detect_rounded_patterns 對每個窗口的判斷相同）
+    返回: 每個符合的窗口一列的 DataFrame（欄位見 WINDOW_PATTERN_COLUMNS），依窗口結束位置排序
+    """
+    window = min_pattern_bars
+    # 二階差分經 5 根平滑後前 4 個為 NaN，前半段沒有有效值時不會符合
+    half = (window - 2) // 2 - 4
+    if len(df) < window or half <= 0:
+        return pd.DataFrame(columns=WINDOW_PATTERN_COLUMNS)
+    close = df['Close'].to_numpy(dtype=float)
+    second_diff = np.diff(sliding_window_view(close, window), n=2, axis=1)
+    smooth = sliding_window_view(second_diff, 5, axis=1).mean(axis=2)
+    first_half, second_half = smooth[:, :half].mean(axis=1), smooth[:, half:].mean(axis=1)
+    top = (first_half < -0.01) & (second_half > 0.01)
+    bottom = ~top & (first_half > 0.01) & (second_half < -0.01)
+    return _pattern_frame(WINDOW_PATTERN_COLUMNS, _window_parts(window, [("圓弧頂", -1, top), ("圓弧底", 1, bottom)]), df)
+
+# 型態時間軸中雙重頂底使用整段序列的極值（order 3）：序列最後 3 根的極值只以部分右側K線判斷，
+# 加入新K線後只有結束於這些位置之後的型態可能改變
+TIMELINE_EXTREMA_ORDER = 3
+# 時間軸中各型態從結束日期到可以確認（極值右側已有 order 根K線）所需的K線數，滑動窗口型態在結束日期即可確認
+TIMELINE_CONFIRM_BARS = {name: TIMELINE_EXTREMA_ORDER for name in ('雙重頂', '雙重底')}
+# 型態時間軸中滑動窗口型態的窗口長度（與各掃描函數的預設值相同）
+TIMELINE_WINDOWS = {name: 20 for name in ('上升三角形', '下降三角形', '上升楔形', '下降楔形', '多頭旗型', '空頭旗型')}
+TIMELINE_WINDOWS.update({'圓弧頂': 30, '圓弧底': 30})
+# 增量更新型態時間軸時，在新K線前面接上的歷史K線數
+TIMELINE_WARMUP_BARS = TREND_LOOKBACK_DAYS
+
+def _merge_window_runs(table):
+    """
+    將同一型態連續符合的窗口（結束位置相鄰）合併為一列：
+    Start 為第一個窗口的第一根，End / Bar 為最後一個窗口的最後一根
+    """
+    if table.empty:
+        return table
+    table = table.sort_values(['Pattern', 'Bar'], kind='stable')
+    pattern, bar = table['Pattern'].to_numpy(), table['Bar'].to_numpy()
+    first = np.ones(len(table), dtype=bool)
+    first[1:] = (pattern[1:] != pattern[:-1]) | (bar[1:] != bar[:-1] + 1)
+    last = np.append(first[1:], True)
+    merged = table[first].copy()
+    merged['End'] = table['End'].to_numpy()[last]
+    merged['Bar'] = bar[last]
+    return merged
+
+def scan_pattern_timeline(df, since=0, ctx=None):
+    """
+    掃描 df 整段歷史中所有的圖形型態（雙重頂底、三角形、楔形、旗型、圓弧；頭肩型態已停用，見 detect_head_and_shoulders），
+    返回結束位置在第 since 根（含）之後的型態
+
+    雙重頂底的每個型態一列（Start / End 為第一個與最後一個極值）；
+    滑動窗口型態（見 TIMELINE_WINDOWS）連續符合的窗口合併為一列，Start 為第一個窗口的第一根、End 為最後一個窗口的最後一根，
+    從 df 第一根開始的型態可能在 df 之前就已開始。參數與各偵測函數的預設值相同。
+    ctx: 可選的 AnalysisContext，df 為其整段K線時共用極值索引
+    返回: 欄位為 PATTERN_TIMELINE_COLUMNS 的 DataFrame，依結束日期排序
+    """
+    if since >= len(df):
+        return pd.DataFrame(columns=PATTERN_TIMELINE_COLUMNS)
+    window_tables = [_merge_window_runs(table) for table in (
+        scan_triangle_patterns(df, ctx=ctx), scan_wedge_patterns(df, ctx=ctx),
+        scan_flag_patterns(df), scan_rounded_patterns(df))]
+    tables = [table[PATTERN_TIMELINE_COLUMNS] for table in [
+        scan_double_tops_bottoms(df, ctx=ctx)] + window_tables
+        if not table.empty]
+    if not tables:
+        return pd.DataFrame(columns=PATTERN_TIMELINE_COLUMNS)
+    timeline = pd.concat(tables, ignore_index=True)
+    timeline = timeline[timeline['End'] >= df.index[since]]
+    timeline = timeline.sort_values(['End', 'Start'], kind='stable').reset_index(drop=True)
+    return timeline.astype({'Score': int})
+
+def timeline_history_sufficient(df, since, ctx=None):
+    """
+    df 是否足以正確掃描結束位置在 since 之後的型態（df 只是完整歷史的最後一段時）
+
+    df 開頭 TIMELINE_EXTREMA_ORDER 根內的極值是以不完整的左側K線判斷；
+    since 之前、開頭以外至少各有兩個局部高點與低點時，結束於 since 之後的雙重頂底都只用到正確的極值。
+    """
+    order = TIMELINE_EXTREMA_ORDER
+    highs, lows = find_local_extrema(df, order=order, ctx=ctx)
+    return all(np.count_nonzero((points >= order) & (points < since)) >= 2 for points in (highs, lows))
+
+# 多尺度型態掃描的極值 order 範圍
+MULTISCALE_ORDERS = range(2, 21)
+# scan_multiscale_patterns 的欄位：Order 為極值的尺度，其餘同 WINDOW_PATTERN_COLUMNS
+MULTISCALE_PATTERN_COLUMNS = ['Order'] + WINDOW_PATTERN_COLUMNS
+
+def scan_multiscale_patterns(df, orders=MULTISCALE_ORDERS, ctx=None):
+    """
+    在每個極值尺度（order）掃描 df 整段的雙重頂底、三角形與楔形（頭肩型態已停用，見 detect_head_and_shoulders）
+
+    所有尺度共用 ctx 中同一個 MultiScaleExtrema（高點與低點各以單調堆疊計算一次），各尺度的極值由阻擋距離直接取得，
+    不需對每個 order 重新比較；三角形與楔形的窗口隨 order 等比例放大（order 2 / 3 時即預設的 20 根）。
+    其餘參數與各掃描函數的預設值相同；旗型與圓弧型態不使用極值，與尺度無關，不列入。
+    ctx: 可選的 AnalysisContext（須為 df 整段的K線），未提供時建立一個
+    返回: 欄位為 MULTISCALE_PATTERN_COLUMNS 的 DataFrame，依結束位置排序（同一根K線依 Order 由小到大）
+    """
+    ctx = ctx if ctx is not None else AnalysisContext(df)
+    parts = []
+    for order in orders:
+        for part in (_double_top_bottom_parts(df, order, 0.02, 0.05, ctx) +
+                     _triangle_parts(df, 10 * order, order, ctx) +
+                     _wedge_parts(df, 20 * order // 3, order, ctx)):
+            part['Order'] = order
+            parts.append(part)
+    return _pattern_frame(MULTISCALE_PATTERN_COLUMNS, parts, df)
+
+# 以 find_local_extrema 尋找極值的偵測函數
+EXTREMA_DETECTORS = (detect_double_top_bottom, detect_triangle_patterns, detect_wedge_patterns)
+
+def analyze_trend_patterns(df, lookback_days=TREND_LOOKBACK_DAYS):
     """
     主函數：分析所有趨勢型態
     參數:
-    - df: K線數據
-    - lookback_days: 分析最近多少天的數據（預設200天）
+    - df: K線數據，或 AnalysisContext（使用其帶指標的K線，同一 context 內只計算一次）
+    - lookback_days: 分析最近多少根K線的數據（預設200根）
     返回: {pattern_name: (score, description), ...}
     """
+    if isinstance(df, AnalysisContext):
+        ctx = df
+        return ctx.memoize(('analyze_trend_patterns', lookback_days),
+                           lambda: _analyze_trend_patterns(ctx.frame, lookback_days, ctx))
+    return _analyze_trend_patterns(df, lookback_days, AnalysisContext(df))
+
+def _analyze_trend_patterns(df, lookback_days, ctx):
     patterns = {}
     
     # 只使用最近的數據進行分析
@@ -250,9 +759,8 @@ def analyze_trend_patterns(df, lookback_days=200):
     if len(df) < 20:
         return {"錯誤": (0, "資料長度不足（需要至少20根K線）")}
     
-    # 檢測各種型態
+    # 檢測各種型態（頭肩型態已停用，見 detect_head_and_shoulders）
     pattern_functions = [
-        detect_head_and_shoulders,
         detect_double_top_bottom,
         detect_triangle_patterns,
         detect_flag_patterns,
@@ -262,7 +770,9 @@ def analyze_trend_patterns(df, lookback_days=200):
     
     for func in pattern_functions:
         try:
-            pattern_name, score, description = func(df)
+            # 使用極值的偵測函數共用 ctx 中的極值索引
+            kwargs = {'ctx': ctx} if func in EXTREMA_DETECTORS else {}
+            pattern_name, score, description = func(df, **kwargs)
             if pattern_name and description:
                 patterns[pattern_name] = (score, description)
         except Exception as e:
@@ -349,4 +859,13 @@ def detect_ma_arrangement(df):
     if last['Close'] < last['SMA_20'] < last['SMA_60']:
         return "均線空頭排列", -1, "價格 < 20MA < 60MA，趨勢向下"
     
-    return None, 0, None
\ No newline at end of file
+    return None, 0, None
+
+# 各分析函數（依預設參數）需要的最少K線數，超過的歷史不影響結果
+# 交叉與均線排列只讀最後幾根，指標欄位本身的暖身由計算指標的一方負責（見 indicators.INDICATOR_LOOKBACK）
+LOOKBACK_BARS = {
+    analyze_trend_patterns: TREND_LOOKBACK_DAYS,
+    detect_macd_cross: 2,
+    detect_kd_cross: 2,
+    detect_ma_arrangement: 1,
+}